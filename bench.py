@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+import contextlib
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser, Namespace, RawDescriptionHelpFormatter
+
+import bootimg
+import get_mkbootimg_settings
+import mkbootimg
+import unmkbootimg
+
+MIB = 1024 * 1024
+
+# name -> (header version, vendor_boot, page size); page size 0 takes -pagesize
+IMAGE_LAYOUTS = {
+    "v0": (0, False, 0),
+    "v1": (1, False, 0),
+    "v2": (2, False, 0),
+    "v3": (3, False, bootimg.BOOT_V3_PAGE_SIZE),
+    "v4": (4, False, bootimg.BOOT_V3_PAGE_SIZE),
+    "vendor_v3": (3, True, 0),
+    "vendor_v4": (4, True, 0),
+}
+
+
+def usage():
+    return """bench.py
+        -images: layouts to generate (default: all of %s)
+        -pagesize: page size for v0-v2 and vendor images (default 2048)
+        -kernel-size: kernel size in MiB (default 16)
+        -ramdisk-size: ramdisk size in MiB (default 16)
+        -preamble: bytes of MTK-style data placed in front of every image (default 0)
+        -mtk-headers: wrap kernel and ramdisk in 512-byte MTK headers
+        -repeat: timed runs per case (default 5)
+        -unpackbootimg: C unpackbootimg binary to time alongside the Python tools
+        -mkbootimg: C mkbootimg binary to time alongside the Python tools
+        -history: JSON lines file each run is appended to and compared against
+        -threshold: slowdown against the previous run reported as a regression (default 0.2)
+        -json: print the run as JSON instead of a table""" % ", ".join(IMAGE_LAYOUTS)
+
+
+def parse_arguments():
+    parser = ArgumentParser(formatter_class=RawDescriptionHelpFormatter, epilog=usage())
+    parser.add_argument("-images", required=False, nargs="+", default=list(IMAGE_LAYOUTS), choices=IMAGE_LAYOUTS)
+    parser.add_argument("-pagesize", required=False, default=2048, type=int)
+    parser.add_argument("-kernel-size", required=False, default=16, type=float)
+    parser.add_argument("-ramdisk-size", required=False, default=16, type=float)
+    parser.add_argument("-preamble", required=False, default=0, type=int)
+    parser.add_argument("-mtk-headers", required=False, default=False, action="store_true")
+    parser.add_argument("-repeat", required=False, default=5, type=int)
+    parser.add_argument("-unpackbootimg", required=False, default=None)
+    parser.add_argument("-mkbootimg", required=False, default=None)
+    parser.add_argument("-history", required=False, default=None)
+    parser.add_argument("-threshold", required=False, default=0.2, type=float)
+    parser.add_argument("-json", required=False, default=False, action="store_true")
+    args = parser.parse_args()
+    return args
+
+
+def write_section(path, size, seed, mtk_name=None):
+    data = random.Random(seed).randbytes(size)
+    with open(path, "wb") as file:
+        if mtk_name:
+            file.write(bootimg.build_mtk_header(mtk_name, size))
+        file.write(data)
+    return path
+
+
+def generate_image(directory, layout, args):
+    # section files stay next to the image so pack and repack cases can reuse them
+    header_version, vendor, page_size = IMAGE_LAYOUTS[layout]
+    page_size = page_size or args.pagesize
+    kernel_size = int(args.kernel_size * MIB)
+    ramdisk_size = int(args.ramdisk_size * MIB)
+    prefix = os.path.join(directory, layout + "-")
+    argv = ["--header_version", str(header_version), "--pagesize", str(page_size), "--cmdline", "bench",
+            "--os_version", "12.0.0", "--os_patch_level", "2024-01"]
+
+    if vendor:
+        argv = ["--vendor_cmdline", "bench", "--header_version", str(header_version), "--pagesize", str(page_size),
+                "--vendor_ramdisk", write_section(prefix + "vendor_ramdisk", ramdisk_size, 2),
+                "--dtb", write_section(prefix + "dtb", 64 * 1024, 3)]
+        if header_version > 3:
+            argv += ["--ramdisk_type", "dlkm", "--ramdisk_name", "dlkm",
+                     "--vendor_ramdisk_fragment", write_section(prefix + "dlkm", ramdisk_size // 4, 4),
+                     "--vendor_bootconfig", write_section(prefix + "bootconfig", 512, 5)]
+    else:
+        mtk = args.mtk_headers and header_version < 3
+        argv += ["--kernel", write_section(prefix + "kernel", kernel_size, 0, "KERNEL" if mtk else None),
+                 "--ramdisk", write_section(prefix + "ramdisk", ramdisk_size, 1, "ROOTFS" if mtk else None)]
+        if header_version in (1, 2):
+            argv += ["--recovery_dtbo", write_section(prefix + "recovery_dtbo", 256 * 1024, 6)]
+        if header_version == 2:
+            argv += ["--dtb", write_section(prefix + "dtb", 64 * 1024, 3)]
+
+    path = prefix + "image.img"
+    packed = path + ".packed" if args.preamble else path
+    mkbootimg.pack(mkbootimg.get_pack_options(mkbootimg.get_parser().parse_args(argv + ["-o", packed])))
+    if args.preamble:
+        with open(path, "wb") as file, open(packed, "rb") as source:
+            file.write(random.Random(7).randbytes(args.preamble))
+            shutil.copyfileobj(source, file, MIB)
+        os.unlink(packed)
+    return path, argv
+
+
+def get_syscalls():
+    # read and write syscalls only; /proc/self/io is the one counter available without tracing
+    try:
+        with open("/proc/self/io") as file:
+            counters = dict(line.split(": ") for line in file.read().splitlines())
+        return int(counters["syscr"]) + int(counters["syscw"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def time_case(function, repeat, number):
+    # sub-millisecond cases run number times per timing so clock resolution does not dominate
+    timings = []
+    syscalls = get_syscalls()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        timings.append((time.perf_counter() - start) / number)
+    if syscalls is not None:
+        syscalls = (get_syscalls() - syscalls) // (repeat * number)
+    return {"seconds": min(timings), "median": statistics.median(timings), "syscalls": syscalls}
+
+
+def run_case(function, repeat, number=1):
+    # every case runs in its own child so peak RSS belongs to that case alone
+    if not hasattr(os, "fork"):
+        return {**time_case(function, repeat, number), "max_rss_kb": None}
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                result = time_case(function, repeat, number)
+        except Exception as error:
+            result = {"error": str(error) or type(error).__name__}
+        os.write(write_fd, json.dumps(result).encode())
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd, "rb") as pipe:
+        output = pipe.read()
+    _, _, rusage = os.wait4(pid, 0)
+    result = json.loads(output) if output else {"error": "benchmark process died"}
+    result["max_rss_kb"] = rusage.ru_maxrss
+    return result
+
+
+def run_command(argv):
+    subprocess.run(argv, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def get_cases(directory, layout, path, argv, args):
+    with open(path, "rb") as file:
+        window = bootimg.read_scan_window(file)
+    unpack_dir = os.path.join(directory, layout + "-unpack")
+    output = os.path.join(directory, layout + "-out.img")
+    os.makedirs(unpack_dir, exist_ok=True)
+    header_version, vendor, page_size = IMAGE_LAYOUTS[layout]
+    # a fragmented vendor ramdisk cannot be swapped in place, its dtb can
+    section = ("dtb" if header_version > 3 else "vendor_ramdisk") if vendor else "kernel"
+    section_path = path[:-len("image.img")] + section
+
+    cases = {
+        "find_magic": (lambda: bootimg.find_magic(window), 0, 1000),
+        "parse_header": (lambda: bootimg.parse_image(window), 0, 1000),
+        "parsePath": (lambda: get_mkbootimg_settings.parsePath(Namespace(path=path)), 0, 100),
+        "unpack": (lambda: unmkbootimg.unpack(path, unpack_dir), os.path.getsize(path), 1),
+        "pack": (lambda: mkbootimg.pack(mkbootimg.get_pack_options(
+            mkbootimg.get_parser().parse_args(argv + ["-o", output]))), os.path.getsize(path), 1),
+        "repack_header": (lambda: mkbootimg.repack(path, output, {"cmdline": "bench repack"}),
+                          os.path.getsize(path), 1),
+        "repack_" + section: (lambda: mkbootimg.repack(path, output, {section: section_path}),
+                              os.path.getsize(path), 1),
+    }
+    if args.mtk_headers and not vendor and header_version < 3:
+        cases["unpack_mtk"] = (lambda: unmkbootimg.unpack(path, unpack_dir, mtk=True), os.path.getsize(path), 1)
+    if args.unpackbootimg:
+        cases["c_unpackbootimg"] = (lambda: run_command([args.unpackbootimg, "-i", path, "-o", unpack_dir]),
+                                    os.path.getsize(path), 1)
+    if args.mkbootimg and not (vendor and header_version > 3):
+        cases["c_mkbootimg"] = (lambda: run_command([args.mkbootimg] + argv + ["-o", output]),
+                                os.path.getsize(path), 1)
+    return cases
+
+
+def get_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_benchmarks(args):
+    results = []
+    with tempfile.TemporaryDirectory(prefix="mkbootimg-bench-") as directory:
+        for layout in args.images:
+            path, argv = generate_image(directory, layout, args)
+            for name, (function, size, number) in get_cases(directory, layout, path, argv, args).items():
+                result = {"image": layout, "case": name, **run_case(function, args.repeat, number)}
+                if size and result.get("seconds"):
+                    result["mb_s"] = size / MIB / result["seconds"]
+                results.append(result)
+    return {"time": time.time(), "revision": get_revision(), "python": sys.version.split()[0],
+            "settings": {"pagesize": args.pagesize, "kernel_size": args.kernel_size,
+                         "ramdisk_size": args.ramdisk_size, "preamble": args.preamble,
+                         "mtk_headers": args.mtk_headers, "repeat": args.repeat},
+            "results": results}
+
+
+def load_previous_run(path, settings):
+    # only a run with the same generator settings is a fair baseline
+    if not path or not os.path.exists(path):
+        return None
+    previous = None
+    with open(path) as file:
+        for line in file:
+            run = json.loads(line)
+            if run.get("settings") == settings:
+                previous = run
+    return previous
+
+
+def find_regressions(run, previous, threshold):
+    if previous is None:
+        return []
+    baseline = {(result["image"], result["case"]): result for result in previous["results"]}
+    regressions = []
+    for result in run["results"]:
+        before = baseline.get((result["image"], result["case"]))
+        if before and before.get("seconds") and result.get("seconds") and \
+                result["seconds"] > before["seconds"] * (1 + threshold):
+            regressions.append({"image": result["image"], "case": result["case"], "before": before["seconds"],
+                                "after": result["seconds"], "revision": previous.get("revision")})
+    return regressions
+
+
+def print_run(run, regressions):
+    print("%-10s %-22s %12s %12s %10s %10s %10s" % ("image", "case", "best", "median", "MB/s", "RSS MiB",
+                                                    "syscalls"))
+    for result in run["results"]:
+        if "error" in result:
+            print("%-10s %-22s error: %s" % (result["image"], result["case"], result["error"]))
+            continue
+        print("%-10s %-22s %10.3fms %10.3fms %10s %10s %10s" % (
+            result["image"], result["case"], result["seconds"] * 1000, result["median"] * 1000,
+            "%.1f" % result["mb_s"] if "mb_s" in result else "-",
+            "%.1f" % (result["max_rss_kb"] / 1024) if result["max_rss_kb"] else "-",
+            result["syscalls"] if result["syscalls"] is not None else "-"))
+    for regression in regressions:
+        print("regression: %s %s %.3fms -> %.3fms (against %s)" % (
+            regression["image"], regression["case"], regression["before"] * 1000, regression["after"] * 1000,
+            regression["revision"]))
+
+
+def main():
+    args = parse_arguments()
+    run = run_benchmarks(args)
+    regressions = find_regressions(run, load_previous_run(args.history, run["settings"]), args.threshold)
+    if args.history:
+        with open(args.history, "a") as file:
+            file.write(json.dumps(run) + "\n")
+
+    if args.json:
+        print(json.dumps({**run, "regressions": regressions}))
+    else:
+        print_run(run, regressions)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,517 @@
+#!/usr/bin/env python3
+import ctypes
+import mmap
+import os
+import re
+
+import instrument
+
+# Layouts mirror bootimg.h; all headers are packed and little-endian on disk.
+
+BOOT_MAGIC = b"ANDROID!"
+BOOT_MAGIC_SIZE = 8
+BOOT_NAME_SIZE = 16
+BOOT_ARGS_SIZE = 512
+BOOT_EXTRA_ARGS_SIZE = 1024
+
+VENDOR_BOOT_MAGIC = b"VNDRBOOT"
+VENDOR_BOOT_MAGIC_SIZE = 8
+VENDOR_BOOT_ARGS_SIZE = 2048
+VENDOR_BOOT_NAME_SIZE = 16
+
+VENDOR_RAMDISK_TYPE_NONE = 0
+VENDOR_RAMDISK_TYPE_PLATFORM = 1
+VENDOR_RAMDISK_TYPE_RECOVERY = 2
+VENDOR_RAMDISK_TYPE_DLKM = 3
+VENDOR_RAMDISK_NAME_SIZE = 32
+VENDOR_RAMDISK_TYPES = {"none": VENDOR_RAMDISK_TYPE_NONE, "platform": VENDOR_RAMDISK_TYPE_PLATFORM,
+                        "recovery": VENDOR_RAMDISK_TYPE_RECOVERY, "dlkm": VENDOR_RAMDISK_TYPE_DLKM}
+VENDOR_RAMDISK_TABLE_ENTRY_BOARD_ID_SIZE = 16
+
+SEEK_LIMIT = 65536  # arbitrary byte limit to search in input file for ANDROID!/VNDRBOOT magic
+HDR_VER_MAX = 8  # arbitrary maximum header version value; when greater assume the field is appended dt size
+BOOT_V3_PAGE_SIZE = 4096  # page_size is hardcoded to 4096 in boot_img_hdr_v3 and above
+KERNEL_BASE_OFFSET = 0x00008000
+
+MTK_MAGIC = 0x58881688  # 88 16 88 58 on disk
+MTK_HEADER_SIZE = 512
+MTK_NAME_SIZE = 32
+MTK_FILL = 0xff  # everything behind the name, addr and mode included, is 0xff in the legacy layout
+MTK_SECTIONS = ("kernel", "ramdisk")
+
+BUFFER_TYPES = (bytes, bytearray, memoryview, mmap.mmap)
+MAGIC_PATTERN = re.compile(re.escape(BOOT_MAGIC) + b"|" + re.escape(VENDOR_BOOT_MAGIC))
+
+
+class _HeaderVersion(ctypes.Union):
+    _pack_ = 1
+    _fields_ = [("header_version", ctypes.c_uint32),
+                ("dt_size", ctypes.c_uint32)]
+
+
+class BootImgHdrV0(ctypes.Structure):
+    _pack_ = 1
+    _anonymous_ = ("_version",)
+    _fields_ = [("magic", ctypes.c_char * BOOT_MAGIC_SIZE),
+                ("kernel_size", ctypes.c_uint32),
+                ("kernel_addr", ctypes.c_uint32),
+                ("ramdisk_size", ctypes.c_uint32),
+                ("ramdisk_addr", ctypes.c_uint32),
+                ("second_size", ctypes.c_uint32),
+                ("second_addr", ctypes.c_uint32),
+                ("tags_addr", ctypes.c_uint32),
+                ("page_size", ctypes.c_uint32),
+                ("_version", _HeaderVersion),
+                ("os_version", ctypes.c_uint32),
+                ("name", ctypes.c_char * BOOT_NAME_SIZE),
+                ("cmdline", ctypes.c_char * BOOT_ARGS_SIZE),
+                ("id", ctypes.c_uint32 * 8),
+                ("extra_cmdline", ctypes.c_char * BOOT_EXTRA_ARGS_SIZE)]
+
+
+class BootImgHdrV1(BootImgHdrV0):
+    _pack_ = 1
+    _fields_ = [("recovery_dtbo_size", ctypes.c_uint32),
+                ("recovery_dtbo_offset", ctypes.c_uint64),
+                ("header_size", ctypes.c_uint32)]
+
+
+class BootImgHdrV2(BootImgHdrV1):
+    _pack_ = 1
+    _fields_ = [("dtb_size", ctypes.c_uint32),
+                ("dtb_addr", ctypes.c_uint64)]
+
+
+class BootImgHdrV3(ctypes.Structure):
+    _pack_ = 1
+    _fields_ = [("magic", ctypes.c_char * BOOT_MAGIC_SIZE),
+                ("kernel_size", ctypes.c_uint32),
+                ("ramdisk_size", ctypes.c_uint32),
+                ("os_version", ctypes.c_uint32),
+                ("header_size", ctypes.c_uint32),
+                ("reserved", ctypes.c_uint32 * 4),
+                ("header_version", ctypes.c_uint32),
+                ("cmdline", ctypes.c_char * (BOOT_ARGS_SIZE + BOOT_EXTRA_ARGS_SIZE))]
+
+
+class BootImgHdrV4(BootImgHdrV3):
+    _pack_ = 1
+    _fields_ = [("signature_size", ctypes.c_uint32)]
+
+
+class VendorBootImgHdrV3(ctypes.Structure):
+    _pack_ = 1
+    _fields_ = [("magic", ctypes.c_char * VENDOR_BOOT_MAGIC_SIZE),
+                ("header_version", ctypes.c_uint32),
+                ("page_size", ctypes.c_uint32),
+                ("kernel_addr", ctypes.c_uint32),
+                ("ramdisk_addr", ctypes.c_uint32),
+                ("vendor_ramdisk_size", ctypes.c_uint32),
+                ("cmdline", ctypes.c_char * VENDOR_BOOT_ARGS_SIZE),
+                ("tags_addr", ctypes.c_uint32),
+                ("name", ctypes.c_char * VENDOR_BOOT_NAME_SIZE),
+                ("header_size", ctypes.c_uint32),
+                ("dtb_size", ctypes.c_uint32),
+                ("dtb_addr", ctypes.c_uint64)]
+
+
+class VendorBootImgHdrV4(VendorBootImgHdrV3):
+    _pack_ = 1
+    _fields_ = [("vendor_ramdisk_table_size", ctypes.c_uint32),
+                ("vendor_ramdisk_table_entry_num", ctypes.c_uint32),
+                ("vendor_ramdisk_table_entry_size", ctypes.c_uint32),
+                ("bootconfig_size", ctypes.c_uint32)]
+
+
+class VendorRamdiskTableEntryV4(ctypes.Structure):
+    _pack_ = 1
+    _fields_ = [("ramdisk_size", ctypes.c_uint32),
+                ("ramdisk_offset", ctypes.c_uint32),
+                ("ramdisk_type", ctypes.c_uint32),
+                ("ramdisk_name", ctypes.c_char * VENDOR_RAMDISK_NAME_SIZE),
+                ("board_id", ctypes.c_uint32 * VENDOR_RAMDISK_TABLE_ENTRY_BOARD_ID_SIZE)]
+
+
+class MtkHdr(ctypes.Structure):
+    # MediaTek wraps kernels and ramdisks in a 512 byte header of its own, inside the boot image sections
+    _pack_ = 1
+    _fields_ = [("magic", ctypes.c_uint32),
+                ("size", ctypes.c_uint32),
+                ("name", ctypes.c_char * MTK_NAME_SIZE)]
+
+
+HEADER_READ_SIZE = max(ctypes.sizeof(BootImgHdrV2), ctypes.sizeof(BootImgHdrV4), ctypes.sizeof(VendorBootImgHdrV4))
+
+
+class Section:
+    def __init__(self, name, offset, size):
+        self.name = name
+        self.offset = offset
+        self.size = size
+
+
+class BootImage:
+    def __init__(self, magic, offset, header, page_size, sections):
+        self.magic = magic
+        self.offset = offset
+        self.header = header
+        self.page_size = page_size
+        self.sections = sections
+
+    @property
+    def is_vendor(self):
+        return self.magic == VENDOR_BOOT_MAGIC
+
+    @property
+    def is_legacy_dt(self):
+        # boot_img_hdr_v0 variants reuse header_version as an appended dt size
+        return not self.is_vendor and self.header.header_version > HDR_VER_MAX
+
+    @property
+    def header_version(self):
+        if self.is_legacy_dt:
+            return 0
+        return self.header.header_version
+
+    def section(self, name):
+        for section in self.sections:
+            if section.name == name:
+                return section
+        return None
+
+
+def get_padding(size, page_size):
+    pagemask = page_size - 1
+    if (size & pagemask) == 0:
+        return 0
+    return page_size - (size & pagemask)
+
+
+def align(size, page_size):
+    return size + get_padding(size, page_size)
+
+
+def read_scan_window(file, seeklimit=SEEK_LIMIT):
+    # one buffered read covering every offset the magic may start at plus the header behind it
+    file.seek(0)
+    return file.read(seeklimit + HEADER_READ_SIZE)
+
+
+def find_magics(buf, seeklimit=SEEK_LIMIT):
+    end = min(len(buf), seeklimit + BOOT_MAGIC_SIZE)
+    if not isinstance(buf, BUFFER_TYPES):
+        # unmapped sources (archive members, sparse images) hand over only the bytes the magic may sit in
+        buf = buf[:end]
+    for match in MAGIC_PATTERN.finditer(buf, 0, end):
+        yield match.start(), match.group()
+
+
+def find_magic(buf, seeklimit=SEEK_LIMIT):
+    with instrument.span("magic_search"):
+        return next(find_magics(buf, seeklimit), (-1, None))
+
+
+def read_struct(buf, offset, struct_type):
+    data = bytes(buf[offset:offset + ctypes.sizeof(struct_type)])
+    data += bytes(ctypes.sizeof(struct_type) - len(data))
+    return struct_type.from_buffer_copy(data)
+
+
+def read_header(buf, offset, magic):
+    with instrument.span("header_decode"):
+        return decode_header(buf, offset, magic)
+
+
+def decode_header(buf, offset, magic):
+    if magic == VENDOR_BOOT_MAGIC:
+        # vendor_boot_img_hdr started at v3 and is not cross-compatible with boot_img_hdr
+        header = read_struct(buf, offset, VendorBootImgHdrV3)
+        if header.header_version > 3:
+            header = read_struct(buf, offset, VendorBootImgHdrV4)
+        return header
+
+    header = read_struct(buf, offset, BootImgHdrV3)
+    if header.header_version < 3 or header.header_version > HDR_VER_MAX:
+        # boot_img_hdr_v2 in the backported header supports all boot_img_hdr versions and cross-compatible variants below 3
+        return read_struct(buf, offset, BootImgHdrV2)
+    if header.header_version > 3:
+        return read_struct(buf, offset, BootImgHdrV4)
+    return header
+
+
+def get_sections(magic, header, offset, page_size):
+    sections = []
+    position = offset + align(ctypes.sizeof(header), page_size)
+
+    def add(name, size, required=False):
+        nonlocal position
+        if size or required:
+            sections.append(Section(name, position, size))
+        position += align(size, page_size)
+
+    if magic == VENDOR_BOOT_MAGIC:
+        add("vendor_ramdisk", header.vendor_ramdisk_size, True)
+        add("dtb", header.dtb_size, True)
+        if header.header_version > 3:
+            add("vendor_ramdisk_table", header.vendor_ramdisk_table_size)
+            add("bootconfig", header.bootconfig_size)
+    elif isinstance(header, BootImgHdrV3):
+        add("kernel", header.kernel_size, True)
+        add("ramdisk", header.ramdisk_size, True)
+        if header.header_version > 3:
+            add("boot_signature", header.signature_size)
+    else:
+        add("kernel", header.kernel_size, True)
+        add("ramdisk", header.ramdisk_size, True)
+        add("second", header.second_size)
+        if header.header_version > HDR_VER_MAX:
+            add("dt", header.dt_size)
+        else:
+            if header.header_version > 0:
+                add("recovery_dtbo", header.recovery_dtbo_size)
+            if header.header_version > 1:
+                add("dtb", header.dtb_size)
+    return sections
+
+
+def parse_image(buf, pagesize=0, seeklimit=SEEK_LIMIT, offset=None):
+    if offset is None:
+        offset, magic = find_magic(buf, seeklimit)
+        if magic is None:
+            raise ValueError("Boot image magic not found.")
+    else:
+        magic = bytes(buf[offset:offset + BOOT_MAGIC_SIZE])
+        if magic not in (BOOT_MAGIC, VENDOR_BOOT_MAGIC):
+            raise ValueError("Boot image magic not found at %d." % offset)
+
+    header = read_header(buf, offset, magic)
+    if pagesize == 0:
+        if isinstance(header, BootImgHdrV3):
+            pagesize = BOOT_V3_PAGE_SIZE
+        else:
+            pagesize = header.page_size
+    if pagesize == 0 or pagesize & (pagesize - 1):
+        raise ValueError("Boot image page size %d is invalid." % pagesize)
+
+    return BootImage(magic, offset, header, pagesize, get_sections(magic, header, offset, pagesize))
+
+
+def scan_image(buf, seeklimit=SEEK_LIMIT):
+    candidates = []
+    for offset, magic in find_magics(buf, seeklimit):
+        try:
+            candidates.append((offset, magic, parse_image(buf, offset=offset)))
+        except ValueError:
+            candidates.append((offset, magic, None))
+    return candidates
+
+
+def get_base(header):
+    return (header.kernel_addr - KERNEL_BASE_OFFSET) & 0xffffffff
+
+
+def get_cmdline(header):
+    if isinstance(header, BootImgHdrV0):
+        return (header.cmdline + header.extra_cmdline).decode(errors="replace")
+    return header.cmdline.decode(errors="replace")
+
+
+def get_hash_type(header):
+    # sha1 is expected to have zeroes in id[20] and higher
+    # offset by 4 to accomodate bootimg variants with BOOT_NAME_SIZE 20
+    if any(bytes(header.id)[24:]):
+        return "sha256"
+    return "sha1"
+
+
+def decode_os_version(value):
+    if value == 0:
+        return None, None
+    os_version = value >> 11
+    os_patch_level = value & 0x7ff
+
+    a = (os_version >> 14) & 0x7f
+    b = (os_version >> 7) & 0x7f
+    c = os_version & 0x7f
+    y = (os_patch_level >> 4) + 2000
+    m = os_patch_level & 0xf
+    if m < 1 or m > 12:
+        return None, None
+    return "%d.%d.%d" % (a, b, c), "%d-%02d" % (y, m)
+
+
+def copy_range(src_fd, dst_fd, offset, count):
+    # in-kernel copy; returns how much was copied so callers can finish the rest from a mapped view
+    done = 0
+    copiers = []
+    if hasattr(os, "copy_file_range"):
+        copiers.append(lambda size: os.copy_file_range(src_fd, dst_fd, size, offset + done))
+    if hasattr(os, "sendfile"):
+        copiers.append(lambda size: os.sendfile(dst_fd, src_fd, offset + done, size))
+    for copier in copiers:
+        try:
+            while done < count:
+                copied = copier(count - done)
+                if copied == 0:
+                    break
+                done += copied
+        except OSError:
+            continue
+        break
+    return done
+
+
+def get_id_sections(image):
+    # sections in the order generate_id in mkbootimg.c feeds them to the boot id hash
+    if image.is_vendor or isinstance(image.header, BootImgHdrV3):
+        return []
+    names = ["kernel", "ramdisk", "second"]
+    if image.is_legacy_dt:
+        names.append("dt")
+    else:
+        if image.header.header_version > 0:
+            names.append("recovery_dtbo")
+        if image.header.header_version > 1:
+            names.append("dtb")
+    return [(name, image.section(name)) for name in names]
+
+
+def get_stored_id(image):
+    if not get_id_sections(image):
+        return None
+    return bytes(image.header.id)
+
+
+SIZE_FIELDS = {"kernel": "kernel_size", "ramdisk": "ramdisk_size", "second": "second_size", "dt": "dt_size",
+               "recovery_dtbo": "recovery_dtbo_size", "dtb": "dtb_size", "boot_signature": "signature_size",
+               "vendor_ramdisk": "vendor_ramdisk_size", "vendor_ramdisk_table": "vendor_ramdisk_table_size",
+               "bootconfig": "bootconfig_size"}
+
+
+def get_section_names(image):
+    # every section the layout reserves, including optional ones that are empty in this image
+    header = image.header
+    if image.is_vendor:
+        names = ["vendor_ramdisk", "dtb"]
+        if header.header_version > 3:
+            names += ["vendor_ramdisk_table", "bootconfig"]
+        return names
+    if isinstance(header, BootImgHdrV3):
+        names = ["kernel", "ramdisk"]
+        if header.header_version > 3:
+            names.append("boot_signature")
+        return names
+    return [name for name, section in get_id_sections(image)]
+
+
+class RamdiskFragment:
+    def __init__(self, index, name, ramdisk_type, offset, size, board_id):
+        self.index = index
+        self.name = name
+        self.ramdisk_type = ramdisk_type
+        self.offset = offset  # absolute, so the fragment can be sliced straight out of the mapped image
+        self.size = size
+        self.board_id = board_id
+
+    @property
+    def type_name(self):
+        for name, value in VENDOR_RAMDISK_TYPES.items():
+            if value == self.ramdisk_type:
+                return name
+        return "0x%x" % self.ramdisk_type
+
+    def view(self, buf):
+        # nothing is read until the returned view is touched
+        if not isinstance(buf, BUFFER_TYPES):
+            return buf[self.offset:self.offset + self.size]
+        return memoryview(buf)[self.offset:self.offset + self.size]
+
+
+def get_ramdisk_fragments(buf, image):
+    # a vendor_boot without a ramdisk table is treated as a single unnamed fragment
+    vendor_ramdisk = image.section("vendor_ramdisk")
+    if vendor_ramdisk is None:
+        raise ValueError("image has no vendor ramdisk")
+    table = image.section("vendor_ramdisk_table")
+    if table is None or image.header.header_version < 4 or image.header.vendor_ramdisk_table_entry_num == 0:
+        return [RamdiskFragment(0, "", VENDOR_RAMDISK_TYPE_NONE, vendor_ramdisk.offset, vendor_ramdisk.size,
+                                (0,) * VENDOR_RAMDISK_TABLE_ENTRY_BOARD_ID_SIZE)]
+
+    header = image.header
+    entry_size = header.vendor_ramdisk_table_entry_size
+    if entry_size < ctypes.sizeof(VendorRamdiskTableEntryV4) or \
+            header.vendor_ramdisk_table_entry_num * entry_size > table.size:
+        raise ValueError("vendor ramdisk table is malformed")
+    fragments = []
+    for index in range(header.vendor_ramdisk_table_entry_num):
+        entry = read_struct(buf, table.offset + index * entry_size, VendorRamdiskTableEntryV4)
+        if entry.ramdisk_offset + entry.ramdisk_size > vendor_ramdisk.size:
+            raise ValueError("vendor ramdisk fragment %d extends past the vendor ramdisk" % index)
+        fragments.append(RamdiskFragment(index, entry.ramdisk_name.decode(errors="replace"), entry.ramdisk_type,
+                                         vendor_ramdisk.offset + entry.ramdisk_offset, entry.ramdisk_size,
+                                         tuple(entry.board_id)))
+    return fragments
+
+
+def find_fragment(fragments, key):
+    # key is a fragment name, a type name such as "dlkm", or an index
+    for fragment in fragments:
+        if fragment.name and fragment.name == key:
+            return fragment
+    ramdisk_type = VENDOR_RAMDISK_TYPES.get(str(key).lower())
+    for fragment in fragments:
+        if ramdisk_type is not None and fragment.ramdisk_type == ramdisk_type:
+            return fragment
+        if ramdisk_type is None and str(fragment.index) == str(key):
+            return fragment
+    raise ValueError("no vendor ramdisk fragment matches " + str(key))
+
+
+def parse_bootconfig(data):
+    # one key = value per line; a value may be a quoted string or a comma separated list
+    params = []
+    for line in bytes(data).decode(errors="replace").splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        key, _, value = line.partition("=")
+        params.append((key.strip(), value.strip()))
+    return params
+
+
+def read_mtk_header(buf, offset, size):
+    # the header only counts when the payload it declares fits in what follows it
+    if size < MTK_HEADER_SIZE:
+        return None
+    header = read_struct(buf, offset, MtkHdr)
+    if header.magic != MTK_MAGIC or header.size > size - MTK_HEADER_SIZE:
+        return None
+    return header
+
+
+def get_mtk_name(header):
+    return header.name.decode(errors="replace")
+
+
+def build_mtk_header(name, size):
+    encoded = name.encode()
+    if len(encoded) > MTK_NAME_SIZE:
+        raise ValueError("MTK header name '%s' is too long" % name)
+    if size > 0xffffffff:
+        raise ValueError("MTK payload '%s' is too large" % name)
+    header = MtkHdr(MTK_MAGIC, size, encoded)
+    return bytes(header) + bytes([MTK_FILL]) * (MTK_HEADER_SIZE - ctypes.sizeof(header))
+
+
+def is_rebuildable_mtk_header(buf, offset, header):
+    # only headers build_mtk_header gives back byte for byte are stripped, so a repack restores the section exactly
+    original = bytes(buf[offset:offset + MTK_HEADER_SIZE])
+    return original == build_mtk_header(get_mtk_name(header), header.size)
+
+
+def get_mtk_payload(buf, section):
+    # the payload is a plain Section inside the image, so it is sliced or copied without touching the rest
+    header = read_mtk_header(buf, section.offset, section.size)
+    if header is None:
+        return None, section
+    return header, Section(section.name, section.offset + MTK_HEADER_SIZE, header.size)
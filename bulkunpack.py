@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+import asyncio
+import json
+import os
+import sys
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from concurrent.futures import ThreadPoolExecutor
+
+import bootimg
+import instrument
+import ramdisk
+import sectionstore
+from unmkbootimg import (get_fragment_sections, get_mtk_sections, map_image, write_bootconfig, write_fragment_table,
+                         write_fragments, write_mtk_settings, write_settings)
+
+WRITE_SIZE = 4 * 1024 * 1024  # every write but a file's last one is this size and lands on a multiple of it
+MEMORY_BUDGET = 256 * 1024 * 1024
+JOBS = 8
+
+
+def usage():
+    return """bulkunpack.py
+        -i: boot images, directories to search for them, or manifests listing one image per line
+        -o: output directory; every image is unpacked into its own subdirectory
+        -jobs: images unpacked at the same time (default 8)
+        -memory: bytes of section data allowed in flight between reads and writes (default 256 MiB)
+        -inflate: also write the decompressed ramdisk as <image>-ramdisk.cpio
+        -mtk: strip MediaTek headers off kernels and ramdisks, as unmkbootimg.py -mtk does
+        -store: keep sections once per content in this section store and hardlink them into the output directories
+        -json: print one JSON line per image""" + instrument.usage()
+
+
+def parse_arguments():
+    parser = ArgumentParser(formatter_class=RawDescriptionHelpFormatter, epilog=usage())
+    parser.add_argument("-i", required=True, nargs="+")
+    parser.add_argument("-o", required=True)
+    parser.add_argument("-jobs", required=False, default=JOBS, type=int)
+    parser.add_argument("-memory", required=False, default=MEMORY_BUDGET, type=int)
+    parser.add_argument("-inflate", required=False, default=False, action="store_true")
+    parser.add_argument("-mtk", required=False, default=False, action="store_true")
+    parser.add_argument("-store", required=False, default=None)
+    parser.add_argument("-json", required=False, default=False, action="store_true")
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    return args
+
+
+def is_boot_image(path, parse=False):
+    # with parse the header must decode too, which leaves out text that merely quotes the magic (settings output)
+    try:
+        with open(path, "rb") as file:
+            window = bootimg.read_scan_window(file)
+    except OSError:
+        return False
+    if not parse:
+        return bootimg.find_magic(window)[1] is not None
+    try:
+        bootimg.parse_image(window)
+    except ValueError:
+        return False
+    return True
+
+
+def find_images(inputs):
+    # directories are searched for anything with a boot header; other paths are images or manifests
+    for path in inputs:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if is_boot_image(os.path.join(root, name), True):
+                        yield os.path.join(root, name)
+        elif not os.path.exists(path) or is_boot_image(path):
+            # a missing path is reported on its own line instead of ending the run
+            yield path
+        else:
+            try:
+                with open(path) as manifest:
+                    lines = [line.strip() for line in manifest if line.strip()]
+            except UnicodeDecodeError:
+                # neither an image nor a manifest; unpacking it reports why
+                lines = [path]
+            yield from lines
+
+
+def get_output_directories(paths, root):
+    directories = []
+    used = set()
+    for path in paths:
+        name = os.path.basename(path)
+        directory = name
+        index = 1
+        while directory in used:
+            directory = "%s.%d" % (name, index)
+            index += 1
+        used.add(directory)
+        directories.append(os.path.join(root, directory))
+    return directories
+
+
+class MemoryBudget:
+    # readers wait here until writers have handed back enough of the budget, which is the backpressure
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self, size):
+        size = min(size, self.limit)
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.used + size <= self.limit)
+            self.used += size
+        return size
+
+    async def release(self, size):
+        async with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+
+def pwrite_all(fd, data, position):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, position)
+        view = view[written:]
+        position += written
+
+
+class ChunkWriter:
+    # writes run in the background while the next chunk is read; finish() waits for all of them
+
+    def __init__(self, fd, budget):
+        self.fd = fd
+        self.budget = budget
+        self.pending = set()
+
+    def write(self, data, position, reserved):
+        task = asyncio.create_task(self.write_chunk(data, position, reserved))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    async def write_chunk(self, data, position, reserved):
+        try:
+            await asyncio.to_thread(pwrite_all, self.fd, data, position)
+            instrument.count("bytes_written", len(data))
+        finally:
+            await self.budget.release(reserved)
+
+    async def finish(self):
+        if self.pending:
+            await asyncio.gather(*self.pending)
+
+
+def prepare_image(path, prefix, mtk=False):
+    file = open(path, "rb")
+    try:
+        mapped = map_image(file)
+        image = bootimg.parse_image(mapped)
+        for section in image.sections:
+            if section.offset + section.size > len(mapped):
+                raise ValueError(section.name + " extends past the end of " + path + ".")
+        os.makedirs(os.path.dirname(prefix), exist_ok=True)
+        # the settings go next to the sections instead of stdout, so parallel images do not interleave
+        with open(prefix + "settings", "w") as out:
+            write_settings(image, prefix, out)
+            fragments = None
+            if image.is_vendor and image.header_version > 3:
+                fragments = bootimg.get_ramdisk_fragments(mapped, image)
+                write_fragments(fragments, out)
+            bootconfig = image.section("bootconfig")
+            if bootconfig is not None:
+                end = bootconfig.offset + bootconfig.size
+                write_bootconfig(bootimg.parse_bootconfig(mapped[bootconfig.offset:end]), out)
+            sections = image.sections
+            if mtk:
+                sections, names = get_mtk_sections(mapped, image)
+                write_mtk_settings(names, prefix, out)
+        fragment_sections = get_fragment_sections(image, fragments)
+        if fragment_sections:
+            write_fragment_table(fragments, prefix)
+        sections = sections + fragment_sections
+    except (OSError, ValueError):
+        file.close()
+        raise
+    return file, mapped, image, sections
+
+
+async def copy_section(file, mapped, section, path, budget):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        # the kernel copies what it can without the data passing through the budget at all
+        done = await asyncio.to_thread(bootimg.copy_range, file.fileno(), fd, section.offset, section.size)
+        instrument.count("bytes_copied", done)
+        writer = ChunkWriter(fd, budget)
+        try:
+            for start in range(done, section.size, WRITE_SIZE):
+                size = min(WRITE_SIZE, section.size - start)
+                reserved = await budget.acquire(size)
+                try:
+                    data = await asyncio.to_thread(os.pread, file.fileno(), size, section.offset + start)
+                except BaseException:
+                    await budget.release(reserved)
+                    raise
+                writer.write(data, start, reserved)
+        finally:
+            await writer.finish()
+    finally:
+        os.close(fd)
+
+
+async def inflate_ramdisk(mapped, section, path, budget):
+    # decompressed chunks are coalesced into full WRITE_SIZE writes before they are queued
+    view = memoryview(mapped)[section.offset:section.offset + section.size]
+    try:
+        stream = ramdisk.open_ramdisk(view)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            writer = ChunkWriter(fd, budget)
+            try:
+                position = 0
+                while True:
+                    reserved = await budget.acquire(WRITE_SIZE)
+                    try:
+                        data = await asyncio.to_thread(stream.read, WRITE_SIZE)
+                    except BaseException:
+                        await budget.release(reserved)
+                        raise
+                    if not data:
+                        await budget.release(reserved)
+                        break
+                    writer.write(data, position, reserved)
+                    position += len(data)
+                instrument.count("bytes_inflated", position)
+            finally:
+                await writer.finish()
+                os.close(fd)
+        finally:
+            stream.close()
+    finally:
+        view.release()
+
+
+async def unpack_image(path, directory, budget, inflate, mtk=False, store=None):
+    prefix = os.path.join(directory, os.path.basename(path) + "-")
+    record = {"path": path, "directory": directory, "status": "ok", "sections": {}}
+    try:
+        with instrument.span("bulk_prepare", path=path):
+            file, mapped, image, sections = await asyncio.to_thread(prepare_image, path, prefix, mtk)
+    except (OSError, ValueError) as error:
+        return {**record, "status": "error", "error": str(error)}
+    try:
+        if store is not None:
+            # stored sections are hashed from the mapping and only written when the store lacks them
+            tasks = [asyncio.to_thread(store.write_section, file.fileno(), mapped, section, prefix + section.name)
+                     for section in sections]
+        else:
+            tasks = [copy_section(file, mapped, section, prefix + section.name, budget) for section in sections]
+        ramdisk_section = image.section("vendor_ramdisk" if image.is_vendor else "ramdisk")
+        if ramdisk_section:
+            header, ramdisk_section = bootimg.get_mtk_payload(mapped, ramdisk_section)
+        if inflate and ramdisk_section and ramdisk_section.size:
+            if ramdisk.get_compression(mapped[ramdisk_section.offset:ramdisk_section.offset + 6]) is not None:
+                tasks.append(inflate_ramdisk(mapped, ramdisk_section, prefix + "ramdisk.cpio", budget))
+        with instrument.span("bulk_sections", path=path):
+            # every writer has to finish before the mapping and the file are closed under it
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        record["sections"] = {section.name: section.size for section in sections}
+    except (OSError, ValueError) as error:
+        record = {**record, "status": "error", "error": str(error)}
+    finally:
+        mapped.close()
+        file.close()
+    return record
+
+
+async def bulk_unpack_async(paths, root, jobs=JOBS, memory=MEMORY_BUDGET, inflate=False, mtk=False, store=None):
+    # every read, inflate and write step is a worker-thread call, so the loop keeps jobs images moving at once
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=jobs * 4))
+    budget = MemoryBudget(memory)
+    limit = asyncio.Semaphore(jobs)
+
+    async def run(path, directory):
+        async with limit:
+            return await unpack_image(path, directory, budget, inflate, mtk, store)
+
+    tasks = [asyncio.create_task(run(path, directory))
+             for path, directory in zip(paths, get_output_directories(paths, root))]
+    for task in asyncio.as_completed(tasks):
+        yield await task
+
+
+def bulk_unpack(paths, root, jobs=JOBS, memory=MEMORY_BUDGET, inflate=False, report=None, mtk=False, store=None):
+    async def collect():
+        records = []
+        async for record in bulk_unpack_async(paths, root, jobs, memory, inflate, mtk, store):
+            if report:
+                report(record)
+            records.append(record)
+        return records
+
+    return asyncio.run(collect())
+
+
+def print_result(record):
+    if record["status"] == "error":
+        print("ERROR " + record["path"] + ": " + record["error"])
+    else:
+        print("OK " + record["path"] + " -> " + record["directory"])
+
+
+def main():
+    args = parse_arguments()
+    instrument.start_from_arguments(args)
+    if args.jobs < 1 or args.memory < 1:
+        print("-jobs and -memory must be positive")
+        quit()
+
+    try:
+        paths = list(find_images(args.i))
+        store = sectionstore.SectionStore(args.store) if args.store else None
+    except OSError as error:
+        print(error)
+        quit()
+    os.makedirs(args.o, exist_ok=True)
+    records = bulk_unpack(paths, args.o, args.jobs, args.memory, args.inflate,
+                          (lambda record: print(json.dumps(record), flush=True)) if args.json else print_result,
+                          args.mtk, store)
+    sys.exit(1 if any(record["status"] == "error" for record in records) else 0)
+
+
+if __name__ == '__main__':
+    main()
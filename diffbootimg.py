@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import mmap
+import sys
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+import bootimg
+from get_mkbootimg_settings import PackArgument, get_image_settings, section_arguments
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def usage():
+    return """diffbootimg.py
+        -a: previous boot image
+        -b: new boot image
+        -hashtype: digest used for the section reports (default sha256)
+        -json: print the result as one JSON object"""
+
+
+def parse_arguments():
+    parser = ArgumentParser(formatter_class=RawDescriptionHelpFormatter, epilog=usage())
+    parser.add_argument("-a", required=True)
+    parser.add_argument("-b", required=True)
+    parser.add_argument("-hashtype", required=False, default="sha256")
+    parser.add_argument("-json", required=False, default=False, action="store_true")
+    args = parser.parse_args()
+    return args
+
+
+class MappedImage:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        try:
+            self.mapped = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            self.file.close()
+            raise ValueError(path + " is empty or cannot be mapped.")
+        if hasattr(self.mapped, "madvise"):
+            # sections are walked front to back exactly once
+            self.mapped.madvise(mmap.MADV_SEQUENTIAL)
+        self.view = memoryview(self.mapped)
+        try:
+            self.image = bootimg.parse_image(self.mapped)
+        except ValueError:
+            self.close()
+            raise
+        for section in self.image.sections:
+            if section.offset + section.size > len(self.view):
+                self.close()
+                raise ValueError(section.name + " extends past the end of " + path + ".")
+
+    def close(self):
+        self.view.release()
+        self.mapped.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def get_header_fields(mapped):
+    # the same settings get_mkbootimg_settings.py turns into pack arguments; section placeholders are left to the
+    # section comparison
+    fields = {"magic": mapped.image.magic.decode(), "magic_offset": mapped.image.offset}
+    for argument, value in get_image_settings(mapped.image, mapped.mapped).items():
+        if argument in section_arguments:
+            continue
+        if argument == PackArgument.vendor_ramdisk_fragments:
+            value = [[ramdisk_type, name, board_id] for ramdisk_type, name, board_id, path in value]
+        fields[argument.name] = value
+    return fields
+
+
+def diff_fields(fields_a, fields_b):
+    changes = {}
+    for name in list(fields_a) + [name for name in fields_b if name not in fields_a]:
+        value_a = fields_a.get(name)
+        value_b = fields_b.get(name)
+        if value_a != value_b:
+            changes[name] = {"a": value_a, "b": value_b}
+    return changes
+
+
+def find_first_difference(data_a, data_b):
+    # narrows a differing chunk down page by page, then byte by byte inside the page
+    page = bootimg.BOOT_V3_PAGE_SIZE
+    length = min(len(data_a), len(data_b))
+    for start in range(0, length, page):
+        if data_a[start:start + page] != data_b[start:start + page]:
+            for position in range(start, min(start + page, length)):
+                if data_a[position] != data_b[position]:
+                    return position
+    return length
+
+
+def compare_section(view_a, section_a, view_b, section_b, hashtype):
+    # one streamed pass per side: every chunk is hashed, and compared until the first difference is known
+    hasher_a = hashlib.new(hashtype) if section_a else None
+    hasher_b = hashlib.new(hashtype) if section_b else None
+    size_a = section_a.size if section_a else 0
+    size_b = section_b.size if section_b else 0
+    first_difference = None
+    for start in range(0, max(size_a, size_b), CHUNK_SIZE):
+        data_a = bytes(view_a[section_a.offset + start:section_a.offset + min(start + CHUNK_SIZE, size_a)]) \
+            if start < size_a else b""
+        data_b = bytes(view_b[section_b.offset + start:section_b.offset + min(start + CHUNK_SIZE, size_b)]) \
+            if start < size_b else b""
+        if data_a:
+            hasher_a.update(data_a)
+        if data_b:
+            hasher_b.update(data_b)
+        if first_difference is None and data_a != data_b:
+            first_difference = start + find_first_difference(data_a, data_b)
+    return (hasher_a.hexdigest() if hasher_a else None, hasher_b.hexdigest() if hasher_b else None,
+            first_difference)
+
+
+def get_section_status(section_a, section_b, first_difference):
+    if not section_a or not section_a.size:
+        return "added" if section_b and section_b.size else "same"
+    if not section_b or not section_b.size:
+        return "removed"
+    return "same" if first_difference is None else "changed"
+
+
+def diff_sections(mapped_a, mapped_b, hashtype):
+    sections = {}
+    names = bootimg.get_section_names(mapped_a.image)
+    names += [name for name in bootimg.get_section_names(mapped_b.image) if name not in names]
+    for name in names:
+        section_a = mapped_a.image.section(name)
+        section_b = mapped_b.image.section(name)
+        if section_a is None and section_b is None:
+            continue
+        digest_a, digest_b, first_difference = compare_section(mapped_a.view, section_a, mapped_b.view, section_b,
+                                                               hashtype)
+        record = {"status": get_section_status(section_a, section_b, first_difference),
+                  "a": {"size": section_a.size, "digest": digest_a} if section_a else None,
+                  "b": {"size": section_b.size, "digest": digest_b} if section_b else None}
+        if record["status"] == "changed":
+            record["first_difference"] = first_difference
+            record["first_page"] = first_difference // mapped_a.image.page_size
+        sections[name] = record
+    return sections
+
+
+def diff(path_a, path_b, hashtype="sha256"):
+    with MappedImage(path_a) as mapped_a, MappedImage(path_b) as mapped_b:
+        header = diff_fields(get_header_fields(mapped_a), get_header_fields(mapped_b))
+        sections = diff_sections(mapped_a, mapped_b, hashtype)
+    identical = not header and all(section["status"] == "same" for section in sections.values())
+    return {"a": path_a, "b": path_b, "identical": identical, "header": header, "sections": sections}
+
+
+def print_result(record):
+    if record["identical"]:
+        print("SAME " + record["a"] + " " + record["b"])
+        return
+    print("DIFF " + record["a"] + " " + record["b"])
+    for name, change in record["header"].items():
+        print("    header %s: %s -> %s" % (name, json.dumps(change["a"]), json.dumps(change["b"])))
+    for name, section in record["sections"].items():
+        size_a = section["a"]["size"] if section["a"] else 0
+        size_b = section["b"]["size"] if section["b"] else 0
+        match section["status"]:
+            case "same":
+                continue
+            case "changed":
+                print("    %s changed: %d -> %d bytes, first difference at 0x%x (page %d)" %
+                      (name, size_a, size_b, section["first_difference"], section["first_page"]))
+            case status:
+                print("    %s %s: %d -> %d bytes" % (name, status, size_a, size_b))
+
+
+def main():
+    args = parse_arguments()
+    if args.hashtype not in hashlib.algorithms_available:
+        print("unknown hash algorithm '" + args.hashtype + "'")
+        quit()
+
+    try:
+        record = diff(args.a, args.b, args.hashtype)
+    except (OSError, ValueError) as error:
+        print(str(error))
+        quit()
+    if args.json:
+        print(json.dumps(record))
+    else:
+        print_result(record)
+    sys.exit(0 if record["identical"] else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+import struct
+
+import bootimg
+import instrument
+
+# Both layouts are big-endian on disk. A dtb section is one or more flattened device trees back to back; a
+# recovery_dtbo section (and a dtbo partition) is a DT table whose entries point at the overlays behind it.
+FDT_MAGIC = 0xd00dfeed
+DT_TABLE_MAGIC = 0xd7b7ab1e
+FDT_HEADER = struct.Struct(">10I")
+DT_TABLE_HEADER = struct.Struct(">8I")
+DT_TABLE_ENTRY = struct.Struct(">8I")
+
+FDT_BEGIN_NODE = 1
+FDT_END_NODE = 2
+FDT_PROP = 3
+FDT_NOP = 4
+FDT_END = 9
+
+ROOT_PROPERTIES = ("compatible", "model")
+
+
+class DtEntry:
+    __slots__ = ("index", "offset", "size", "dt_id", "rev", "custom", "compatible", "model")
+
+    def __init__(self, index, offset, size, dt_id=None, rev=None, custom=None):
+        self.index = index
+        self.offset = offset  # absolute, so the blob can be sliced straight out of the mapped image
+        self.size = size
+        self.dt_id = dt_id  # id, rev and custom only exist for DT table entries
+        self.rev = rev
+        self.custom = custom
+        self.compatible = []
+        self.model = None
+
+    def view(self, buf):
+        # nothing is read until the returned view is touched
+        if not isinstance(buf, bootimg.BUFFER_TYPES):
+            return buf[self.offset:self.offset + self.size]
+        return memoryview(buf)[self.offset:self.offset + self.size]
+
+    def to_record(self):
+        record = {"index": self.index, "offset": self.offset, "size": self.size, "compatible": self.compatible,
+                  "model": self.model}
+        if self.dt_id is not None:
+            record.update({"id": self.dt_id, "rev": self.rev, "custom": list(self.custom)})
+        return record
+
+
+def read_u32(buf, offset):
+    return struct.unpack(">I", bytes(buf[offset:offset + 4]))[0]
+
+
+def is_fdt(buf, offset=0):
+    return len(bytes(buf[offset:offset + 4])) == 4 and read_u32(buf, offset) == FDT_MAGIC
+
+
+def is_dt_table(buf, offset=0):
+    return len(bytes(buf[offset:offset + 4])) == 4 and read_u32(buf, offset) == DT_TABLE_MAGIC
+
+
+def read_root_properties(buf, offset, size):
+    # only the root node's own properties are decoded; they come before its first subnode in the structure block
+    if size < FDT_HEADER.size:
+        return {}
+    magic, totalsize, off_struct, off_strings, off_rsvmap, version, last_comp, boot_cpu, size_strings, \
+        size_struct = FDT_HEADER.unpack(bytes(buf[offset:offset + FDT_HEADER.size]))
+    if version < 17:
+        size_struct = totalsize - off_struct
+    if off_struct + size_struct > size or off_strings + size_strings > size:
+        return {}
+    block = bytes(buf[offset + off_struct:offset + off_struct + size_struct])
+    strings = bytes(buf[offset + off_strings:offset + off_strings + size_strings])
+    properties = {}
+    position = 0
+    depth = 0
+    while position + 4 <= len(block):
+        token = struct.unpack_from(">I", block, position)[0]
+        position += 4
+        if token == FDT_BEGIN_NODE:
+            if depth == 1:
+                break
+            depth += 1
+            position = (block.index(b"\0", position) + 4) & ~3
+        elif token == FDT_PROP:
+            length, name_offset = struct.unpack_from(">II", block, position)
+            position += 8
+            name = strings[name_offset:strings.index(b"\0", name_offset)].decode(errors="replace")
+            if depth == 1 and name in ROOT_PROPERTIES:
+                properties[name] = block[position:position + length]
+            position = (position + length + 3) & ~3
+        elif token in (FDT_END_NODE, FDT_END):
+            break
+        elif token != FDT_NOP:
+            break
+    return properties
+
+
+def describe(buf, entry):
+    try:
+        properties = read_root_properties(buf, entry.offset, entry.size)
+    except (ValueError, struct.error):
+        return entry
+    compatible = properties.get("compatible", b"")
+    entry.compatible = [value.decode(errors="replace") for value in compatible.split(b"\0") if value]
+    if "model" in properties:
+        entry.model = properties["model"].rstrip(b"\0").decode(errors="replace")
+    return entry
+
+
+def index_fdts(buf, offset, size):
+    # concatenated trees; each header's totalsize leads to the next one
+    entries = []
+    position = offset
+    while position + FDT_HEADER.size <= offset + size and is_fdt(buf, position):
+        totalsize = read_u32(buf, position + 4)
+        if totalsize < FDT_HEADER.size or position + totalsize > offset + size:
+            raise ValueError("device tree %d at 0x%x is truncated" % (len(entries), position - offset))
+        entries.append(describe(buf, DtEntry(len(entries), position, totalsize)))
+        position += totalsize
+    if not entries:
+        raise ValueError("no device tree found")
+    return entries
+
+
+def index_dt_table(buf, offset, size):
+    magic, total_size, header_size, entry_size, entry_count, entries_offset, page_size, version = \
+        DT_TABLE_HEADER.unpack(bytes(buf[offset:offset + DT_TABLE_HEADER.size]))
+    if entry_size < DT_TABLE_ENTRY.size or entries_offset + entry_count * entry_size > size or total_size > size:
+        raise ValueError("DT table header is malformed")
+    entries = []
+    for index in range(entry_count):
+        start = offset + entries_offset + index * entry_size
+        dt_size, dt_offset, dt_id, rev, *custom = DT_TABLE_ENTRY.unpack(bytes(buf[start:start + DT_TABLE_ENTRY.size]))
+        if dt_offset + dt_size > size:
+            raise ValueError("DT table entry %d extends past the table" % index)
+        entries.append(describe(buf, DtEntry(index, offset + dt_offset, dt_size, dt_id, rev, tuple(custom))))
+    return entries
+
+
+def index_dtb(buf, offset=0, size=None):
+    if size is None:
+        size = len(buf) - offset
+    with instrument.span("dtb_index", size=size):
+        if is_dt_table(buf, offset):
+            return index_dt_table(buf, offset, size)
+        return index_fdts(buf, offset, size)
+
+
+def find_entry(entries, key):
+    # key is an index or a compatible string
+    for entry in entries:
+        if str(entry.index) == str(key):
+            return entry
+    for entry in entries:
+        if key in entry.compatible:
+            return entry
+    raise ValueError("no device tree matches " + str(key))
+
+
+def replace_fdt(buf, offset, size, entry, data):
+    # the trees around the replaced one are sliced out as they are
+    return b"".join((bytes(buf[offset:entry.offset]), bytes(data),
+                     bytes(buf[entry.offset + entry.size:offset + size])))
+
+
+def replace_dt_table_entry(buf, offset, size, entries, entry, data):
+    # entries sharing one stored overlay keep sharing it; the replaced entry gets its data appended after the rest
+    magic, total_size, header_size, entry_size, entry_count, entries_offset, page_size, version = \
+        DT_TABLE_HEADER.unpack(bytes(buf[offset:offset + DT_TABLE_HEADER.size]))
+    blobs_start = min([item.offset - offset for item in entries] + [size])
+    head = bytearray(buf[offset:offset + blobs_start])
+    blobs = []
+    placed = {}
+    position = blobs_start
+    for item in entries:
+        if item is entry:
+            continue
+        key = (item.offset, item.size)
+        if key not in placed:
+            placed[key] = position
+            blobs.append(bytes(buf[item.offset:item.offset + item.size]))
+            position += item.size
+    new_offset = position
+    blobs.append(bytes(data))
+    position += len(data)
+    for item in entries:
+        start = entries_offset + item.index * entry_size
+        if item is entry:
+            struct.pack_into(">II", head, start, len(data), new_offset)
+        else:
+            struct.pack_into(">II", head, start, item.size, placed[(item.offset, item.size)])
+    struct.pack_into(">I", head, 4, position)
+    return bytes(head) + b"".join(blobs)
+
+
+def replace_entry(buf, offset, size, key, data):
+    # returns the whole section with one tree or overlay swapped; only that entry's bytes come from data
+    if not is_fdt(data):
+        raise ValueError("replacement is not a flattened device tree")
+    entries = index_dtb(buf, offset, size)
+    entry = find_entry(entries, key)
+    if is_dt_table(buf, offset):
+        return replace_dt_table_entry(buf, offset, size, entries, entry, data)
+    return replace_fdt(buf, offset, size, entry, data)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+import json
+import os
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+import bootimg
+import dtb
+import instrument
+import mkbootimg
+import sources
+from unmkbootimg import open_image
+
+DTB_SECTIONS = ("dtb", "recovery_dtbo", "dt")
+
+
+def usage():
+    return """dtbimg.py
+        -i: boot image, or a dtb or dtbo file on its own (<container>!<member> works as with unmkbootimg.py)
+        -section: dtb, recovery_dtbo or dt (default: every one the boot image has)
+        -extract: device tree (index or compatible string) to write into the output directory
+        -replace: device tree (index or compatible string) and the file to put in its place
+        -o: output directory for -extract, output image or blob for -replace
+        -json: print the index as one JSON object
+        Without -extract or -replace the device trees are listed with their offsets, sizes, ids and compatibles.""" + \
+        instrument.usage()
+
+
+def parse_arguments():
+    parser = ArgumentParser(formatter_class=RawDescriptionHelpFormatter, epilog=usage())
+    parser.add_argument("-i", required=True)
+    parser.add_argument("-section", required=False, default=None, choices=DTB_SECTIONS)
+    parser.add_argument("-extract", required=False, action="append", default=[])
+    parser.add_argument("-replace", required=False, nargs=2, default=None)
+    parser.add_argument("-o", required=False)
+    parser.add_argument("-json", required=False, default=False, action="store_true")
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    return args
+
+
+def get_dtb_sections(buf, view, name=None):
+    # a bare dtb or dtbo file is one section covering the whole file
+    if dtb.is_dt_table(view):
+        return None, [bootimg.Section(name or "recovery_dtbo", 0, len(view))]
+    if dtb.is_fdt(view):
+        return None, [bootimg.Section(name or "dtb", 0, len(view))]
+    image = bootimg.parse_image(buf)
+    sections = [section for section in image.sections
+                if section.name in DTB_SECTIONS and section.size and (name is None or section.name == name)]
+    for section in sections:
+        if section.offset + section.size > len(view):
+            raise ValueError(section.name + " extends past the end of the image.")
+    if not sections:
+        raise ValueError("image has no " + (name or "device tree") + " section")
+    return image, sections
+
+
+def index_image(path, name=None):
+    with open_image(path) as (fd, buf, view):
+        image, sections = get_dtb_sections(buf, view, name)
+        return {section.name: [entry.to_record() for entry in dtb.index_dtb(view, section.offset, section.size)]
+                for section in sections}
+
+
+def print_index(index):
+    for name, entries in index.items():
+        print(name + ":")
+        for entry in entries:
+            ids = " id 0x%08x rev 0x%08x" % (entry["id"], entry["rev"]) if "id" in entry else ""
+            print("    %3d 0x%08x %8d%s %s" % (entry["index"], entry["offset"], entry["size"], ids,
+                                             " ".join(entry["compatible"]) or entry["model"] or "-"))
+
+
+def extract(path, directory, keys, name=None):
+    with open_image(path) as (fd, buf, view):
+        image, sections = get_dtb_sections(buf, view, name)
+        indexes = [(section, dtb.index_dtb(view, section.offset, section.size)) for section in sections]
+        for key in keys:
+            # a key only has to match in one of the sections searched
+            found = []
+            for section, entries in indexes:
+                try:
+                    found.append((section, dtb.find_entry(entries, key)))
+                except ValueError:
+                    continue
+            if not found:
+                raise ValueError("no device tree matches " + str(key))
+            for section, entry in found:
+                target = os.path.join(directory, "%s-%s.%02d.dtb" % (sources.get_image_name(path), section.name,
+                                                                      entry.index))
+                blob = entry.view(view)
+                try:
+                    with open(target, "wb") as output:
+                        output.write(blob)
+                finally:
+                    if isinstance(blob, memoryview):
+                        blob.release()
+                print(target)
+
+
+def replace(path, output, key, replacement, name=None):
+    with open(replacement, "rb") as file:
+        data = file.read()
+    with open_image(path) as (fd, buf, view):
+        image, sections = get_dtb_sections(buf, view, name)
+        if len(sections) > 1:
+            raise ValueError("image has several device tree sections; pick one with -section")
+        section = sections[0]
+        blob = dtb.replace_entry(view, section.offset, section.size, key, data)
+        # open_image hands out no fd for containers and sparse images
+        sourced = fd is None
+    if image is None:
+        with open(output, "wb") as file:
+            file.write(blob)
+        return None
+    # the section is rebuilt in memory and everything else in the image is reused by the incremental repack
+    if sourced:
+        raise ValueError("device trees can only be replaced in plain image files")
+    return mkbootimg.repack(path, output, {section.name: blob})
+
+
+def main():
+    args = parse_arguments()
+    instrument.start_from_arguments(args)
+
+    if not os.path.isfile(args.i) and not sources.needs_source(args.i):
+        print(args.i + " is not a file.")
+        quit()
+
+    try:
+        if args.extract:
+            if args.o is None or not os.path.isdir(args.o):
+                print(str(args.o) + " is not a directory.")
+                quit()
+            extract(args.i, args.o, args.extract, args.section)
+        elif args.replace:
+            if args.o is None:
+                print("-replace needs -o")
+                quit()
+            replace(args.i, args.o, args.replace[0], args.replace[1], args.section)
+        else:
+            index = index_image(args.i, args.section)
+            if args.json:
+                print(json.dumps(index))
+            else:
+                print_index(index)
+    except (OSError, ValueError) as error:
+        print(error)
+        quit()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,26 @@
 #!/usr/bin/env python3
+import json
+import mmap
 import os.path
+import re
+import shlex
+import signal
+import socketserver
+import sys
+import threading
 from argparse import (ArgumentParser, ArgumentTypeError,
                       FileType, RawDescriptionHelpFormatter)
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
 from enum import IntEnum
+from functools import lru_cache, partial
 
-convert_hex = False
-unmk_path = ""
+import bootimg
+import instrument
+import mkbootimg
+import sectionstore
+import sources
+from headercache import CACHE_SIZE, HeaderCache
 
 
 class UnpackMethod(IntEnum):
@@ -13,6 +28,7 @@ class UnpackMethod(IntEnum):
     unmkbootimg = 1
     unpackbootimg = 2
     unpack_bootimg = 3
+    image = 4
 
 
 class PackArgument(IntEnum):
@@ -35,328 +51,528 @@ class PackArgument(IntEnum):
     name = 17
     extra_cmdline = 18
     recovery_dtbo = 19
-
-
-class CommandPacket:
-    def __init__(self, command, commandlist, method, alerts):
-        self.command = command
-        self.commandlist = commandlist
-        self.method = method
-        self.alerts = alerts
-
-
-def convert_to_decimal(string):
-    returnvalue = ""
-    global convert_hex
-    if convert_hex:
-        returnvalue = str(int(string, 16))
-    else:
-        returnvalue = string
-    return returnvalue
+    vendor_ramdisk = 20
+    vendor_cmdline = 21
+    vendor_ramdisk_fragments = 22
+    vendor_bootconfig = 23
+    dt = 24
+    mtk_kernel = 25
+    mtk_ramdisk = 26
 
 
 pack_cmd_dict = {PackArgument.kernel: "--kernel", PackArgument.dtb: "--dtb", PackArgument.ramdisk: "--ramdisk",
-                 PackArgument.base: "--base", PackArgument.name: "--id", PackArgument.cmdline: "--cmdline",
+                 PackArgument.base: "--base", PackArgument.name: "--board", PackArgument.cmdline: "--cmdline",
                  PackArgument.dtb_offset: "--dtb_offset", PackArgument.hash_type: "--hashtype",
                  PackArgument.header_version: "--header_version",
                  PackArgument.kernel_offset: "--kernel_offset", PackArgument.os_patch_level: "--os_patch_level",
                  PackArgument.os_version: "--os_version", PackArgument.pagesize: "--pagesize",
                  PackArgument.ramdisk_offset: "--ramdisk_offset", PackArgument.recovery_dtbo: "--recovery_dtbo",
-                 PackArgument.second_offset: "--second_offset", PackArgument.tags_offset: "--tags_offset"}
+                 PackArgument.second_offset: "--second_offset", PackArgument.tags_offset: "--tags_offset",
+                 PackArgument.second: "--second", PackArgument.vendor_ramdisk: "--vendor_ramdisk",
+                 PackArgument.vendor_cmdline: "--vendor_cmdline",
+                 PackArgument.vendor_ramdisk_fragments: "--vendor_ramdisk_fragment",
+                 PackArgument.vendor_bootconfig: "--vendor_bootconfig", PackArgument.dt: "--dt",
+                 PackArgument.mtk_kernel: "--mtk_kernel", PackArgument.mtk_ramdisk: "--mtk_ramdisk"}
+
+
+offset_arguments = {PackArgument.base, PackArgument.kernel_offset, PackArgument.ramdisk_offset,
+                    PackArgument.second_offset, PackArgument.tags_offset, PackArgument.dtb_offset}
+
+integer_arguments = {PackArgument.pagesize, PackArgument.header_version}
+
+# mkbootimg.py option names where they differ from the PackArgument name
+pack_option_names = {PackArgument.name: "board", PackArgument.hash_type: "hashtype",
+                     PackArgument.vendor_ramdisk_fragments: "vendor_ramdisk_fragments"}
+
+alert_names = {PackArgument.dtb: "dtb", PackArgument.vendor_ramdisk_fragments: "vendor_ramdisk_fragment",
+               PackArgument.vendor_bootconfig: "bootconfig"}
+
+placeholder_settings = {PackArgument.kernel: "<kernel>", PackArgument.ramdisk: "<ramdisk>"}
+
+
+def last_token(value):
+    return value.split(" ")[-1].strip()
+
+
+def quoted_value(value):
+    return value.split("\"")[-2]
+
+
+def mkbootimg_base(value):
+    return value.split("base")[1].split(" ")[1]
+
+
+def settings_format(table, separator):
+    # line prefix -> (argument, value extractor); the separator regex splits the prefix from the value
+    prefixes = sorted(table, key=len, reverse=True)
+    pattern = re.compile("^(" + "|".join(map(re.escape, prefixes)) + ")" + separator + "(.*)$", re.MULTILINE)
+    return table, pattern
+
+
+unpackbootimg_settings = settings_format({
+    "BOARD_KERNEL_CMDLINE": (PackArgument.cmdline, str.strip),
+    "BOARD_VENDOR_CMDLINE": (PackArgument.vendor_cmdline, str.strip),
+    "BOARD_KERNEL_BASE": (PackArgument.base, str.strip),
+    "BOARD_VENDOR_BASE": (PackArgument.base, str.strip),
+    "BOARD_NAME": (PackArgument.name, str.strip),
+    "BOARD_PAGE_SIZE": (PackArgument.pagesize, str.strip),
+    "BOARD_HASH_TYPE": (PackArgument.hash_type, str.strip),
+    "BOARD_KERNEL_OFFSET": (PackArgument.kernel_offset, str.strip),
+    "BOARD_RAMDISK_OFFSET": (PackArgument.ramdisk_offset, str.strip),
+    "BOARD_SECOND_OFFSET": (PackArgument.second_offset, str.strip),
+    "BOARD_TAGS_OFFSET": (PackArgument.tags_offset, str.strip),
+    "BOARD_OS_VERSION": (PackArgument.os_version, str.strip),
+    "BOARD_OS_PATCH_LEVEL": (PackArgument.os_patch_level, str.strip),
+    "BOARD_HEADER_VERSION": (PackArgument.header_version, str.strip),
+    "BOARD_DTB_OFFSET": (PackArgument.dtb_offset, str.strip),
+    "BOARD_DTB_SIZE": (PackArgument.dtb, str.strip),
+    "BOARD_BOOTCONFIG_SIZE": (PackArgument.vendor_bootconfig, str.strip),
+    "BOARD_KERNEL_MTK_NAME": (PackArgument.mtk_kernel, str.strip),
+    "BOARD_RAMDISK_MTK_NAME": (PackArgument.mtk_ramdisk, str.strip)
+}, " ")
+
+unpack_bootimg_settings = settings_format({
+    "kernel load address": (PackArgument.kernel_offset, str.strip),
+    "ramdisk load address": (PackArgument.ramdisk_offset, str.strip),
+    "second bootloader load address": (PackArgument.second_offset, str.strip),
+    "kernel tags load address": (PackArgument.tags_offset, str.strip),
+    "page size": (PackArgument.pagesize, str.strip),
+    "os version": (PackArgument.os_version, str.strip),
+    "os patch level": (PackArgument.os_patch_level, str.strip),
+    "boot image": (PackArgument.header_version, str.strip),
+    "product": (PackArgument.name, str.strip),
+    "command": (PackArgument.cmdline, str.strip),
+    "dtb address": (PackArgument.dtb_offset, str.strip),
+    "dtb size": (PackArgument.dtb, str.strip),
+    "vendor boot image header version": (PackArgument.header_version, str.strip),
+    "vendor command line args": (PackArgument.vendor_cmdline, str.strip),
+    "vendor bootconfig size": (PackArgument.vendor_bootconfig, str.strip)
+}, "[^:]*:")
+
+unpackbootimg_fragment_pattern = re.compile(
+    r"^BOARD_VENDOR_RAMDISK_FRAGMENT (\d+) (\S+) (\S+) \d+ (\S+)$", re.MULTILINE)
+
+unpack_bootimg_fragment_pattern = re.compile(
+    r"^ +(\S+): \{\n +size: \d+\n +offset: \d+\n +type: (\S+)\n +name: ?([^\n]*)\n +board_id: \[\n(.*?)\]",
+    re.MULTILINE | re.DOTALL)
+
+unmkbootimg_offset_settings = settings_format({
+    "OFF_KERNEL_ADDR": (PackArgument.kernel_offset, last_token),
+    "OFF_RAMDISK_ADDR": (PackArgument.ramdisk_offset, last_token),
+    "OFF_SECOND_ADDR": (PackArgument.second_offset, last_token),
+    "  mkbootimg": (PackArgument.base, mkbootimg_base)
+}, "")
+
+unmkbootimg_settings = settings_format({
+    "Kernel address": (PackArgument.kernel_offset, last_token),
+    "Ramdisk address": (PackArgument.ramdisk_offset, last_token),
+    "Secondary address": (PackArgument.second_offset, last_token),
+    "Kernel tags address": (PackArgument.tags_offset, last_token),
+    "Flash page size": (PackArgument.pagesize, last_token),
+    "Board name": (PackArgument.name, quoted_value),
+    "Command line": (PackArgument.cmdline, quoted_value),
+    **unmkbootimg_offset_settings[0]
+}, "")
+
+
+def read_settings(path, settings_type):
+    settings = {}
+    table, pattern = settings_type
+    with open(path) as file:
+        for match in pattern.finditer(file.read()):
+            argument, extract = table[match.group(1)]
+            settings[argument] = extract(match.group(2))
+    return settings
+
+
+def is_placeholder(value):
+    return isinstance(value, str) and value.startswith("<") and value.endswith(">")
+
+
+def get_typed_value(argument, value):
+    # values keep their type from here on; anything that does not convert is passed through as found
+    try:
+        if argument in offset_arguments and isinstance(value, str):
+            return int(value, 16)
+        if argument in integer_arguments and isinstance(value, str):
+            return int(value)
+    except ValueError:
+        return value
+    if argument == PackArgument.vendor_ramdisk_fragments:
+        return tuple((ramdisk_type, name, tuple(board_id), path) for ramdisk_type, name, board_id, path in value)
+    return value
+
+
+def get_commands_from_settings(settings):
+    return {argument: get_typed_value(argument, value) for argument, value in settings.items()}
+
+
+def get_fragment_tokens(fragments):
+    # every fragment is preceded by the options describing it, so one argument carries the whole table
+    tokens = []
+    for ramdisk_type, name, board_id, path in fragments:
+        tokens += ["--ramdisk_type", ramdisk_type.lower()]
+        if name:
+            tokens += ["--ramdisk_name", name]
+        for index, value in enumerate(board_id):
+            if value:
+                tokens += ["--board_id%d" % index, "0x%08x" % value]
+        tokens += [pack_cmd_dict[PackArgument.vendor_ramdisk_fragments], path]
+    return tokens
+
+
+def get_argument_tokens(argument, value, decimal=False):
+    if argument == PackArgument.vendor_ramdisk_fragments:
+        return get_fragment_tokens(value)
+    if argument in offset_arguments and isinstance(value, int):
+        value = ("%d" if decimal else "0x%08x") % value
+    return [pack_cmd_dict[argument], str(value)]
+
+
+def get_fragment_options(fragments):
+    return [{"path": path, "name": name, "type": mkbootimg.parse_ramdisk_type(ramdisk_type),
+             "board_id": list(board_id) + [0] * (bootimg.VENDOR_RAMDISK_TABLE_ENTRY_BOARD_ID_SIZE - len(board_id))}
+            for ramdisk_type, name, board_id, path in fragments]
+
+
+def get_pack_option(argument, value):
+    match argument:
+        case PackArgument.os_version:
+            return mkbootimg.parse_os_version(value)
+        case PackArgument.os_patch_level:
+            return mkbootimg.parse_os_patch_level(value)
+        case PackArgument.vendor_ramdisk_fragments:
+            return get_fragment_options(value)
+    return value
+
+
+@dataclass(slots=True)
+class CommandPacket:
+    # holds typed values only; argv, shell text, JSON and alerts are rendered from them on demand
+    values: dict
+    method: UnpackMethod
+    convert_hex: bool = False
+    output: str = "new.img"
+
+    @property
+    def program(self):
+        # MediaTek headers, ramdisk fragments and bootconfig are mkbootimg.py only
+        if self.convert_hex or any(argument in self.values for argument in mkbootimg_py_arguments):
+            return "mkbootimg.py"
+        return "mkbootimg"
+
+    @property
+    def decimal(self):
+        # decimal offsets are for AOSP's mkbootimg.py; MediaTek headers need this repo's, which reads them as hex
+        return self.convert_hex and not any(argument in self.values for argument in mtk_arguments)
+
+    def argv(self, output=None):
+        argv = [self.program]
+        for argument in sorted(self.values):
+            argv += get_argument_tokens(argument, self.values[argument], self.decimal)
+        return argv + ["-o", output or self.output]
+
+    def shell(self, output=None):
+        return shlex.join(self.argv(output))
+
+    @property
+    def command(self):
+        return {argument: shlex.join(get_argument_tokens(argument, value, self.decimal))
+                for argument, value in self.values.items()}
+
+    @property
+    def commandlist(self):
+        return self.shell()
+
+    def get_alerts(self):
+        alerts = []
+        for argument in sorted(self.values):
+            value = self.values[argument]
+            if argument == PackArgument.vendor_ramdisk_fragments:
+                value = next((path for ramdisk_type, name, board_id, path in value if is_placeholder(path)), None)
+            if is_placeholder(value):
+                alerts.append(alert_names.get(argument, argument.name) + " need to be manually configured!!!")
+        return alerts
+
+    @property
+    def alerts(self):
+        return "\n" + "".join(alert + "\n" for alert in self.get_alerts())
+
+    def to_record(self):
+        values = {}
+        for argument, value in self.values.items():
+            if argument == PackArgument.vendor_ramdisk_fragments:
+                value = [{"type": ramdisk_type, "name": name, "board_id": list(board_id), "path": path}
+                         for ramdisk_type, name, board_id, path in value]
+            values[argument.name] = value
+        argv = self.argv()
+        return {"method": self.method.name, "command": shlex.join(argv), "argv": argv, "values": values,
+                "alerts": self.get_alerts()}
+
+    def to_json(self):
+        return json.dumps(self.to_record())
+
+    def get_pack_arguments(self):
+        return {pack_option_names.get(argument, pack_cmd_dict[argument][2:]): get_pack_option(argument, value)
+                for argument, value in self.values.items()}
+
+    def pack(self, output=None, directory=".", inputs=None):
+        # straight into mkbootimg.pack; section paths are resolved against the unpack directory
+        return mkbootimg.pack_arguments(self.get_pack_arguments(), output or self.output, directory, inputs)
+
+
+def get_bootconfig_settings(settings):
+    # settings only report the bootconfig size; the file itself is supplied like any other section
+    if int(settings.pop(PackArgument.vendor_bootconfig, "0"), 0):
+        settings[PackArgument.vendor_bootconfig] = "<bootconfig>"
+    return settings
+
+
+def get_fragment_settings(settings, fragments):
+    # a table holding more than the plain vendor ramdisk is rebuilt fragment by fragment
+    if len(fragments) > 1 or any(name or ramdisk_type.lower() != "platform"
+                                 for ramdisk_type, name, board_id, path in fragments):
+        settings.pop(PackArgument.vendor_ramdisk, None)
+        settings[PackArgument.vendor_ramdisk_fragments] = fragments
+    return settings
+
+
+def read_unpackbootimg_fragments(path):
+    with open(path) as file:
+        return parse_unpackbootimg_fragments(file.read())
+
+
+def parse_unpackbootimg_fragments(text, prefix=None):
+    # with a prefix the fragments point at the files unmkbootimg.py unpacked them to, else at placeholders
+    matches = unpackbootimg_fragment_pattern.findall(text)
+    return [(ramdisk_type, "" if name == "-" else name, [int(value, 16) for value in board_id.split(",")],
+             ("%s%s" if prefix is not None else "<%s%s>") % (
+                 prefix or "", "vendor_ramdisk." + ("%02d" % int(index) if name == "-" else name)))
+            for index, ramdisk_type, name, board_id in matches]
+
+
+def read_unpack_bootimg_fragments(path):
+    with open(path) as file:
+        matches = unpack_bootimg_fragment_pattern.findall(file.read())
+    return [(ramdisk_type, name.strip(), [int(value, 16) for value in re.findall("0x[0-9a-fA-F]+", board_id)],
+             "<" + output + ">")
+            for output, ramdisk_type, name, board_id in matches]
 
 
 def get_unpackbootimg_commands_from_settings(path):
-    commands = {}
-    line_size = 0
-    line_fragments = ""
-    for line in open(path).read().split("\n"):
-        if line.startswith("BOARD_KERNEL_CMDLINE"):
-            line_fragments = line.split("BOARD_KERNEL_CMDLINE")
-            line_size = len(line_fragments)
-            commands[PackArgument.cmdline] = pack_cmd_dict.get(
-                PackArgument.cmdline) + " \"" + line_fragments[line_size - 1].strip() + "\""
-        if line.startswith("BOARD_KERNEL_BASE"):
-            line_fragments = line.split(" ")
-            line_size = len(line_fragments)
-            commands[PackArgument.base] = pack_cmd_dict.get(PackArgument.base) + " " + convert_to_decimal(
-                line_fragments[line_size - 1].strip())
-        if line.startswith("BOARD_NAME"):
-            line_fragments = line.split("BOARD_NAME")
-            line_size = len(line_fragments)
-            commands[PackArgument.name] = pack_cmd_dict.get(
-                PackArgument.name) + " " + line_fragments[line_size - 1].strip()
-        if line.startswith("BOARD_PAGE_SIZE"):
-            line_fragments = line.split(" ")
-            line_size = len(line_fragments)
-            commands[PackArgument.pagesize] = pack_cmd_dict.get(
-                PackArgument.pagesize) + " " + line_fragments[line_size - 1].strip()
-        if line.startswith("BOARD_KERNEL_OFFSET"):
-            line_fragments = line.split(" ")
-            line_size = len(line_fragments)
-            commands[PackArgument.kernel_offset] = pack_cmd_dict.get(
-                PackArgument.kernel_offset) + " " + convert_to_decimal(
-                line_fragments[line_size - 1].strip())
-        if line.startswith("BOARD_RAMDISK_OFFSET"):
-            line_fragments = line.split(" ")
-            line_size = len(line_fragments)
-            commands[PackArgument.ramdisk_offset] = pack_cmd_dict.get(
-                PackArgument.ramdisk_offset) + " " + convert_to_decimal(
-                line_fragments[line_size - 1].strip())
-        if line.startswith("BOARD_SECOND_OFFSET"):
-            line_fragments = line.split(" ")
-            line_size = len(line_fragments)
-            commands[PackArgument.second_offset] = pack_cmd_dict.get(
-                PackArgument.second_offset) + " " + convert_to_decimal(
-                line_fragments[line_size - 1].strip())
-        if line.startswith("BOARD_TAGS_OFFSET"):
-            line_fragments = line.split(" ")
-            line_size = len(line_fragments)
-            commands[PackArgument.tags_offset] = pack_cmd_dict.get(
-                PackArgument.tags_offset) + " " + convert_to_decimal(
-                line_fragments[line_size - 1].strip())
-        if line.startswith("BOARD_OS_VERSION"):
-            line_fragments = line.split(" ")
-            line_size = len(line_fragments)
-            commands[PackArgument.os_version] = pack_cmd_dict.get(
-                PackArgument.os_version) + " " + line_fragments[line_size - 1].strip()
-        if line.startswith("BOARD_OS_PATCH_LEVEL"):
-            line_fragments = line.split(" ")
-            line_size = len(line_fragments)
-            commands[PackArgument.os_patch_level] = pack_cmd_dict.get(
-                PackArgument.os_patch_level) + " " + line_fragments[line_size - 1].strip()
-        if line.startswith("BOARD_HEADER_VERSION"):
-            line_fragments = line.split(" ")
-            line_size = len(line_fragments)
-            commands[PackArgument.header_version] = pack_cmd_dict.get(
-                PackArgument.header_version) + " " + line_fragments[line_size - 1].strip()
-        if line.startswith("BOARD_DTB_OFFSET"):
-            line_fragments = line.split(" ")
-            line_size = len(line_fragments)
-            commands[PackArgument.dtb_offset] = pack_cmd_dict.get(
-                PackArgument.dtb_offset) + " " + convert_to_decimal(
-                line_fragments[line_size - 1].strip())
-    commands[PackArgument.dtb] = pack_cmd_dict.get(PackArgument.dtb) + " <dtb.dtb>"
-    commands[PackArgument.kernel] = pack_cmd_dict.get(PackArgument.kernel) + " <kernel>"
-    commands[PackArgument.ramdisk] = pack_cmd_dict.get(PackArgument.ramdisk) + " <ramdisk>"
-
-    global unmk_path
-    commands = get_unmkbootimg_commands_from_settings_offsets(unmk_path, commands)
-
-    return commands
+    settings = read_settings(path, unpackbootimg_settings)
+    if PackArgument.vendor_cmdline in settings:
+        settings[PackArgument.vendor_ramdisk] = "<vendor_ramdisk>"
+        settings.setdefault(PackArgument.dtb, "<dtb.dtb>")
+        settings = get_bootconfig_settings(get_fragment_settings(settings, read_unpackbootimg_fragments(path)))
+        return get_commands_from_settings(settings)
+    return get_commands_from_settings({**settings, **placeholder_settings})
 
 
 def get_unpack_bootimg_commands_from_settings(path):
-    commands = {}
-    line_size = 0
-    line_fragments = ""
-    for line in open(path).read().split("\n"):
-        if line.startswith("kernel load address"):
-            line_fragments = line.split(":")
-            line_size = len(line_fragments)
-            commands[PackArgument.kernel_offset] = pack_cmd_dict.get(
-                PackArgument.kernel_offset) + " " + convert_to_decimal(
-                line_fragments[line_size - 1].strip())
-        if line.startswith("ramdisk load address"):
-            line_fragments = line.split(":")
-            line_size = len(line_fragments)
-            commands[PackArgument.ramdisk_offset] = pack_cmd_dict.get(
-                PackArgument.ramdisk_offset) + " " + convert_to_decimal(
-                line_fragments[line_size - 1].strip())
-        if line.startswith("second bootloader load address"):
-            line_fragments = line.split(":")
-            line_size = len(line_fragments)
-            commands[PackArgument.second_offset] = pack_cmd_dict.get(
-                PackArgument.second_offset) + " " + convert_to_decimal(
-                line_fragments[line_size - 1].strip())
-        if line.startswith("kernel tags load address"):
-            line_fragments = line.split(":")
-            line_size = len(line_fragments)
-            commands[PackArgument.tags_offset] = pack_cmd_dict.get(
-                PackArgument.tags_offset) + " " + convert_to_decimal(
-                line_fragments[line_size - 1].strip())
-        if line.startswith("page size"):
-            line_fragments = line.split(":")
-            line_size = len(line_fragments)
-            commands[PackArgument.pagesize] = pack_cmd_dict.get(PackArgument.pagesize) + " " + line_fragments[line_size - 1].strip()
-        if line.startswith("os version"):
-            line_fragments = line.split(":")
-            line_size = len(line_fragments)
-            commands[PackArgument.os_version] = pack_cmd_dict.get(
-                PackArgument.os_version) + " " + "\"" + line_fragments[line_size - 1].strip() + "\""
-        if line.startswith("os patch level"):
-            line_fragments = line.split(":")
-            line_size = len(line_fragments)
-            commands[PackArgument.os_patch_level] = pack_cmd_dict.get(PackArgument.os_patch_level) + " " + \
-                "\"" + line_fragments[line_size - 1].strip() + "\""
-        if line.startswith("boot image"):
-            line_fragments = line.split(":")
-            line_size = len(line_fragments)
-            commands[PackArgument.header_version] = pack_cmd_dict.get(PackArgument.header_version) + " " + \
-                line_fragments[line_size - 1].strip()
-        if line.startswith("product"):
-            line_fragments = line.split(":")
-            line_size = len(line_fragments)
-            commands[PackArgument.name] = pack_cmd_dict.get(PackArgument.name) + " " + line_fragments[
-                line_size - 1].strip()
-        if line.startswith("command"):
-            line_fragments = line.split(":")
-            line_size = len(line_fragments)
-            commands[PackArgument.cmdline] = pack_cmd_dict.get(PackArgument.cmdline) + " " + "\"" + line_fragments[
-                line_size - 1].strip() + "\""
-        if line.startswith("dtb address"):
-            line_fragments = line.split(":")
-            line_size = len(line_fragments)
-            commands[PackArgument.dtb_offset] = pack_cmd_dict.get(PackArgument.dtb_offset) + " " + convert_to_decimal(
-                line_fragments[line_size - 1].strip())
-
-        commands[PackArgument.dtb] = pack_cmd_dict.get(PackArgument.dtb) + " <dtb.dtb>"
-        commands[PackArgument.kernel] = pack_cmd_dict.get(PackArgument.kernel) + " <kernel>"
-        commands[PackArgument.ramdisk] = pack_cmd_dict.get(PackArgument.ramdisk) + " <ramdisk>"
-
-        global unmk_path
-        commands = get_unmkbootimg_commands_from_settings_offsets(unmk_path, commands)
-    return commands
-
-
-def get_unmkbootimg_commands_from_settings_offsets(path, commands):
-    line_size = 0
-    line_fragments = ""
-    for line in open(path).read().split("\n"):
-        if line.startswith("OFF_KERNEL_ADDR"):
-            line_fragments = line.split(" ")
-            line_size = len(line_fragments)
-            commands[PackArgument.kernel_offset] = pack_cmd_dict.get(PackArgument.kernel_offset) + " " + \
-                convert_to_decimal(line_fragments[line_size - 1])
-        if line.startswith("OFF_RAMDISK_ADDR"):
-            line_fragments = line.split(" ")
-            line_size = len(line_fragments)
-            commands[PackArgument.ramdisk_offset] = pack_cmd_dict.get(PackArgument.ramdisk_offset) + " " + \
-                convert_to_decimal(line_fragments[line_size - 1])
-        if line.startswith("OFF_SECOND_ADDR"):
-            line_fragments = line.split(" ")
-            line_size = len(line_fragments)
-            commands[PackArgument.second_offset] = pack_cmd_dict.get(PackArgument.second_offset) + " " + \
-                convert_to_decimal(line_fragments[line_size - 1])
-        if line.startswith("  mkbootimg"):
-            line_fragments = line.split("base")[1].split(" ")[1]
-            commands[PackArgument.base] = pack_cmd_dict.get(PackArgument.base) + " " + convert_to_decimal(line_fragments)
-
-    return commands
+    settings = read_settings(path, unpack_bootimg_settings)
+    if PackArgument.vendor_cmdline in settings:
+        settings.pop(PackArgument.cmdline, None)
+        settings[PackArgument.vendor_ramdisk] = "<vendor_ramdisk>"
+        settings.setdefault(PackArgument.dtb, "<dtb.dtb>")
+        settings = get_bootconfig_settings(get_fragment_settings(settings, read_unpack_bootimg_fragments(path)))
+        return get_commands_from_settings(settings)
+    return get_commands_from_settings({**settings, **placeholder_settings})
 
 
 def get_unmkbootimg_commands_from_settings(path):
+    return get_commands_from_settings({**read_settings(path, unmkbootimg_settings), **placeholder_settings})
+
+
+def get_image_settings(image, buf=None):
+    header = image.header
+    settings = {}
+
+    if image.is_vendor:
+        base = bootimg.get_base(header)
+        settings[PackArgument.vendor_cmdline] = bootimg.get_cmdline(header)
+        settings[PackArgument.name] = header.name.decode(errors="replace")
+        settings[PackArgument.pagesize] = "%d" % header.page_size
+        settings[PackArgument.base] = "0x%08x" % base
+        settings[PackArgument.kernel_offset] = "0x%08x" % ((header.kernel_addr - base) & 0xffffffff)
+        settings[PackArgument.ramdisk_offset] = "0x%08x" % ((header.ramdisk_addr - base) & 0xffffffff)
+        settings[PackArgument.tags_offset] = "0x%08x" % ((header.tags_addr - base) & 0xffffffff)
+        settings[PackArgument.dtb_offset] = "0x%08x" % ((header.dtb_addr - base) & 0xffffffffffffffff)
+        settings[PackArgument.header_version] = "%d" % header.header_version
+        settings[PackArgument.vendor_ramdisk] = "<vendor_ramdisk>"
+        settings[PackArgument.dtb] = "%d" % header.dtb_size
+        if header.header_version > 3:
+            if header.bootconfig_size:
+                settings[PackArgument.vendor_bootconfig] = "<bootconfig>"
+            if buf is not None and header.vendor_ramdisk_table_entry_num:
+                fragments = [(fragment.type_name, fragment.name, list(fragment.board_id),
+                              "<vendor_ramdisk.%s>" % (fragment.name or "%02d" % fragment.index))
+                             for fragment in bootimg.get_ramdisk_fragments(buf, image)]
+                get_fragment_settings(settings, fragments)
+        return settings
+
+    os_version, os_patch_level = bootimg.decode_os_version(header.os_version)
+    if os_version:
+        settings[PackArgument.os_version] = os_version
+        settings[PackArgument.os_patch_level] = os_patch_level
+    settings[PackArgument.cmdline] = bootimg.get_cmdline(header)
+    settings[PackArgument.kernel] = "<kernel>"
+    settings[PackArgument.ramdisk] = "<ramdisk>"
+
+    if isinstance(header, bootimg.BootImgHdrV3):
+        settings[PackArgument.header_version] = "%d" % header.header_version
+        return settings
+
+    base = bootimg.get_base(header)
+    settings[PackArgument.base] = "0x%08x" % base
+    settings[PackArgument.name] = header.name.decode(errors="replace")
+    settings[PackArgument.pagesize] = "%d" % header.page_size
+    settings[PackArgument.hash_type] = bootimg.get_hash_type(header)
+    settings[PackArgument.kernel_offset] = "0x%08x" % ((header.kernel_addr - base) & 0xffffffff)
+    settings[PackArgument.ramdisk_offset] = "0x%08x" % ((header.ramdisk_addr - base) & 0xffffffff)
+    settings[PackArgument.second_offset] = "0x%08x" % ((header.second_addr - base) & 0xffffffff)
+    settings[PackArgument.tags_offset] = "0x%08x" % ((header.tags_addr - base) & 0xffffffff)
+    if header.second_size:
+        settings[PackArgument.second] = "<second>"
+    if not image.is_legacy_dt:
+        settings[PackArgument.header_version] = "%d" % header.header_version
+        if header.header_version > 0 and header.recovery_dtbo_size:
+            settings[PackArgument.recovery_dtbo] = "<recovery_dtbo>"
+        if header.header_version > 1:
+            settings[PackArgument.dtb_offset] = "0x%08x" % ((header.dtb_addr - base) & 0xffffffffffffffff)
+            settings[PackArgument.dtb] = "%d" % header.dtb_size
+    return settings
+
+
+def get_source_image_commands(path):
+    # archive members and sparse images are read through a source; only the header pages are touched
+    source = sources.open_source(path)
+    try:
+        view = sources.SourceView(source)
+        image = bootimg.parse_image(view)
+        return get_commands_from_settings(get_image_settings(image, view if image.is_vendor else None))
+    finally:
+        source.close()
+
+
+def get_image_commands(path, sourced=False):
+    if sourced:
+        return get_source_image_commands(path)
+    with open(path, "rb") as file:
+        image = bootimg.parse_image(bootimg.read_scan_window(file))
+        if not image.is_vendor or image.header_version < 4:
+            return get_commands_from_settings(get_image_settings(image))
+        # the ramdisk table sits behind the ramdisk, so only vendor_boot v4 maps the whole image
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return get_commands_from_settings(get_image_settings(bootimg.parse_image(mapped), mapped))
+
+
+mtk_arguments = {PackArgument.mtk_kernel, PackArgument.mtk_ramdisk}
+
+# options mkbootimg (the C tool) does not know
+mkbootimg_py_arguments = {*mtk_arguments, PackArgument.vendor_ramdisk_fragments, PackArgument.vendor_bootconfig}
+
+section_arguments = {PackArgument.kernel, PackArgument.ramdisk, PackArgument.second, PackArgument.dtb,
+                     PackArgument.recovery_dtbo, PackArgument.vendor_ramdisk, PackArgument.vendor_bootconfig,
+                     PackArgument.dt}
+
+# unpack_bootimg writes fixed names and no value files
+unpack_bootimg_dir_files = {"kernel": PackArgument.kernel, "ramdisk": PackArgument.ramdisk,
+                            "second": PackArgument.second, "dtb": PackArgument.dtb,
+                            "recovery_dtbo": PackArgument.recovery_dtbo,
+                            "vendor_ramdisk": PackArgument.vendor_ramdisk,
+                            "bootconfig": PackArgument.vendor_bootconfig}
+
+# unpackbootimg writes <image>-<suffix>; suffixes never contain "-", so the last one splits them off exactly
+unpackbootimg_dir_files = {**unpack_bootimg_dir_files, "dt": PackArgument.dt,
+                           "base": PackArgument.base, "board": PackArgument.name, "cmdline": PackArgument.cmdline,
+                           "vendor_cmdline": PackArgument.vendor_cmdline, "dtb_offset": PackArgument.dtb_offset,
+                           "hashtype": PackArgument.hash_type, "header_version": PackArgument.header_version,
+                           "kernel_offset": PackArgument.kernel_offset,
+                           "ramdisk_offset": PackArgument.ramdisk_offset,
+                           "second_offset": PackArgument.second_offset, "tags_offset": PackArgument.tags_offset,
+                           "os_version": PackArgument.os_version, "os_patch_level": PackArgument.os_patch_level,
+                           "pagesize": PackArgument.pagesize, "kernel_mtk": PackArgument.mtk_kernel,
+                           "ramdisk_mtk": PackArgument.mtk_ramdisk,
+                           "vendor_ramdisk_fragments": PackArgument.vendor_ramdisk_fragments}
+
+DIR_READ_THREADS = 16
+DTB_SIBLINGS = ("kernel", "ramdisk", "vendor_ramdisk")
+
+
+def scan_unpack_dir(path):
+    # one directory read; d_type from scandir tells files apart without a stat per entry
+    with os.scandir(path) as entries:
+        return sorted(entry.name for entry in entries if entry.is_file())
+
+
+def read_value_file(path):
+    with open(path) as file:
+        return file.read().strip()
+
+
+def read_value_files(paths):
+    # small files are fetched together so slow filesystems pay one round trip instead of one per file
+    with instrument.span("value_files", count=len(paths)):
+        if len(paths) < 2:
+            return [read_value_file(path) for path in paths]
+        with ThreadPoolExecutor(max_workers=min(DIR_READ_THREADS, len(paths))) as executor:
+            return list(executor.map(read_value_file, paths))
+
+
+def get_stored_name(directory, name, stubs):
+    # section store stubs are replaced by the stored copy, which any mkbootimg can read; the stub index names
+    # them, so no other section file is opened
+    if name not in stubs:
+        return name
+    return sectionstore.resolve(os.path.join(directory, name))
+
+
+def get_dir_commands(path, names, table, suffix_separator=None):
+    sections = {}
+    values = {}
+    fragments_prefix = None
+    for name in names:
+        suffix = name.rpartition(suffix_separator)[2] if suffix_separator else name
+        argument = table.get(suffix)
+        if argument is None:
+            continue
+        if argument in section_arguments:
+            sections[argument] = name
+        else:
+            if argument == PackArgument.vendor_ramdisk_fragments:
+                fragments_prefix = name[:-len(suffix)]
+            values[argument] = os.path.join(path, name)
+
+    # value files, the fragment table and the stub index all come in the one batched fetch
+    paths = list(values.values())
+    if sectionstore.STUB_INDEX in names:
+        paths.append(os.path.join(path, sectionstore.STUB_INDEX))
+    contents = read_value_files(paths)
+    stubs = sectionstore.parse_stub_index(contents.pop()) if len(contents) > len(values) else set()
+    settings = dict(zip(values, contents))
+    settings.update({argument: get_stored_name(path, name, stubs) for argument, name in sections.items()})
+    if fragments_prefix is not None:
+        fragments = [(ramdisk_type, fragment_name, board_id, get_stored_name(path, fragment_path, stubs))
+                     for ramdisk_type, fragment_name, board_id, fragment_path in parse_unpackbootimg_fragments(
+                         settings.pop(PackArgument.vendor_ramdisk_fragments), fragments_prefix)]
+        settings = get_fragment_settings(settings, fragments)
+    return get_commands_from_settings(settings)
+
+
+def get_unpack_bootimg_commands_from_path(path, names=None):
+    return get_dir_commands(path, scan_unpack_dir(path) if names is None else names, unpack_bootimg_dir_files)
+
+
+def get_unpackbootimg_commands_from_path(path, names=None):
+    return get_dir_commands(path, scan_unpack_dir(path) if names is None else names, unpackbootimg_dir_files, "-")
+
+
+def get_method_commands(path, method, names=None, sourced=False):
     commands = {}
-    line_size = 0
-    line_fragments = ""
-    for line in open(path).read().split("\n"):
-        if line.startswith("Kernel address"):
-            line_fragments = line.split(" ")
-            line_size = len(line_fragments)
-            commands[PackArgument.kernel_offset] = pack_cmd_dict.get(PackArgument.kernel_offset) + " " + \
-                convert_to_decimal(line_fragments[line_size - 1])
-        if line.startswith("Ramdisk address"):
-            line_fragments = line.split(" ")
-            line_size = len(line_fragments)
-            commands[PackArgument.ramdisk_offset] = pack_cmd_dict.get(PackArgument.ramdisk_offset) + " " + \
-                convert_to_decimal(line_fragments[line_size - 1])
-        if line.startswith("Secondary address"):
-            line_fragments = line.split(" ")
-            line_size = len(line_fragments)
-            commands[PackArgument.second_offset] = pack_cmd_dict.get(PackArgument.second_offset) + " " + \
-                convert_to_decimal(line_fragments[line_size - 1])
-        if line.startswith("Kernel tags address"):
-            line_fragments = line.split(" ")
-            line_size = len(line_fragments)
-            commands[PackArgument.tags_offset] = pack_cmd_dict.get(PackArgument.tags_offset) + " " + \
-                convert_to_decimal(line_fragments[line_size - 1])
-        if line.startswith("Flash page size"):
-            line_fragments = line.split(" ")
-            line_size = len(line_fragments)
-            commands[PackArgument.pagesize] = pack_cmd_dict.get(PackArgument.pagesize) + " " + \
-                line_fragments[line_size - 1]
-        if line.startswith("Board name"):
-            line_fragments = line.split("\"")
-            line_size = len(line_fragments)
-            commands[PackArgument.name] = pack_cmd_dict.get(PackArgument.name) + " " + line_fragments[line_size - 2]
-        if line.startswith("Command line"):
-            line_fragments = line.split("\"")
-            line_size = len(line_fragments)
-            commands[PackArgument.cmdline] = pack_cmd_dict.get(PackArgument.cmdline) + " \"" + \
-                line_fragments[line_size - 2] + "\""
-
-        commands[PackArgument.dtb] = pack_cmd_dict.get(PackArgument.dtb) + " <dtb.dtb>"
-        commands[PackArgument.kernel] = pack_cmd_dict.get(PackArgument.kernel) + " <kernel>"
-        commands[PackArgument.ramdisk] = pack_cmd_dict.get(PackArgument.ramdisk) + " <ramdisk>"
-
-        commands = get_unmkbootimg_commands_from_settings_offsets(path, commands)
-    return commands
-
-
-def get_unpack_bootimg_commands_from_path(path):
-    commands = {}
-    commands[PackArgument.kernel] = pack_cmd_dict.get(PackArgument.kernel) + " kernel"
-    commands[PackArgument.ramdisk] = pack_cmd_dict.get(PackArgument.ramdisk) + " ramdisk"
-    commands[PackArgument.dtb] = pack_cmd_dict.get(PackArgument.dtb) + " dtb"
-    commands[PackArgument.recovery_dtbo] = pack_cmd_dict.get(PackArgument.recovery_dtbo) + " recovery_dtbo"
-    return commands
-
-
-def get_unpackbootimg_commands_from_path(path):
-    commands = {}
-
-    for file in os.listdir(path):
-        if file.endswith("kernel"):
-            commands[PackArgument.kernel] = pack_cmd_dict.get(PackArgument.kernel) + " " + file
-        if file.endswith("dtb"):
-            commands[PackArgument.dtb] = pack_cmd_dict.get(PackArgument.dtb) + " " + file
-        if file.endswith("ramdisk"):
-            commands[PackArgument.ramdisk] = pack_cmd_dict.get(PackArgument.ramdisk) + " " + file
-        if file.endswith("recovery_dtbo"):
-            commands[PackArgument.recovery_dtbo] = pack_cmd_dict.get(PackArgument.recovery_dtbo) + " " + file
-        if file.endswith("base"):
-            commands[PackArgument.base] = pack_cmd_dict.get(PackArgument.base) + " " + convert_to_decimal(
-                open(path + file).read().strip())
-        if file.endswith("board"):
-            commands[PackArgument.name] = pack_cmd_dict.get(PackArgument.name) + " " + open(path + file).read().strip()
-        if file.endswith("cmdline"):
-            commands[PackArgument.cmdline] = pack_cmd_dict.get(PackArgument.cmdline) + " \"" + open(
-                path + file).read().strip() + "\""
-        if file.endswith("dtb_offset"):
-            commands[PackArgument.dtb_offset] = pack_cmd_dict.get(PackArgument.dtb_offset) + " " + \
-                                                convert_to_decimal(open(path + file).read().strip())
-        if file.endswith("hashtype"):
-            commands[PackArgument.hash_type] = pack_cmd_dict.get(PackArgument.hash_type) + " " + \
-                                               open(path + file).read().strip()
-        if file.endswith("header_version"):
-            commands[PackArgument.header_version] = pack_cmd_dict.get(PackArgument.header_version) + " " + open(
-                path + file).read().strip()
-        if file.endswith("kernel_offset"):
-            commands[PackArgument.kernel_offset] = pack_cmd_dict.get(
-                PackArgument.kernel_offset) + " " + convert_to_decimal(open(path + file).read().strip())
-        if file.endswith("os_patch_level"):
-            commands[PackArgument.os_patch_level] = pack_cmd_dict.get(PackArgument.os_patch_level) + " " + open(
-                path + file).read().strip()
-        if file.endswith("os_version"):
-            commands[PackArgument.os_version] = pack_cmd_dict.get(PackArgument.os_version) + " " + open(
-                path + file).read().strip()
-        if file.endswith("pagesize"):
-            commands[PackArgument.pagesize] = pack_cmd_dict.get(PackArgument.pagesize) + " " + open(
-                path + file).read().strip()
-        if file.endswith("ramdisk_offset"):
-            commands[PackArgument.ramdisk_offset] = pack_cmd_dict.get(
-                PackArgument.ramdisk_offset) + " " + convert_to_decimal(open(path + file).read().strip())
-        if file.endswith("second_offset"):
-            commands[PackArgument.second_offset] = pack_cmd_dict.get(
-                PackArgument.second_offset) + " " + convert_to_decimal(open(path + file).read().strip())
-        if file.endswith("tags_offset"):
-            commands[PackArgument.tags_offset] = pack_cmd_dict.get(PackArgument.tags_offset) + " " + convert_to_decimal(
-                open(path + file).read().strip())
-    return commands
-
-
-def get_build_commands(path, method):
-    commands = {}
-    if os.path.isfile(path):
+    if method == UnpackMethod.image and sourced:
+        commands = get_image_commands(path, sourced)
+    elif os.path.isfile(path):
         match method:
             case UnpackMethod.unpack_bootimg:
                 commands = get_unpack_bootimg_commands_from_settings(path)
@@ -364,26 +580,98 @@ def get_build_commands(path, method):
                 commands = get_unpackbootimg_commands_from_settings(path)
             case UnpackMethod.unmkbootimg:
                 commands = get_unmkbootimg_commands_from_settings(path)
+            case UnpackMethod.image:
+                commands = get_image_commands(path)
             case _:
-                print("Commands could not be parsed.")
-                quit()
-    if os.path.isdir(path):
+                raise ValueError("Commands could not be parsed.")
+    elif os.path.isdir(path):
         match method:
             case UnpackMethod.unpack_bootimg:
-                commands = get_unpack_bootimg_commands_from_path(path)
+                commands = get_unpack_bootimg_commands_from_path(path, names)
             case UnpackMethod.unpackbootimg:
-                commands = get_unpackbootimg_commands_from_path(path)
+                commands = get_unpackbootimg_commands_from_path(path, names)
             case _:
-                print("Commands could not be parsed.")
-                quit()
+                raise ValueError("Commands could not be parsed.")
+    else:
+        raise ValueError(path + " does not exist.")
+    return commands
 
-    global unmk_path
-    if unmk_path:
-        commands = get_unmkbootimg_commands_from_settings_offsets(unmk_path, commands)
 
+def get_override_commands(overrides):
+    # overrides are an unmkbootimg settings file or a PackArgument (or name) -> value mapping
+    if isinstance(overrides, (str, os.PathLike)):
+        return get_commands_from_settings(read_settings(overrides, unmkbootimg_offset_settings))
+    settings = {}
+    for argument, value in overrides.items():
+        settings[PackArgument[argument] if isinstance(argument, str) else PackArgument(argument)] = value
+    return get_commands_from_settings(settings)
+
+
+def get_dtb_candidates(path, names):
+    # <image>-settings names its image; a plain settings file takes the dtbs that came with their own sections
+    name = os.path.basename(path)
+    if name.endswith("-settings"):
+        return [name[:-len("settings")] + "dtb"]
+    candidates = [name for name in names if name == "dtb" or name.endswith("-dtb")]
+    unpacked = [name for name in candidates if any(name[:-len("dtb")] + suffix in names for suffix in DTB_SIBLINGS)]
+    return unpacked or candidates
+
+
+def find_dtb_file(path, method, size, sourced=False):
+    # a dtb unpacked next to the settings file or image is used when its size matches the one in the header,
+    # and only when exactly one does, so a directory of several unpacks never borrows another image's dtb
+    if sourced:
+        return None
+    directory = os.path.dirname(path) or "."
+    if method == UnpackMethod.image:
+        names = [os.path.basename(path) + "-dtb"]
+    else:
+        names = get_dtb_candidates(path, scan_unpack_dir(directory))
+    stubs = sectionstore.read_stub_names(directory)
+    matches = [name for name in names if os.path.isfile(os.path.join(directory, name))
+               and os.path.getsize(os.path.join(directory, get_stored_name(directory, name, stubs))) == size]
+    if len(matches) != 1:
+        return None
+    return get_stored_name(directory, matches[0], stubs)
+
+
+def resolve_dtb(path, method, commands, sourced=False):
+    # settings files and images only give the dtb size: no dtb when it is 0, else a matching file or the placeholder
+    value = commands.get(PackArgument.dtb)
+    if not isinstance(value, str) or not value.isdigit():
+        return commands
+    commands = dict(commands)
+    size = int(value)
+    if size == 0:
+        del commands[PackArgument.dtb]
+    else:
+        commands[PackArgument.dtb] = find_dtb_file(path, method, size, sourced) or "<dtb.dtb>"
     return commands
 
 
+def get_cached_method_commands(path, cache=None):
+    # whether the path is a container member or sparse image is decided once and handed to every step
+    sourced = sources.needs_source(path)
+    if cache and sourced:
+        # the cache keys on the first bytes of the file, which for a container are not the boot header
+        cache = None
+    # the dtb is resolved after the cache, since which files sit next to a path is not part of its content
+    cached = cache.get(path, "dtb-size") if cache else None
+    if cached:
+        method, commands = cached
+        method = UnpackMethod(method)
+        return method, resolve_dtb(path, method, {PackArgument(argument): get_typed_value(PackArgument(argument), value)
+                                                  for argument, value in commands.items()}, sourced)
+
+    # a directory is listed once and the names feed both method detection and parsing
+    names = scan_unpack_dir(path) if os.path.isdir(path) else None
+    method = get_unpack_method(path, names, sourced)
+    commands = get_method_commands(path, method, names, sourced)
+    if cache:
+        cache.put(path, "dtb-size", method, commands)
+    return method, resolve_dtb(path, method, commands, sourced)
+
+
 def get_unpack_method_from_settings(path):
     method = UnpackMethod.notset
     with open(path, "r") as file:
@@ -391,73 +679,184 @@ def get_unpack_method_from_settings(path):
         if contents.startswith("unmkbootimg"):
             method = UnpackMethod.unmkbootimg
 
-        if contents.startswith("boot magic: ANDROID!"):
+        if contents.startswith("boot magic: ANDROID!") or contents.startswith("boot magic: VNDRBOOT"):
             method = UnpackMethod.unpack_bootimg
 
-        if contents.startswith("ANDROID! magic found at:"):
+        if contents.startswith("ANDROID! magic found at:") or contents.startswith("VNDRBOOT magic found at:"):
             method = UnpackMethod.unpackbootimg
 
     return method
 
 
-def get_unpack_method(path):
-    file_count = 0;
+def get_unpack_method(path, names=None, sourced=False):
     method = UnpackMethod.notset
 
+    if sourced or os.path.isfile(path) and not path.endswith("settings"):
+        return UnpackMethod.image
+
     if not path.endswith("settings"):
-        for file in os.listdir(path):
-            file_count += 1
-            if file == "kernel":
-                method = UnpackMethod.unpack_bootimg
-                break
-            if file == "initramfs.cpio.gz":
-                method = UnpackMethod.unmkbootimg
-                break
-            if file_count > 6:
-                method = UnpackMethod.unpackbootimg
-                break
+        if names is None:
+            names = scan_unpack_dir(path)
+        if "kernel" in names or "vendor_ramdisk" in names:
+            method = UnpackMethod.unpack_bootimg
+        elif "initramfs.cpio.gz" in names:
+            method = UnpackMethod.unmkbootimg
+        elif any(name.rpartition("-")[2] in unpackbootimg_dir_files for name in names):
+            method = UnpackMethod.unpackbootimg
     if path.endswith("settings"):
         method = get_unpack_method_from_settings(path)
 
     return method
 
 
-def generate_alerts(command):
-    alerts = "\n"
-    if "dtb.dtb" in command:
-        alerts += "dtb need to be manually configured!!!\n"
-    if "<kernel>" in command:
-        alerts += "kernel need to be manually configured!!!\n"
-    if "<ramdisk>" in command:
-        alerts += "ramdisk need to be manually configured!!!\n"
-    return alerts
+def parse(path, convert_hex=False, unmk_overrides=None, cache=None):
+    # reentrant: everything a call depends on comes in through its arguments
+    with instrument.span("method_commands", path=path):
+        method, commands = get_cached_method_commands(path, cache)
+    if unmk_overrides:
+        commands = {**commands, **get_override_commands(unmk_overrides)}
+    return CommandPacket(commands, method, convert_hex)
 
 
 def parsePath(args):
-    method = get_unpack_method(args.path)
-    commands = get_build_commands(args.path, method)
+    return parse(args.path, bool(getattr(args, "d", False)), getattr(args, "unmk", None) or None)
 
-    global convert_hex
-    if convert_hex:
-        commandlist = "mkbootimg.py "
-    else:
-        commandlist = "mkbootimg "
 
-    for command in sorted(list(commands)):
-        commandlist += commands[command.value] + " "
-    commandlist += " -o new.img"
+def is_unpack_dir(path):
+    for file in os.listdir(path):
+        if file in ("kernel", "initramfs.cpio.gz") or file.endswith("-kernel") or file.endswith("-vendor_ramdisk"):
+            return True
+    return False
+
 
-    alerts = generate_alerts(commandlist)
-    commandpacket = CommandPacket(commands, commandlist, method, alerts)
-    return commandpacket;
+def find_batch_paths(path):
+    if os.path.isfile(path):
+        # manifest: one image, settings file or unpack directory per line
+        with open(path) as file:
+            return [line.strip() for line in file if line.strip() and not line.startswith("#")]
+
+    paths = []
+    for root, dirs, files in os.walk(path):
+        if root != path and is_unpack_dir(root):
+            paths.append(root)
+            dirs.clear()
+            continue
+        dirs.sort()
+        for file in sorted(files):
+            if file == "settings" or file.endswith(".img"):
+                paths.append(os.path.join(root, file))
+    return paths
+
+
+@lru_cache(maxsize=None)
+def open_cache(directory, max_bytes):
+    # one connection per worker process, opened on its first record
+    return HeaderCache(directory, max_bytes)
+
+
+def get_batch_record(path, convert_hex=False, unmk_overrides=None, cache_settings=None):
+    record = {"path": path}
+    try:
+        cache = open_cache(*cache_settings) if cache_settings else None
+        record.update(parse(path, convert_hex, unmk_overrides, cache).to_record())
+    except Exception as error:
+        # one malformed dump must not take down the rest of the batch
+        record["error"] = str(error) or type(error).__name__
+    return json.dumps(record)
+
+
+def run_batch(path, jobs=None, output=sys.stdout, convert_hex=False, unmk_overrides=None, cache_settings=None):
+    paths = find_batch_paths(path)
+    get_record = partial(get_batch_record, convert_hex=convert_hex, unmk_overrides=unmk_overrides,
+                         cache_settings=cache_settings)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        for record in executor.map(get_record, paths, chunksize=max(1, len(paths) // 256)):
+            output.write(record + "\n")
+    return len(paths)
+
+
+def handle_request(line, get_cache):
+    record = {}
+    try:
+        request = json.loads(line)
+        record["id"] = request.get("id")
+        commandpacket = parse(request["path"], bool(request.get("convert_hex")), request.get("unmk_overrides"),
+                              get_cache())
+        record.update(commandpacket.to_record())
+    except Exception as error:
+        record["error"] = str(error) or type(error).__name__
+    return json.dumps(record)
+
+
+def get_thread_cache_opener(cache_settings):
+    # sqlite connections stay on the thread that opened them
+    local = threading.local()
+
+    def get_cache():
+        if cache_settings is None:
+            return None
+        if not hasattr(local, "cache"):
+            local.cache = HeaderCache(*cache_settings)
+        return local.cache
+    return get_cache
+
+
+def serve_stdin(jobs=None, cache_settings=None, input=sys.stdin, output=sys.stdout):
+    # one JSON request per line; answers carry the request id and may come back out of order
+    get_cache = get_thread_cache_opener(cache_settings)
+    lock = threading.Lock()
+
+    def respond(future):
+        with lock:
+            output.write(future.result() + "\n")
+            output.flush()
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for line in input:
+            if line.strip():
+                executor.submit(handle_request, line, get_cache).add_done_callback(respond)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if line.strip():
+                self.wfile.write((handle_request(line, self.server.get_cache) + "\n").encode())
+
+
+class RequestServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve_socket(path, cache_settings=None):
+    # every connection gets its own thread; requests on one connection are answered in order
+    if os.path.exists(path):
+        os.unlink(path)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    with RequestServer(path, RequestHandler) as server:
+        server.get_cache = get_thread_cache_opener(cache_settings)
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(path)
 
 
 def usage():
-    print("""get_mkbootimg_settings.py
-    -path: path to folder containing unpack or settings file
-    -d: convert offsets to decimal
+    return """get_mkbootimg_settings.py
+    -path: path to folder containing unpack, settings file or boot image
+    -d: convert offsets to decimal for AOSP mkbootimg.py (this repo's mkbootimg.py reads them as hex)
     -unmk: update offsets from unmkbootimg settings file
-    Settings File can be used. Copy the output from your unpacking operation to a file called 'settings'""")
+    -format: shell (default), argv (NUL separated, for xargs -0) or json
+    -pack: pack the image straight away into this file instead of printing the command
+    -batch: directory tree or manifest of paths; prints one JSON line per image
+    -jobs: worker processes for -batch, request threads for -serve (default: all cores)
+    -serve: answer JSON requests ({"id", "path", "convert_hex", "unmk_overrides"}) one per line on stdin
+    -socket: with -serve, listen on this unix socket instead of stdin
+    -no-cache: always parse instead of using the header cache
+    -cache-dir: header cache location (default: ~/.cache/mtk_mkbootimg)
+    -cache-size: header cache size cap in bytes
+    -cache-stats: print header cache hit rates""" + instrument.usage(indent="    ") + """
+    Settings File can be used. Copy the output from your unpacking operation to a file called 'settings'"""
 
 
 def parse_arguments():
@@ -465,23 +864,47 @@ def parse_arguments():
     parser.add_argument("-path")
     parser.add_argument("-d", required=False, default="", action="store_true")
     parser.add_argument("-unmk", required=False, default="", )
+    parser.add_argument("-format", required=False, default="shell", choices=("shell", "argv", "json"))
+    parser.add_argument("-pack", required=False, default=None)
+    parser.add_argument("-batch", required=False)
+    parser.add_argument("-jobs", required=False, default=None, type=int)
+    parser.add_argument("-serve", required=False, default=False, action="store_true")
+    parser.add_argument("-socket", required=False, default=None)
+    parser.add_argument("-no-cache", required=False, default=False, action="store_true")
+    parser.add_argument("-cache-dir", required=False, default=None)
+    parser.add_argument("-cache-size", required=False, default=CACHE_SIZE, type=int)
+    parser.add_argument("-cache-stats", required=False, default=False, action="store_true")
+    instrument.add_arguments(parser)
     args = parser.parse_args()
     return args
 
 
 def main():
     args = parse_arguments()
-
-    if args.path is None:
+    instrument.start_from_arguments(args)
+
+    header_cache = None
+    cache_settings = None
+    if not args.no_cache:
+        header_cache = HeaderCache(args.cache_dir, args.cache_size)
+        cache_settings = (header_cache.directory, header_cache.max_bytes)
+
+    if args.cache_stats and header_cache:
+        print(json.dumps(header_cache.stats()))
+
+    if args.serve:
+        if args.socket:
+            serve_socket(args.socket, cache_settings)
+        else:
+            serve_stdin(args.jobs, cache_settings)
         quit()
 
-    if args.d:
-        global convert_hex
-        convert_hex = True
+    if args.path is None and args.batch is None:
+        quit()
 
-    if args.unmk:
-        global unmk_path
-        unmk_path = args.unmk
+    if args.batch:
+        run_batch(args.batch, args.jobs, sys.stdout, bool(args.d), args.unmk or None, cache_settings)
+        quit()
 
     if not args.path.startswith("/"):
         args.path = "./" + args.path
@@ -491,10 +914,26 @@ def main():
     #         print("path must be settings file or path to unpack directory")
     #         quit()
 
-    commandpacket = parsePath(args)
-    print("You used " + commandpacket.method.name + " to unpack your image.")
-    print("Your pack command is:\n" + commandpacket.commandlist)
-    print(commandpacket.alerts)
+    try:
+        commandpacket = parse(args.path, bool(args.d), args.unmk or None, header_cache)
+        if args.pack:
+            directory = args.path if os.path.isdir(args.path) else os.path.dirname(args.path)
+            commandpacket.pack(args.pack, directory)
+            quit()
+    except (ValueError, OSError) as error:
+        print(error)
+        quit()
+
+    with instrument.span("command_generation"):
+        match args.format:
+            case "json":
+                print(commandpacket.to_json())
+            case "argv":
+                sys.stdout.write("\0".join(commandpacket.argv()) + "\0")
+            case _:
+                print("You used " + commandpacket.method.name + " to unpack your image.")
+                print("Your pack command is:\n" + commandpacket.shell())
+                print(commandpacket.alerts)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+import bootimg
+
+CACHE_SIZE = 8 * 1024 * 1024  # bytes of cached command payload kept before least recently used entries go
+
+
+def get_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "mtk_mkbootimg")
+
+
+def get_table_section(path, window):
+    if path.endswith("settings"):
+        return None
+    try:
+        image = bootimg.parse_image(window)
+    except ValueError:
+        return None
+    if not image.is_vendor or image.header_version < 4:
+        return None
+    return image.section("vendor_ramdisk_table")
+
+
+class HeaderCache:
+    # results are stored once per header content; paths only map (path, size, mtime) onto that content
+
+    def __init__(self, directory=None, max_bytes=CACHE_SIZE):
+        self.directory = directory or get_cache_dir()
+        self.max_bytes = max_bytes
+        self.pending = {}
+        os.makedirs(self.directory, exist_ok=True)
+        self.connection = sqlite3.connect(os.path.join(self.directory, "headers.sqlite"), timeout=30,
+                                          isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS entries (content_key TEXT PRIMARY KEY, method INTEGER, "
+                                "commands TEXT, size INTEGER, last_used REAL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS paths (stat_key TEXT PRIMARY KEY, content_key TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)")
+
+    def close(self):
+        self.connection.close()
+
+    def count(self, name):
+        self.connection.execute("INSERT INTO stats VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1",
+                                (name,))
+
+    def get_stat_key(self, path, variant):
+        st = os.stat(path)
+        return "%s\0%d\0%d\0%s" % (os.path.abspath(path), st.st_size, st.st_mtime_ns, variant)
+
+    def get_content_key(self, path, variant):
+        # the header window decides the parse result, so two copies of a stock image share one entry;
+        # the vendor ramdisk table lies past the window and is parsed too, so its bytes are part of the key
+        with open(path, "rb") as file:
+            window = bootimg.read_scan_window(file)
+            digest = hashlib.blake2b(window, digest_size=16)
+            table = get_table_section(path, window)
+            if table is not None:
+                file.seek(table.offset)
+                digest.update(file.read(table.size))
+        digest.update(("\0%s\0%s" % (path.endswith("settings"), variant)).encode())
+        return digest.hexdigest()
+
+    def load(self, content_key):
+        row = self.connection.execute("SELECT method, commands FROM entries WHERE content_key = ?",
+                                      (content_key,)).fetchone()
+        if row is None:
+            return None
+        self.connection.execute("UPDATE entries SET last_used = ? WHERE content_key = ?", (time.time(), content_key))
+        return row[0], {int(argument): command for argument, command in json.loads(row[1]).items()}
+
+    def get(self, path, variant=""):
+        if not os.path.isfile(path):
+            return None
+        stat_key = self.get_stat_key(path, variant)
+        row = self.connection.execute("SELECT content_key FROM paths WHERE stat_key = ?", (stat_key,)).fetchone()
+        if row is not None:
+            entry = self.load(row[0])
+            if entry is not None:
+                self.count("hits")
+                return entry
+
+        content_key = self.get_content_key(path, variant)
+        entry = self.load(content_key)
+        if entry is not None:
+            self.connection.execute("INSERT OR REPLACE INTO paths VALUES (?, ?)", (stat_key, content_key))
+            self.count("hits")
+            return entry
+
+        self.pending[path] = (stat_key, content_key)
+        self.count("misses")
+        return None
+
+    def put(self, path, variant, method, commands):
+        if not os.path.isfile(path):
+            return
+        stat_key, content_key = self.pending.pop(path, (None, None))
+        if stat_key is None:
+            stat_key = self.get_stat_key(path, variant)
+            content_key = self.get_content_key(path, variant)
+        payload = json.dumps({int(argument): command for argument, command in commands.items()})
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                                    (content_key, int(method), payload, len(payload), time.time()))
+            self.connection.execute("INSERT OR REPLACE INTO paths VALUES (?, ?)", (stat_key, content_key))
+            self.evict()
+
+    def evict(self):
+        total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for content_key, size in self.connection.execute(
+                "SELECT content_key, size FROM entries ORDER BY last_used").fetchall():
+            if total <= self.max_bytes:
+                break
+            self.connection.execute("DELETE FROM entries WHERE content_key = ?", (content_key,))
+            total -= size
+            self.count("evictions")
+        self.connection.execute("DELETE FROM paths WHERE content_key NOT IN (SELECT content_key FROM entries)")
+
+    def stats(self):
+        stats = dict(self.connection.execute("SELECT name, value FROM stats").fetchall())
+        entries, size = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        hits = stats.get("hits", 0)
+        misses = stats.get("misses", 0)
+        return {"directory": self.directory, "entries": entries, "bytes": size, "max_bytes": self.max_bytes,
+                "hits": hits, "misses": misses, "evictions": stats.get("evictions", 0),
+                "hit_rate": hits / (hits + misses) if hits + misses else 0.0}
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+import atexit
+import json
+import os
+import threading
+import time
+
+TRACE_FORMATS = ("json", "chrome")
+PROFILE_LIMIT = 40
+MEMORY_LIMIT = 20
+
+recorder = None  # None while tracing is off, so every hook costs one global lookup
+
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    __slots__ = ("recorder", "name", "args", "start")
+
+    def __init__(self, recorder, name, args):
+        self.recorder = recorder
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *args):
+        self.recorder.add_event(self.name, self.start, time.perf_counter_ns() - self.start, self.args)
+        return False
+
+
+class Recorder:
+    def __init__(self, profile=False, memory=False):
+        self.origin = time.perf_counter_ns()
+        self.lock = threading.Lock()
+        self.events = []
+        self.counters = {}
+        self.profiler = None
+        self.memory = memory
+        if profile:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        if memory:
+            import tracemalloc
+            tracemalloc.start()
+
+    def add_event(self, name, start, duration, args):
+        # list.append is atomic, so threads record without taking the lock
+        self.events.append((name, start - self.origin, duration, threading.get_ident(), args))
+
+    def count(self, name, value):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def get_stages(self):
+        stages = {}
+        for name, start, duration, tid, args in self.events:
+            stage = stages.setdefault(name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+            stage["count"] += 1
+            stage["total_ms"] += duration / 1e6
+            stage["max_ms"] = max(stage["max_ms"], duration / 1e6)
+        return stages
+
+    def get_profile(self):
+        import pstats
+        self.profiler.disable()
+        stats = pstats.Stats(self.profiler)
+        rows = []
+        for (filename, line, function), (calls, primitive, total, cumulative, callers) in stats.stats.items():
+            rows.append({"function": "%s:%d(%s)" % (os.path.basename(filename), line, function), "calls": calls,
+                         "total_ms": total * 1e3, "cumulative_ms": cumulative * 1e3})
+        rows.sort(key=lambda row: row["cumulative_ms"], reverse=True)
+        return rows[:PROFILE_LIMIT]
+
+    def get_memory(self):
+        import tracemalloc
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        top = [{"location": "%s:%d" % (os.path.basename(stat.traceback[0].filename), stat.traceback[0].lineno),
+                "bytes": stat.size, "blocks": stat.count}
+               for stat in snapshot.statistics("lineno")[:MEMORY_LIMIT]]
+        return {"current": current, "peak": peak, "top": top}
+
+    def get_extras(self):
+        extras = {}
+        if self.profiler is not None:
+            extras["profile"] = self.get_profile()
+        if self.memory:
+            extras["memory"] = self.get_memory()
+        return extras
+
+    def to_json(self):
+        events = [{"name": name, "start_ms": start / 1e6, "duration_ms": duration / 1e6, "thread": tid,
+                   "args": args}
+                  for name, start, duration, tid, args in self.events]
+        return {"stages": self.get_stages(), "counters": self.counters, "events": events, **self.get_extras()}
+
+    def to_chrome(self):
+        # chrome://tracing and Perfetto read complete ("X") events in microseconds
+        pid = os.getpid()
+        events = [{"name": name, "ph": "X", "ts": start / 1e3, "dur": duration / 1e3, "pid": pid, "tid": tid,
+                   "args": args}
+                  for name, start, duration, tid, args in self.events]
+        end = max((start + duration for name, start, duration, tid, args in self.events), default=0)
+        events += [{"name": name, "ph": "C", "ts": end / 1e3, "pid": pid, "tid": 0, "args": {name: value}}
+                   for name, value in self.counters.items()]
+        return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": self.get_extras()}
+
+
+def span(name, **args):
+    if recorder is None:
+        return NULL_SPAN
+    return Span(recorder, name, args)
+
+
+def count(name, value=1):
+    if recorder is not None:
+        recorder.count(name, value)
+
+
+def start(profile=False, memory=False):
+    global recorder
+    recorder = Recorder(profile, memory)
+    return recorder
+
+
+def stop():
+    global recorder
+    stopped = recorder
+    recorder = None
+    return stopped
+
+
+def write(stopped, path, trace_format="json"):
+    if trace_format not in TRACE_FORMATS:
+        raise ValueError("unknown trace format '" + trace_format + "'")
+    trace = stopped.to_chrome() if trace_format == "chrome" else stopped.to_json()
+    with open(path, "w") as file:
+        json.dump(trace, file)
+
+
+def trace_to(path, trace_format="json", profile=False, memory=False):
+    # the scripts leave through quit() from many places, so the trace is written when the interpreter exits
+    if trace_format not in TRACE_FORMATS:
+        raise ValueError("unknown trace format '" + trace_format + "'")
+    start(profile, memory)
+    atexit.register(lambda: write(stop(), path, trace_format))
+
+
+OPTIONS = (("trace", "write per-stage timings and byte counters to this file"),
+           ("trace_format", "json (default) or chrome for chrome://tracing and Perfetto"),
+           ("profile", "add the top cProfile entries to the trace"),
+           ("tracemalloc", "add peak memory and the largest allocation sites to the trace"))
+OPTION_NAMES = tuple(name for name, help in OPTIONS)
+
+
+def get_flag(name, prefix, separator):
+    return prefix + name.replace("_", separator)
+
+
+def add_arguments(parser, prefix="-", separator="-"):
+    parser.add_argument(get_flag("trace", prefix, separator), dest="trace", default=None)
+    parser.add_argument(get_flag("trace_format", prefix, separator), dest="trace_format", default="json",
+                        choices=TRACE_FORMATS)
+    parser.add_argument(get_flag("profile", prefix, separator), dest="profile", default=False, action="store_true")
+    parser.add_argument(get_flag("tracemalloc", prefix, separator), dest="tracemalloc", default=False,
+                        action="store_true")
+
+
+def usage(prefix="-", separator="-", indent="        "):
+    return "".join("\n%s%s: %s" % (indent, get_flag(name, prefix, separator), help) for name, help in OPTIONS)
+
+
+def start_from_arguments(args):
+    if args.trace:
+        trace_to(args.trace, args.trace_format, args.profile, args.tracemalloc)
@@ -0,0 +1,824 @@
+#!/usr/bin/env python3
+import ctypes
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import threading
+from argparse import Action, ArgumentParser, RawDescriptionHelpFormatter
+
+import bootimg
+import instrument
+import sectionstore
+
+CHUNK_SIZE = 1024 * 1024
+PAGE_SIZES = (2048, 4096, 8192, 16384, 32768, 65536, 131072)
+HASH_TYPES = ("sha1", "sha256")
+UINT32_MAX = 0xffffffff
+
+
+def parse_int(value):
+    # hex with or without 0x, as mkbootimg.c reads them with strtoul(..., 16)
+    return int(value, 16)
+
+
+def parse_os_version(ver):
+    parts = ver.split(".")
+    try:
+        numbers = [int(part) for part in parts[:3]]
+    except ValueError:
+        return 0
+    numbers += [0] * (3 - len(numbers))
+    a, b, c = numbers
+    if a < 128 and b < 128 and c < 128:
+        return (a << 14) | (b << 7) | c
+    return 0
+
+
+def parse_os_patch_level(lvl):
+    parts = lvl.split("-")
+    try:
+        y, m = int(parts[0]) - 2000, int(parts[1])
+    except (ValueError, IndexError):
+        return 0
+    if 0 <= y < 128 and 0 < m <= 12:
+        return (y << 4) | m
+    return 0
+
+
+class FragmentAction(Action):
+    # --ramdisk_type, --ramdisk_name and --board_idN describe the --vendor_ramdisk_fragment that follows them
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        fragments = getattr(namespace, self.dest) or []
+        board_id = []
+        for index in range(bootimg.VENDOR_RAMDISK_TABLE_ENTRY_BOARD_ID_SIZE):
+            board_id.append(getattr(namespace, "board_id%d" % index) or 0)
+            setattr(namespace, "board_id%d" % index, None)
+        ramdisk_type = getattr(namespace, "ramdisk_type")
+        fragments.append({"path": values, "name": getattr(namespace, "ramdisk_name") or "", "board_id": board_id,
+                          "type": bootimg.VENDOR_RAMDISK_TYPE_NONE if ramdisk_type is None else ramdisk_type})
+        namespace.ramdisk_type = None
+        namespace.ramdisk_name = None
+        setattr(namespace, self.dest, fragments)
+
+
+class PackInputs:
+    # shared by several packs: every input is mapped once, and the boot id hash state after each prefix of inputs
+    # is kept, so images starting with the same kernel hash it only once
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}
+        self.hash_states = {}
+
+    def get(self, path):
+        path = os.path.realpath(sectionstore.resolve(path))
+        with self.lock:
+            entry = self.files.get(path)
+            if entry is None:
+                with open(path, "rb") as file:
+                    st = os.fstat(file.fileno())
+                    data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if st.st_size else b""
+                entry = ((st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns), data)
+                self.files[path] = entry
+        return entry
+
+    def close(self):
+        for key, data in self.files.values():
+            if isinstance(data, mmap.mmap):
+                data.close()
+        self.files.clear()
+
+
+class SectionWriter:
+    # streams inputs into the image in fixed chunks, feeding the boot id hash on the way
+
+    def __init__(self, file, page_size, hasher=None, inputs=None):
+        self.file = file
+        self.page_size = page_size
+        self.hasher = hasher
+        self.inputs = inputs
+        self.hash_key = ()
+        self.buffer = bytearray(CHUNK_SIZE)
+        self.position = file.tell()
+
+    def update_hash(self, key, *chunks):
+        if not self.hasher:
+            return
+        if self.inputs is None:
+            for chunk in chunks:
+                self.hasher.update(chunk)
+            return
+        # key names what is hashed, so the whole key tuple identifies the hash state
+        self.hash_key += (key,)
+        memo_key = (self.hasher.name, self.hash_key)
+        state = self.inputs.hash_states.get(memo_key)
+        if state is not None:
+            self.hasher = state.copy()
+            return
+        for chunk in chunks:
+            self.hasher.update(chunk)
+        self.inputs.hash_states[memo_key] = self.hasher.copy()
+
+    def hash_size(self, size):
+        data = struct.pack("<I", size)
+        self.update_hash(data, data)
+
+    def skip_padding(self, size):
+        # padding is left as a hole and zero-filled by the final truncate
+        self.position += bootimg.get_padding(size, self.page_size)
+        self.file.seek(self.position)
+
+    def reserve(self, size):
+        self.position += size
+        self.skip_padding(size)
+
+    def write_bytes(self, data):
+        self.file.write(data)
+        self.position += len(data)
+        self.skip_padding(len(data))
+        return len(data)
+
+    def write_file(self, path, name, pad=True, mtk_name=None):
+        with instrument.span("section_io", section=name):
+            size = self.stream_file(path, name, mtk_name)
+        instrument.count("bytes_written", size)
+        if pad:
+            self.skip_padding(size)
+        return size
+
+    def write_input(self, path, name, mtk_name=None):
+        try:
+            key, data = self.inputs.get(path)
+        except OSError:
+            raise ValueError("error: could not load %s '%s'" % (name, path))
+        header = bootimg.build_mtk_header(mtk_name, len(data)) if mtk_name is not None else b""
+        size = len(header) + len(data)
+        if size > UINT32_MAX:
+            raise ValueError("error: %s '%s' is too large" % (name, path))
+        self.update_hash((key, mtk_name), header, data)
+        self.file.write(header)
+        self.file.write(data)
+        self.hash_size(size)
+        self.position += size
+        return size
+
+    def stream_file(self, path, name, mtk_name=None):
+        if self.inputs is not None:
+            return self.write_input(path, name, mtk_name)
+        size = 0
+        view = memoryview(self.buffer)
+        try:
+            with open(sectionstore.resolve(path), "rb") as section:
+                if mtk_name is not None:
+                    # the payload size is known before it is read, so the MTK header goes out first like any chunk
+                    payload_size = os.fstat(section.fileno()).st_size
+                    header = bootimg.build_mtk_header(mtk_name, payload_size)
+                    if self.hasher:
+                        self.hasher.update(header)
+                    self.file.write(header)
+                    size += len(header)
+                while True:
+                    count = section.readinto(self.buffer)
+                    if not count:
+                        break
+                    chunk = view[:count]
+                    if self.hasher:
+                        self.hasher.update(chunk)
+                    self.file.write(chunk)
+                    size += count
+        except OSError:
+            raise ValueError("error: could not load %s '%s'" % (name, path))
+        finally:
+            view.release()
+        if mtk_name is not None and size != bootimg.MTK_HEADER_SIZE + payload_size:
+            raise ValueError("error: %s '%s' changed while it was packed" % (name, path))
+        if size > UINT32_MAX:
+            raise ValueError("error: %s '%s' is too large" % (name, path))
+        self.hash_size(size)
+        self.position += size
+        return size
+
+    def copy_section(self, src_fd, view, offset, size):
+        # unchanged sections move in-kernel; they are only read back when the boot id has to be rebuilt
+        if self.hasher:
+            with instrument.span("hashing", size=size):
+                for start in range(offset, offset + size, CHUNK_SIZE):
+                    self.hasher.update(view[start:min(start + CHUNK_SIZE, offset + size)])
+                self.hasher.update(struct.pack("<I", size))
+            instrument.count("bytes_hashed", size)
+        with instrument.span("section_copy", size=size):
+            self.file.flush()
+            copied = bootimg.copy_range(src_fd, self.file.fileno(), offset, size)
+            self.file.seek(self.position + copied)
+            if copied < size:
+                self.file.write(view[offset + copied:offset + size])
+        instrument.count("bytes_copied", size)
+        self.position += size
+        self.skip_padding(size)
+        return size
+
+    def finish(self):
+        self.file.truncate(self.position)
+
+
+def set_cmdline(hdr, cmdline):
+    if len(cmdline) <= bootimg.BOOT_ARGS_SIZE:
+        hdr.cmdline = cmdline
+    elif len(cmdline) <= bootimg.BOOT_ARGS_SIZE + bootimg.BOOT_EXTRA_ARGS_SIZE:
+        # exceeds the limits of the base command-line size, go for the extra
+        hdr.cmdline = cmdline[:bootimg.BOOT_ARGS_SIZE]
+        hdr.extra_cmdline = cmdline[bootimg.BOOT_ARGS_SIZE:]
+    else:
+        raise ValueError("error: kernel cmdline too large")
+
+
+def pack_boot_v2(file, options, inputs=None):
+    # boot_img_hdr_v2 in the backported header supports all boot_img_hdr versions and cross-compatible variants below 3
+    header_version = options["header_version"]
+    page_size = options["pagesize"]
+    base = options["base"]
+
+    hdr = bootimg.BootImgHdrV2()
+    hdr.magic = bootimg.BOOT_MAGIC
+    hdr.page_size = page_size
+    hdr.kernel_addr = (base + options["kernel_offset"]) & UINT32_MAX
+    hdr.ramdisk_addr = (base + options["ramdisk_offset"]) & UINT32_MAX
+    hdr.second_addr = (base + options["second_offset"]) & UINT32_MAX
+    hdr.tags_addr = (base + options["tags_offset"]) & UINT32_MAX
+    hdr.header_version = header_version
+    hdr.os_version = (options["os_version"] << 11) | options["os_patch_level"]
+
+    board = options["board"].encode()
+    if len(board) >= bootimg.BOOT_NAME_SIZE:
+        raise ValueError("error: board name too large")
+    hdr.name = board
+    set_cmdline(hdr, options["cmdline"].encode())
+
+    writer = SectionWriter(file, page_size, hashlib.new(options["hashtype"]), inputs)
+    writer.reserve(ctypes.sizeof(hdr))
+
+    hdr.kernel_size = writer.write_file(options["kernel"], "kernel", mtk_name=options["mtk_kernel"])
+    hdr.ramdisk_size = writer.write_file(options["ramdisk"], "ramdisk", mtk_name=options["mtk_ramdisk"]) \
+        if options["ramdisk"] else 0
+    if not options["ramdisk"]:
+        writer.hash_size(0)
+    if options["second"]:
+        hdr.second_size = writer.write_file(options["second"], "second")
+    else:
+        writer.hash_size(0)
+
+    if header_version == 0:
+        if options["dt"]:
+            hdr.dt_size = writer.write_file(options["dt"], "dt")  # overrides hdr.header_version
+            if hdr.dt_size == 0:
+                raise ValueError("error: could not load dt '%s'" % options["dt"])
+        else:
+            hdr.dt_size = 0
+    else:
+        if options["recovery_dtbo"]:
+            # header occupies a page
+            hdr.recovery_dtbo_offset = page_size * (1 + (hdr.kernel_size + page_size - 1) // page_size +
+                                                    (hdr.ramdisk_size + page_size - 1) // page_size +
+                                                    (hdr.second_size + page_size - 1) // page_size)
+            hdr.recovery_dtbo_size = writer.write_file(options["recovery_dtbo"], "recovery dtbo/acpio")
+            if hdr.recovery_dtbo_size == 0:
+                raise ValueError("error: could not load recovery dtbo/acpio '%s'" % options["recovery_dtbo"])
+        else:
+            writer.hash_size(0)
+        if header_version > 1:
+            if options["dtb"]:
+                hdr.dtb_size = writer.write_file(options["dtb"], "dtb")
+                if hdr.dtb_size == 0:
+                    raise ValueError("error: could not load dtb '%s'" % options["dtb"])
+            else:
+                writer.hash_size(0)
+            hdr.dtb_addr = base + options["dtb_offset"]
+        if header_version == 1:
+            hdr.header_size = ctypes.sizeof(bootimg.BootImgHdrV1)
+        else:
+            hdr.header_size = ctypes.sizeof(hdr)
+    writer.finish()
+
+    # put a hash of the contents in the header so boot images can be differentiated based on their first 2k
+    digest = writer.hasher.digest()[:ctypes.sizeof(hdr.id)]
+    ctypes.memmove(hdr.id, digest, len(digest))
+    file.seek(0)
+    file.write(bytes(hdr))
+    return bytes(hdr.id)
+
+
+def pack_boot_v3(file, options, inputs=None):
+    # boot_img_hdr_v3 and above are no longer backwards compatible
+    header_version = options["header_version"]
+    hdr = bootimg.BootImgHdrV4() if header_version > 3 else bootimg.BootImgHdrV3()
+    hdr.magic = bootimg.BOOT_MAGIC
+    hdr.os_version = (options["os_version"] << 11) | options["os_patch_level"]
+    hdr.header_size = ctypes.sizeof(hdr)
+    hdr.header_version = header_version
+
+    cmdline = options["cmdline"].encode()
+    if len(cmdline) > bootimg.BOOT_ARGS_SIZE + bootimg.BOOT_EXTRA_ARGS_SIZE:
+        raise ValueError("error: kernel cmdline too large")
+    hdr.cmdline = cmdline
+
+    writer = SectionWriter(file, bootimg.BOOT_V3_PAGE_SIZE, inputs=inputs)
+    writer.reserve(ctypes.sizeof(hdr))
+    hdr.kernel_size = writer.write_file(options["kernel"], "kernel", mtk_name=options["mtk_kernel"])
+    if options["ramdisk"]:
+        hdr.ramdisk_size = writer.write_file(options["ramdisk"], "ramdisk", mtk_name=options["mtk_ramdisk"])
+    writer.finish()
+
+    file.seek(0)
+    file.write(bytes(hdr))
+    return None
+
+
+def parse_ramdisk_type(value):
+    ramdisk_type = bootimg.VENDOR_RAMDISK_TYPES.get(value.lower())
+    return ramdisk_type if ramdisk_type is not None else parse_int(value)
+
+
+def get_vendor_ramdisk_fragments(options):
+    # a plain --vendor_ramdisk becomes the first, platform type entry of the ramdisk table
+    fragments = []
+    if options["ramdisk"]:
+        fragments.append({"path": options["ramdisk"], "type": bootimg.VENDOR_RAMDISK_TYPE_PLATFORM, "name": "",
+                          "board_id": [0] * bootimg.VENDOR_RAMDISK_TABLE_ENTRY_BOARD_ID_SIZE})
+    return fragments + (options.get("vendor_ramdisk_fragments") or [])
+
+
+def pack_vendor_boot(file, options, inputs=None):
+    # vendor_boot_img_hdr started at v3 and is not cross-compatible with boot_img_hdr
+    header_version = max(options["header_version"], 3)
+    page_size = options["pagesize"]
+    base = options["base"]
+
+    hdr = bootimg.VendorBootImgHdrV4() if header_version > 3 else bootimg.VendorBootImgHdrV3()
+    hdr.magic = bootimg.VENDOR_BOOT_MAGIC
+    hdr.header_version = header_version
+    hdr.page_size = page_size
+    hdr.kernel_addr = (base + options["kernel_offset"]) & UINT32_MAX
+    hdr.ramdisk_addr = (base + options["ramdisk_offset"]) & UINT32_MAX
+    hdr.tags_addr = (base + options["tags_offset"]) & UINT32_MAX
+    hdr.dtb_addr = base + options["dtb_offset"]
+    hdr.header_size = ctypes.sizeof(hdr)
+
+    board = options["board"].encode()
+    if len(board) >= bootimg.VENDOR_BOOT_NAME_SIZE:
+        raise ValueError("error: board name too large")
+    hdr.name = board
+
+    cmdline = options["cmdline"].encode()
+    if len(cmdline) > bootimg.VENDOR_BOOT_ARGS_SIZE:
+        raise ValueError("error: vendor cmdline too large")
+    hdr.cmdline = cmdline
+
+    fragments = get_vendor_ramdisk_fragments(options)
+    if header_version < 4 and (len(fragments) > 1 or options.get("vendor_bootconfig")):
+        raise ValueError("error: vendor ramdisk fragments and bootconfig need header version 4")
+
+    writer = SectionWriter(file, page_size, inputs=inputs)
+    writer.reserve(ctypes.sizeof(hdr))
+    table = (bootimg.VendorRamdiskTableEntryV4 * len(fragments))()
+    for entry, fragment in zip(table, fragments):
+        # fragments are packed back to back and share the vendor ramdisk section's padding
+        entry.ramdisk_offset = hdr.vendor_ramdisk_size
+        entry.ramdisk_size = writer.write_file(fragment["path"], "vendor ramdisk", pad=False)
+        if entry.ramdisk_size == 0:
+            raise ValueError("error: could not load vendor ramdisk '%s'" % fragment["path"])
+        entry.ramdisk_type = fragment["type"]
+        name = fragment["name"].encode()
+        if len(name) >= bootimg.VENDOR_RAMDISK_NAME_SIZE:
+            raise ValueError("error: vendor ramdisk name too large")
+        entry.ramdisk_name = name
+        entry.board_id[:] = fragment["board_id"]
+        hdr.vendor_ramdisk_size += entry.ramdisk_size
+    writer.skip_padding(hdr.vendor_ramdisk_size)
+    if options["dtb"]:
+        hdr.dtb_size = writer.write_file(options["dtb"], "dtb")
+        if hdr.dtb_size == 0:
+            raise ValueError("error: could not load dtb '%s'" % options["dtb"])
+    if header_version > 3:
+        hdr.vendor_ramdisk_table_entry_num = len(fragments)
+        hdr.vendor_ramdisk_table_entry_size = ctypes.sizeof(bootimg.VendorRamdiskTableEntryV4)
+        hdr.vendor_ramdisk_table_size = ctypes.sizeof(table)
+        writer.write_bytes(bytes(table))
+        if options.get("vendor_bootconfig"):
+            hdr.bootconfig_size = writer.write_file(options["vendor_bootconfig"], "vendor bootconfig")
+    writer.finish()
+
+    file.seek(0)
+    file.write(bytes(hdr))
+    return None
+
+
+def pack(options, inputs=None):
+    output = options["output"]
+    if output is None:
+        raise ValueError("error: no output filename specified")
+    if options["pagesize"] not in PAGE_SIZES:
+        raise ValueError("error: unsupported page size %d" % options["pagesize"])
+    if options["hashtype"] not in HASH_TYPES:
+        raise ValueError("error: unknown hash algorithm '%s'" % options["hashtype"])
+    if not options["vendor_boot"] and options["kernel"] is None:
+        raise ValueError("error: no kernel image specified")
+    if options["vendor_boot"] and (options["mtk_kernel"] or options["mtk_ramdisk"]):
+        raise ValueError("error: MTK headers are only supported on boot images")
+
+    try:
+        with open(output, "wb") as file:
+            if options["vendor_boot"]:
+                return pack_vendor_boot(file, options, inputs)
+            if options["header_version"] < 3:
+                return pack_boot_v2(file, options, inputs)
+            return pack_boot_v3(file, options, inputs)
+    except (ValueError, OSError):
+        if os.path.exists(output):
+            os.unlink(output)
+        raise
+
+
+FICLONE = 0x40049409
+REPACK_ALIASES = {"name": "board", "hash_type": "hashtype"}
+ADDRESS_FIELDS = {"kernel_offset": "kernel_addr", "ramdisk_offset": "ramdisk_addr", "second_offset": "second_addr",
+                  "tags_offset": "tags_addr", "dtb_offset": "dtb_addr"}
+FIXED_LAYOUT_OPTIONS = ("pagesize", "header_version", "vendor_ramdisk_fragments")
+
+
+def clone_file(src_fd, dst_fd, size):
+    # reflink where the filesystem shares extents, otherwise an in-kernel copy
+    try:
+        import fcntl
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return size
+    except (ImportError, OSError):
+        pass
+    os.lseek(dst_fd, 0, os.SEEK_SET)
+    return bootimg.copy_range(src_fd, dst_fd, 0, size)
+
+
+def get_repack_changes(changes):
+    normalized = {}
+    for key, value in changes.items():
+        name = getattr(key, "name", key)
+        normalized[REPACK_ALIASES.get(name, name)] = value
+    for name in FIXED_LAYOUT_OPTIONS:
+        if name in normalized:
+            raise ValueError("error: %s cannot change in an incremental repack" % name)
+    if "vendor_cmdline" in normalized:
+        normalized["cmdline"] = normalized.pop("vendor_cmdline")
+    if "vendor_bootconfig" in normalized:
+        normalized["bootconfig"] = normalized.pop("vendor_bootconfig")
+    return normalized
+
+
+def update_header(image, hdr, changes):
+    if "cmdline" in changes:
+        cmdline = changes["cmdline"].encode()
+        if isinstance(hdr, bootimg.BootImgHdrV0):
+            hdr.cmdline = b""
+            hdr.extra_cmdline = b""
+            set_cmdline(hdr, cmdline)
+        elif len(cmdline) > type(hdr).cmdline.size:
+            raise ValueError("error: kernel cmdline too large")
+        else:
+            hdr.cmdline = cmdline
+
+    if "board" in changes:
+        if not hasattr(hdr, "name"):
+            raise ValueError("error: header version %d boot images have no board name" % image.header_version)
+        board = changes["board"].encode()
+        if len(board) >= type(hdr).name.size:
+            raise ValueError("error: board name too large")
+        hdr.name = board
+
+    if "os_version" in changes or "os_patch_level" in changes:
+        os_version = changes.get("os_version")
+        os_patch_level = changes.get("os_patch_level")
+        # get_repack_options already gives header values; strings are still taken from direct callers
+        if os_version is None:
+            os_version = hdr.os_version >> 11
+        elif isinstance(os_version, str):
+            os_version = parse_os_version(os_version)
+        if os_patch_level is None:
+            os_patch_level = hdr.os_version & 0x7ff
+        elif isinstance(os_patch_level, str):
+            os_patch_level = parse_os_patch_level(os_patch_level)
+        hdr.os_version = (os_version << 11) | os_patch_level
+
+    if "base" in changes or any(name in changes for name in ADDRESS_FIELDS):
+        old_base = bootimg.get_base(hdr)
+        base = changes.get("base", old_base)
+        if isinstance(base, str):
+            base = parse_int(base)
+        for name, field in ADDRESS_FIELDS.items():
+            if not hasattr(hdr, field) or (field == "dtb_addr" and not image.is_vendor and image.header_version < 2):
+                continue
+            offset = changes.get(name, getattr(hdr, field) - old_base)
+            if isinstance(offset, str):
+                offset = parse_int(offset)
+            mask = 0xffffffffffffffff if field == "dtb_addr" else UINT32_MAX
+            setattr(hdr, field, (base + offset) & mask)
+
+
+def write_header(path, offset, hdr):
+    with open(path, "r+b") as file:
+        file.seek(offset)
+        file.write(bytes(hdr))
+
+
+def repack_header(src, view, image, output, hdr, in_place):
+    if not in_place:
+        with open(output, "wb") as file:
+            copied = clone_file(src.fileno(), file.fileno(), len(view))
+            file.seek(copied)
+            file.write(view[copied:])
+    write_header(output, image.offset, hdr)
+
+
+def repack_sections(src, view, image, output, hdr, replaced, hashtype, mtk_names):
+    hasher = hashlib.new(hashtype) if hashtype else None
+    end = image.offset + bootimg.align(ctypes.sizeof(image.header), image.page_size)
+    with open(output, "wb") as file:
+        file.write(view[:image.offset])
+        writer = SectionWriter(file, image.page_size, hasher)
+        writer.reserve(ctypes.sizeof(hdr))
+        for name in bootimg.get_section_names(image):
+            section = image.section(name)
+            if section is not None:
+                end = max(end, section.offset + bootimg.align(section.size, image.page_size))
+            if isinstance(replaced.get(name), bytes):
+                # sections rebuilt in memory (ramdisk table, device tree blobs) are hashed like any other input
+                writer.update_hash(name, replaced[name])
+                size = writer.write_bytes(replaced[name])
+                writer.hash_size(size)
+            elif name in replaced:
+                size = writer.write_file(replaced[name], name, mtk_name=mtk_names.get(name))
+            elif section is not None:
+                size = writer.copy_section(src.fileno(), view, section.offset, section.size)
+            else:
+                size = 0
+                if hasher:
+                    hasher.update(struct.pack("<I", 0))
+            if name == "recovery_dtbo" and size:
+                hdr.recovery_dtbo_offset = writer.position - image.offset - bootimg.align(size, image.page_size)
+            setattr(hdr, bootimg.SIZE_FIELDS[name], size)
+        # anything stored behind the last section (signatures, footers) is carried over untouched
+        end = min(end, len(view))
+        if end < len(view):
+            writer.hasher = None
+            writer.copy_section(src.fileno(), view, end, len(view) - end)
+        writer.finish()
+
+    if hasher:
+        digest = hasher.digest()[:ctypes.sizeof(hdr.id)]
+        ctypes.memset(hdr.id, 0, ctypes.sizeof(hdr.id))
+        ctypes.memmove(hdr.id, digest, len(digest))
+    write_header(output, image.offset, hdr)
+
+
+def repack_image(src, view, image, output, changes):
+    if image.is_vendor and "ramdisk" in changes:
+        changes["vendor_ramdisk"] = changes.pop("ramdisk")
+    names = bootimg.get_section_names(image)
+    replaced = {}
+    for name in bootimg.SIZE_FIELDS:
+        if changes.get(name):
+            if name not in names:
+                raise ValueError("error: %s is not part of this image layout" % name)
+            replaced[name] = changes[name]
+    if "vendor_ramdisk" in replaced and image.header_version > 3 and image.header.vendor_ramdisk_table_entry_num:
+        if image.header.vendor_ramdisk_table_entry_num > 1:
+            raise ValueError("error: a fragmented vendor ramdisk cannot be replaced in an incremental repack")
+        table = image.section("vendor_ramdisk_table")
+        entry = bootimg.read_struct(view, table.offset, bootimg.VendorRamdiskTableEntryV4)
+        entry.ramdisk_size = os.path.getsize(sectionstore.resolve(replaced["vendor_ramdisk"]))
+        replaced["vendor_ramdisk_table"] = bytes(entry) + bytes(
+            view[table.offset + ctypes.sizeof(entry):table.offset + table.size])
+
+    mtk_names = {}
+    for name in bootimg.MTK_SECTIONS:
+        if changes.get("mtk_" + name):
+            if name not in replaced or image.is_vendor:
+                raise ValueError("error: --mtk_%s needs a replacement %s" % (name, name))
+            mtk_names[name] = changes["mtk_" + name]
+
+    hdr = type(image.header).from_buffer_copy(image.header)
+    update_header(image, hdr, changes)
+
+    has_id = bool(bootimg.get_id_sections(image))
+    hashtype = None
+    if has_id:
+        hashtype = changes.get("hashtype", bootimg.get_hash_type(image.header))
+        if hashtype not in HASH_TYPES:
+            raise ValueError("error: unknown hash algorithm '%s'" % hashtype)
+        if not replaced and hashtype == bootimg.get_hash_type(image.header):
+            hashtype = None
+
+    in_place = os.path.exists(output) and os.path.samefile(src.name, output)
+    if not replaced and hashtype is None:
+        # header fields are not covered by the boot id, so the body is reused as is
+        repack_header(src, view, image, output, hdr, in_place)
+        return bytes(hdr.id) if has_id else None
+
+    target = output + ".repack" if in_place else output
+    try:
+        repack_sections(src, view, image, target, hdr, replaced, hashtype, mtk_names)
+    except (ValueError, OSError):
+        if os.path.exists(target):
+            os.unlink(target)
+        raise
+    if in_place:
+        os.replace(target, output)
+    return bytes(hdr.id) if has_id else None
+
+
+def repack(source, output, changes):
+    if output is None:
+        raise ValueError("error: no output filename specified")
+    changes = get_repack_changes(changes)
+    with open(source, "rb") as src:
+        if os.fstat(src.fileno()).st_size == 0:
+            raise ValueError("error: " + source + " is empty")
+        with mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                return repack_image(src, view, bootimg.parse_image(mapped), output, changes)
+            finally:
+                view.release()
+
+
+def usage():
+    return """mkbootimg.py
+    [ --kernel <filename> ]
+    [ --ramdisk <filename> | --vendor_ramdisk <filename> ]
+    [ --second <filename> ]
+    [ --dtb <filename> ]
+    [ --recovery_dtbo <filename> | --recovery_acpio <filename> ]
+    [ --dt <filename> ]
+    [ --cmdline <command line> | --vendor_cmdline <command line> ]
+    [ --base <address> ]
+    [ --kernel_offset <base offset> ]
+    [ --ramdisk_offset <base offset> ]
+    [ --second_offset <base offset> ]
+    [ --tags_offset <base offset> ]
+    [ --dtb_offset <base offset> ]
+    [ --os_version <A.B.C version> ]
+    [ --os_patch_level <YYYY-MM-DD date> ]
+    [ --board <board name> ]
+    [ --pagesize <pagesize> ]
+    [ --header_version <version number> ]
+    [ --hashtype <sha1(default)|sha256> ]
+    [ --id ]
+    [ --repack <image> ]
+    [ --ramdisk_type <none|platform|recovery|dlkm> ]
+    [ --ramdisk_name <name> ]
+    [ --board_id<0-15> <value> ]
+    [ --vendor_ramdisk_fragment <filename> ]
+    [ --vendor_bootconfig <filename> ]
+    [ --mtk_kernel <name> ]
+    [ --mtk_ramdisk <name> ]
+    [ --trace <filename> [ --trace_format <json|chrome> ] [ --profile ] [ --tracemalloc ] ]
+    -o|--output <filename> | --vendor_boot <filename>
+    Addresses and offsets are hex with or without 0x, as in mkbootimg.c.
+    --repack rewrites only the header and the sections given; everything else is reused from <image>.
+    --ramdisk_type, --ramdisk_name and --board_id<N> apply to the next --vendor_ramdisk_fragment.
+    Section store stubs written by unmkbootimg.py -store are read from the store they name.
+    --mtk_kernel and --mtk_ramdisk wrap the kernel or ramdisk in a MediaTek header with that name, e.g. KERNEL
+    and ROOTFS."""
+
+
+def get_parser(defaults=True):
+    # without defaults every option not given stays None, which is how --repack tells what to change
+    parser = ArgumentParser(prog="mkbootimg.py", usage=usage(), allow_abbrev=False,
+                            formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument("-o", "--output", default=None)
+    parser.add_argument("--vendor_boot", default=None)
+    parser.add_argument("--kernel", default=None)
+    parser.add_argument("--ramdisk", default=None)
+    parser.add_argument("--vendor_ramdisk", default=None)
+    parser.add_argument("--second", default=None)
+    parser.add_argument("--dtb", default=None)
+    parser.add_argument("--recovery_dtbo", "--recovery_acpio", dest="recovery_dtbo", default=None)
+    parser.add_argument("--dt", default=None)
+    parser.add_argument("--cmdline", default=None)
+    parser.add_argument("--vendor_cmdline", default=None)
+    parser.add_argument("--base", default=0x10000000, type=parse_int)
+    parser.add_argument("--kernel_offset", default=0x00008000, type=parse_int)
+    parser.add_argument("--ramdisk_offset", default=0x01000000, type=parse_int)
+    parser.add_argument("--second_offset", default=0x00f00000, type=parse_int)
+    parser.add_argument("--tags_offset", default=0x00000100, type=parse_int)
+    parser.add_argument("--dtb_offset", default=0x01f00000, type=parse_int)
+    parser.add_argument("--os_version", default=0, type=parse_os_version)
+    parser.add_argument("--os_patch_level", default=0, type=parse_os_patch_level)
+    parser.add_argument("--board", default="")
+    parser.add_argument("--pagesize", default=2048, type=int)
+    parser.add_argument("--header_version", default=0, type=int)
+    parser.add_argument("--hashtype", default="sha1")
+    parser.add_argument("--id", default=False, action="store_true")
+    parser.add_argument("--repack", default=None)
+    parser.add_argument("--ramdisk_type", default=None, type=parse_ramdisk_type)
+    parser.add_argument("--ramdisk_name", default=None)
+    for index in range(bootimg.VENDOR_RAMDISK_TABLE_ENTRY_BOARD_ID_SIZE):
+        parser.add_argument("--board_id%d" % index, default=None, type=parse_int)
+    parser.add_argument("--vendor_ramdisk_fragment", dest="vendor_ramdisk_fragments", default=None,
+                        action=FragmentAction)
+    parser.add_argument("--vendor_bootconfig", default=None)
+    parser.add_argument("--mtk_kernel", default=None)
+    parser.add_argument("--mtk_ramdisk", default=None)
+    instrument.add_arguments(parser, "--", "_")
+    if not defaults:
+        parser.set_defaults(**dict.fromkeys(vars(parser.parse_args([]))))
+    return parser
+
+
+def get_repack_options(argv=None):
+    args = vars(get_parser(False).parse_args(argv))
+    return {name: value for name, value in args.items()
+            if value is not None and name not in ("output", "vendor_boot", "repack", "id") + instrument.OPTION_NAMES}
+
+
+def get_pack_options(args):
+    options = vars(args).copy()
+    options["vendor_boot"] = False
+    if args.vendor_boot:
+        options["vendor_boot"] = True
+        options["output"] = args.vendor_boot
+    if args.vendor_ramdisk:
+        options["vendor_boot"] = True
+        options["ramdisk"] = args.vendor_ramdisk
+    if args.vendor_cmdline is not None:
+        options["vendor_boot"] = True
+        options["cmdline"] = args.vendor_cmdline
+    if args.vendor_ramdisk_fragments or args.vendor_bootconfig:
+        options["vendor_boot"] = True
+    if options["cmdline"] is None:
+        options["cmdline"] = ""
+    return options
+
+
+def get_input_path(value, name, directory):
+    if value is None:
+        return None
+    if value.startswith("<") and value.endswith(">"):
+        raise ValueError(name + " need to be manually configured!!!")
+    return os.path.join(directory, value)
+
+
+def resolve_input_paths(options, directory):
+    for name in ("kernel", "ramdisk", "second", "dtb", "recovery_dtbo", "dt", "vendor_bootconfig"):
+        options[name] = get_input_path(options[name], name, directory)
+    for fragment in options["vendor_ramdisk_fragments"] or []:
+        fragment["path"] = get_input_path(fragment["path"], "vendor_ramdisk_fragment", directory)
+    return options
+
+
+def pack_arguments(arguments, output, directory=".", inputs=None):
+    # arguments are typed option values keyed by get_parser dest, as get_mkbootimg_settings.CommandPacket hands over
+    args = get_parser().parse_args([])
+    for name, value in arguments.items():
+        setattr(args, name, value)
+    args.output = output
+    return pack(resolve_input_paths(get_pack_options(args), directory), inputs)
+
+
+def pack_argv(argv, output, directory=".", inputs=None):
+    # argv is a mkbootimg.py command line without the output; input paths are relative to directory
+    try:
+        args = get_parser().parse_args(list(argv) + ["-o", output])
+    except SystemExit:
+        raise ValueError("error: invalid mkbootimg.py arguments for " + output)
+    if args.repack:
+        raise ValueError("error: --repack cannot be part of a pack manifest")
+    return pack(resolve_input_paths(get_pack_options(args), directory), inputs)
+
+
+def print_id(id_bytes):
+    print("0x" + id_bytes.hex())
+
+
+def main():
+    args = get_parser().parse_args()
+    instrument.start_from_arguments(args)
+    options = get_pack_options(args)
+    try:
+        if options["repack"]:
+            id_bytes = repack(options["repack"], options["output"], get_repack_options())
+        else:
+            id_bytes = pack(options)
+    except ValueError as error:
+        print(error, file=sys.stderr)
+        sys.exit(1)
+    except OSError as error:
+        print("error: failed writing '%s': %s" % (options["output"], error.strerror), file=sys.stderr)
+        sys.exit(1)
+
+    if options["id"] and id_bytes is not None:
+        print_id(id_bytes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+import json
+import os
+import sys
+import time
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import instrument
+import mkbootimg
+from get_mkbootimg_settings import PackArgument, parse, section_arguments
+
+JOBS = os.cpu_count() or 4
+
+
+def usage():
+    return """multipack.py
+        -m: pack manifest, a JSON list with one entry per output image:
+            {"output": "out/boot.img", "argv": ["--kernel", "Image.gz", "--ramdisk", "ramdisk.cpio.gz", ...]}
+            {"output": "out/vendor_boot.img", "from": "unpacked/vendor_boot", "overrides": {"vendor_cmdline": "..."}}
+            argv is a mkbootimg.py command line without -o; from is anything get_mkbootimg_settings.py -path takes,
+            packed with its pack command and the overrides applied. Relative paths are taken from the manifest
+            directory, input paths in argv as well.
+        -jobs: images packed at the same time (default: all cores)
+        -json: print one JSON line per image
+        Every distinct input is read once for the whole manifest, and images that start with the same inputs
+        share the boot id hash work for them.""" + instrument.usage()
+
+
+def parse_arguments():
+    parser = ArgumentParser(formatter_class=RawDescriptionHelpFormatter, epilog=usage())
+    parser.add_argument("-m", required=True)
+    parser.add_argument("-jobs", required=False, default=JOBS, type=int)
+    parser.add_argument("-json", required=False, default=False, action="store_true")
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    return args
+
+
+def read_manifest(path):
+    try:
+        with open(path) as file:
+            entries = json.load(file)
+    except json.JSONDecodeError as error:
+        raise ValueError(path + " is not valid JSON: " + str(error))
+    if not isinstance(entries, list):
+        raise ValueError(path + " must hold a list of outputs")
+    root = os.path.dirname(os.path.abspath(path))
+    outputs = set()
+    for index, entry in enumerate(entries):
+        if not isinstance(entry, dict) or not entry.get("output"):
+            raise ValueError("manifest entry %d has no output" % index)
+        if ("argv" in entry) == ("from" in entry):
+            raise ValueError("manifest entry %d needs either argv or from" % index)
+        overrides = entry.get("overrides") or {}
+        if not isinstance(overrides, dict):
+            raise ValueError("manifest entry %d overrides must be an object" % index)
+        for name in overrides:
+            if name not in PackArgument.__members__:
+                raise ValueError("manifest entry %d has unknown override '%s'" % (index, name))
+        output = os.path.normpath(os.path.join(root, entry["output"]))
+        if output in outputs:
+            raise ValueError(entry["output"] + " is packed more than once")
+        outputs.add(output)
+    return root, entries
+
+
+def get_overrides(root, overrides):
+    # override files are named relative to the manifest, while the rest of the command is relative to from
+    result = {}
+    for name, value in overrides.items():
+        argument = PackArgument[name]
+        if argument in section_arguments and isinstance(value, str):
+            value = os.path.join(root, value)
+        elif argument == PackArgument.vendor_ramdisk_fragments:
+            value = [(ramdisk_type, fragment_name, board_id, os.path.join(root, path))
+                     for ramdisk_type, fragment_name, board_id, path in value]
+        result[argument] = value
+    return result
+
+
+def pack_entry(root, entry, inputs):
+    output = os.path.join(root, entry["output"])
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with instrument.span("multipack_output", output=entry["output"]):
+        if "argv" in entry:
+            return mkbootimg.pack_argv(entry["argv"], output, root, inputs)
+        path = os.path.join(root, entry["from"])
+        packet = parse(path, False, get_overrides(root, entry.get("overrides") or {}) or None)
+        directory = path if os.path.isdir(path) else os.path.dirname(path)
+        return packet.pack(output, directory, inputs)
+
+
+def run_entry(root, entry, inputs):
+    record = {"output": entry["output"], "status": "ok"}
+    start = time.perf_counter()
+    try:
+        id_bytes = pack_entry(root, entry, inputs)
+        if id_bytes is not None:
+            record["id"] = id_bytes.hex()
+    except (OSError, ValueError, KeyError) as error:
+        record = {**record, "status": "error", "error": str(error)}
+    record["seconds"] = time.perf_counter() - start
+    return record
+
+
+def multi_pack(path, jobs=JOBS, report=None):
+    root, entries = read_manifest(path)
+    inputs = mkbootimg.PackInputs()
+    records = []
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(jobs, len(entries)))) as executor:
+            futures = [executor.submit(run_entry, root, entry, inputs) for entry in entries]
+            for future in as_completed(futures):
+                record = future.result()
+                if report:
+                    report(record)
+                records.append(record)
+    finally:
+        inputs.close()
+    return records
+
+
+def print_result(record):
+    if record["status"] == "error":
+        print("ERROR " + record["output"] + ": " + record["error"])
+    else:
+        print("OK " + record["output"])
+
+
+def main():
+    args = parse_arguments()
+    instrument.start_from_arguments(args)
+    if args.jobs < 1:
+        print("-jobs must be positive")
+        quit()
+
+    try:
+        records = multi_pack(args.m, args.jobs,
+                             (lambda record: print(json.dumps(record), flush=True)) if args.json else print_result)
+    except (OSError, ValueError) as error:
+        print(error)
+        quit()
+    sys.exit(1 if any(record["status"] == "error" for record in records) else 0)
+
+
+if __name__ == '__main__':
+    main()
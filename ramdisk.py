@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+import lzma
+import shutil
+import struct
+import subprocess
+import threading
+import zlib
+
+import instrument
+
+CHUNK_SIZE = 1024 * 1024
+
+GZIP_MAGIC = b"\x1f\x8b"
+LZ4_LEGACY_MAGIC = b"\x02\x21\x4c\x18"
+XZ_MAGIC = b"\xfd7zXZ\x00"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+LZMA_MAGIC = b"\x5d\x00\x00"
+CPIO_MAGICS = (b"070701", b"070702")
+
+LZ4_LEGACY_BLOCK_SIZE = 8 * 1024 * 1024  # every legacy block but the last inflates to exactly this
+CPIO_HEADER_SIZE = 110
+CPIO_TRAILER = "TRAILER!!!"
+
+S_IFMT = 0o170000
+S_IFDIR = 0o040000
+S_IFLNK = 0o120000
+
+
+class CpioEntry:
+    __slots__ = ("name", "mode", "size", "offset")
+
+    def __init__(self, name, mode, size, offset):
+        self.name = name
+        self.mode = mode
+        self.size = size
+        self.offset = offset  # of the file data within the decompressed archive
+
+    @property
+    def is_dir(self):
+        return self.mode & S_IFMT == S_IFDIR
+
+    @property
+    def is_symlink(self):
+        return self.mode & S_IFMT == S_IFLNK
+
+
+def get_compression(data):
+    head = bytes(data[:6])
+    if head.startswith(GZIP_MAGIC):
+        return "gzip"
+    if head.startswith(LZ4_LEGACY_MAGIC):
+        return "lz4"
+    if head.startswith(XZ_MAGIC):
+        return "xz"
+    if head.startswith(ZSTD_MAGIC):
+        return "zstd"
+    if head.startswith(LZMA_MAGIC):
+        return "lzma"
+    if head in CPIO_MAGICS:
+        return "none"
+    return None
+
+
+def inflate_gzip(view):
+    # concatenated members are followed until the zero padding the packer leaves behind
+    position = 0
+    while view[position:position + 2] == GZIP_MAGIC:
+        decompressor = zlib.decompressobj(31)
+        while not decompressor.eof and position < len(view):
+            data = view[position:position + CHUNK_SIZE]
+            position += len(data)
+            yield decompressor.decompress(data, CHUNK_SIZE)
+            while decompressor.unconsumed_tail and not decompressor.eof:
+                yield decompressor.decompress(decompressor.unconsumed_tail, CHUNK_SIZE)
+        if not decompressor.eof:
+            raise ValueError("gzip ramdisk is truncated")
+        position -= len(decompressor.unused_data)
+
+
+def inflate_lzma(view, magic, fmt):
+    position = 0
+    while view[position:position + len(magic)] == magic:
+        decompressor = lzma.LZMADecompressor(fmt)
+        while not decompressor.eof:
+            data = b""
+            if decompressor.needs_input:
+                if position >= len(view):
+                    raise ValueError("lzma ramdisk is truncated")
+                data = view[position:position + CHUNK_SIZE]
+                position += len(data)
+            yield decompressor.decompress(data, CHUNK_SIZE)
+        position -= len(decompressor.unused_data)
+
+
+def inflate_lz4_legacy(view):
+    import lz4.block
+    position = 0
+    while position + 4 <= len(view):
+        if view[position:position + 4] == LZ4_LEGACY_MAGIC:
+            position += 4
+            continue
+        size, = struct.unpack_from("<I", view, position)
+        position += 4
+        if size == 0 or position + size > len(view):
+            break
+        yield lz4.block.decompress(view[position:position + size], uncompressed_size=LZ4_LEGACY_BLOCK_SIZE)
+        position += size
+
+
+def inflate_zstd(view):
+    import zstandard
+    decompressor = zstandard.ZstdDecompressor()
+    yield from decompressor.read_to_iter(memoryview(view), read_size=CHUNK_SIZE, write_size=CHUNK_SIZE)
+
+
+def inflate_command(argv, view):
+    # streams through the command line tool when the python binding is not installed
+    if shutil.which(argv[0]) is None:
+        raise ValueError(argv[0] + " is needed to decompress this ramdisk")
+    process = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def feed():
+        try:
+            for position in range(0, len(view), CHUNK_SIZE):
+                process.stdin.write(view[position:position + CHUNK_SIZE])
+        except (BrokenPipeError, ValueError):
+            pass
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    produced = 0
+    try:
+        while True:
+            data = process.stdout.read(CHUNK_SIZE)
+            if not data:
+                break
+            produced += len(data)
+            yield data
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.stdout.close()
+        process.wait()
+        feeder.join()
+    # the tools complain about the zero padding behind the last frame, so only an empty result is fatal
+    if process.returncode != 0 and not produced:
+        raise ValueError(argv[0] + " failed to decompress the ramdisk")
+
+
+def get_decompressor(compression):
+    match compression:
+        case "gzip":
+            return inflate_gzip
+        case "xz":
+            return lambda view: inflate_lzma(view, XZ_MAGIC, lzma.FORMAT_XZ)
+        case "lzma":
+            return lambda view: inflate_lzma(view, LZMA_MAGIC, lzma.FORMAT_ALONE)
+        case "lz4":
+            try:
+                import lz4.block  # noqa: F401
+                return inflate_lz4_legacy
+            except ImportError:
+                return lambda view: inflate_command(["lz4", "-dc"], view)
+        case "zstd":
+            try:
+                import zstandard  # noqa: F401
+                return inflate_zstd
+            except ImportError:
+                return lambda view: inflate_command(["zstd", "-dcq"], view)
+        case "none":
+            return lambda view: iter((view,))
+    raise ValueError("unknown ramdisk compression")
+
+
+class RamdiskStream:
+    # forward-only reader over decompressed chunks; skipped data is dropped without being joined
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buffer = memoryview(b"")
+        self.position = 0
+
+    def fill(self):
+        while not self.buffer:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return False
+            self.buffer = memoryview(chunk)
+        return True
+
+    def read(self, size):
+        parts = []
+        while size > 0 and self.fill():
+            part = self.buffer[:size]
+            self.buffer = self.buffer[len(part):]
+            self.position += len(part)
+            size -= len(part)
+            parts.append(part)
+        return b"".join(parts)
+
+    def skip(self, size):
+        while size > 0 and self.fill():
+            skipped = min(size, len(self.buffer))
+            self.buffer = self.buffer[skipped:]
+            self.position += skipped
+            size -= skipped
+        if size:
+            raise ValueError("ramdisk ends inside an archive entry")
+
+    def seek(self, offset):
+        if offset < self.position:
+            raise ValueError("ramdisk streams cannot seek backwards")
+        self.skip(offset - self.position)
+
+    def close(self):
+        close = getattr(self.chunks, "close", None)
+        if close is not None:
+            close()
+
+
+def open_ramdisk(view):
+    compression = get_compression(view)
+    if compression is None:
+        raise ValueError("ramdisk is neither a cpio archive nor a known compressed format")
+    return RamdiskStream(iter(get_decompressor(compression)(view)))
+
+
+def read_cpio_entry(stream):
+    # returns None once the stream holds nothing but padding
+    header = stream.read(CPIO_HEADER_SIZE)
+    while header and not header.strip(b"\0"):
+        header = stream.read(CPIO_HEADER_SIZE)
+    if not header:
+        return None
+    start = header.find(b"07070")
+    if start > 0:
+        # concatenated archives are only padded to four bytes, so realign onto the next magic
+        header = header[start:] + stream.read(start)
+    if len(header) < CPIO_HEADER_SIZE or header[:6] not in CPIO_MAGICS:
+        raise ValueError("bad cpio header at offset %d" % (stream.position - len(header)))
+    fields = [int(header[position:position + 8], 16) for position in range(6, CPIO_HEADER_SIZE, 8)]
+    mode, size, namesize = fields[1], fields[6], fields[11]
+    name = stream.read(namesize)[:-1].decode(errors="surrogateescape")
+    stream.skip((4 - (CPIO_HEADER_SIZE + namesize) % 4) % 4)
+    return CpioEntry(name, mode, size, stream.position)
+
+
+def iter_cpio(stream):
+    while True:
+        entry = read_cpio_entry(stream)
+        if entry is None:
+            return
+        if entry.name != CPIO_TRAILER:
+            yield entry
+        stream.skip(entry.size + (4 - entry.size % 4) % 4)
+
+
+def index_ramdisk(view):
+    stream = open_ramdisk(view)
+    try:
+        with instrument.span("ramdisk_index"):
+            return list(iter_cpio(stream))
+    finally:
+        instrument.count("bytes_inflated", stream.position)
+        stream.close()
+
+
+def read_entry(view, entry):
+    if get_compression(view) == "none":
+        return view[entry.offset:entry.offset + entry.size]
+    stream = open_ramdisk(view)
+    try:
+        stream.seek(entry.offset)
+        return stream.read(entry.size)
+    finally:
+        stream.close()
+
+
+def extract_file(view, name):
+    # stops decompressing as soon as the entry has been read
+    name = name.lstrip("/")
+    stream = open_ramdisk(view)
+    try:
+        for entry in iter_cpio(stream):
+            if entry.name == name:
+                return entry, stream.read(entry.size)
+    finally:
+        stream.close()
+    raise ValueError(name + " is not in the ramdisk")
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+import hashlib
+import os
+import tempfile
+
+import bootimg
+import instrument
+
+# Sections are stored once under their digest; unpack directories hardlink to the stored copy, or hold a one line
+# stub naming it where a hardlink cannot be made (another filesystem, no link support):
+#   #section-store sha256:<digest> <size> <store directory>
+# Every stub is also listed in the directory's stub index, so readers know which files to resolve without opening any.
+STUB_MAGIC = b"#section-store "
+STUB_INDEX = ".section-store-stubs"
+STUB_MAX = 4096  # anything larger is section data, never a stub
+HASH_TYPE = "sha256"
+CHUNK_SIZE = 1024 * 1024
+
+
+def get_object_path(directory, digest):
+    return os.path.join(directory, "objects", digest[:2], digest)
+
+
+class SectionStore:
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.temp = os.path.join(self.directory, "tmp")
+        os.makedirs(os.path.join(self.directory, "objects"), exist_ok=True)
+        os.makedirs(self.temp, exist_ok=True)
+
+    def hash_range(self, view, offset, size):
+        hasher = hashlib.new(HASH_TYPE)
+        with instrument.span("store_hashing", size=size):
+            for start in range(offset, offset + size, CHUNK_SIZE):
+                hasher.update(view[start:min(start + CHUNK_SIZE, offset + size)])
+        instrument.count("bytes_hashed", size)
+        return hasher.hexdigest()
+
+    def add(self, src_fd, view, offset, size):
+        # hashing only reads the image, so a section already stored costs no write at all
+        digest = self.hash_range(view, offset, size)
+        target = get_object_path(self.directory, digest)
+        if os.path.exists(target):
+            instrument.count("bytes_deduplicated", size)
+            return digest
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=self.temp)
+        try:
+            done = bootimg.copy_range(src_fd, fd, offset, size) if src_fd is not None else 0
+            os.lseek(fd, done, os.SEEK_SET)
+            for start in range(offset + done, offset + size, CHUNK_SIZE):
+                data = view[start:min(start + CHUNK_SIZE, offset + size)]
+                while data:
+                    data = data[os.write(fd, data):]
+            # stored copies are shared by every directory linking to them, so they are never written in place
+            os.fchmod(fd, 0o444)
+            os.close(fd)
+            fd = None
+            try:
+                os.link(temp, target)
+                instrument.count("bytes_stored", size)
+            except FileExistsError:
+                # another writer stored the same section first
+                instrument.count("bytes_deduplicated", size)
+        finally:
+            if fd is not None:
+                os.close(fd)
+            os.unlink(temp)
+        return digest
+
+    def link(self, digest, size, path):
+        if os.path.lexists(path):
+            os.unlink(path)
+        try:
+            os.link(get_object_path(self.directory, digest), path)
+        except OSError:
+            with open(path, "w") as file:
+                file.write("%s%s:%s %d %s\n" % (STUB_MAGIC.decode(), HASH_TYPE, digest, size, self.directory))
+            # one short append per stub, so sections linked from several threads do not garble the index
+            with open(os.path.join(os.path.dirname(path), STUB_INDEX), "a") as file:
+                file.write(os.path.basename(path) + "\n")
+
+    def write_section(self, src_fd, view, section, path):
+        digest = self.add(src_fd, view, section.offset, section.size)
+        self.link(digest, section.size, path)
+        return digest
+
+
+def read_stub(path):
+    # returns (store directory, digest, size) for a stub and None for any other file
+    try:
+        if os.path.getsize(path) > STUB_MAX:
+            return None
+        with open(path, "rb") as file:
+            line = file.read(STUB_MAX)
+    except OSError:
+        return None
+    if not line.startswith(STUB_MAGIC):
+        return None
+    try:
+        digest, size, directory = line[len(STUB_MAGIC):].decode().rstrip("\n").split(" ", 2)
+        return directory, digest.partition(":")[2], int(size)
+    except ValueError:
+        raise ValueError(path + " is a malformed section store stub")
+
+
+def parse_stub_index(text):
+    return {name for name in text.splitlines() if name}
+
+
+def read_stub_names(directory):
+    try:
+        with open(os.path.join(directory, STUB_INDEX)) as file:
+            return parse_stub_index(file.read())
+    except FileNotFoundError:
+        return set()
+
+
+def resolve(path):
+    # a stub stands for the stored section it names; every other path is returned as is
+    stub = read_stub(path)
+    if stub is None:
+        return path
+    directory, digest, size = stub
+    target = get_object_path(directory, digest)
+    if not os.path.isfile(target) or os.path.getsize(target) != size:
+        raise ValueError(path + " refers to section " + digest + " which is missing from " + directory)
+    return target
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+import bisect
+import io
+import os
+import struct
+import tarfile
+import threading
+import zipfile
+
+# Images inside containers are named with "!" between the container and the member, and containers nest:
+#   ota.zip!boot.img   firmware.tar!images/vendor_boot.img   super.img!boot_a   drop.zip!super.img!vendor_boot_a
+# Android sparse images are expanded wherever they appear, including as a plain path.
+MEMBER_SEPARATOR = "!"
+
+SPARSE_MAGIC = 0xed26ff3a
+SPARSE_HEADER = struct.Struct("<IHHHHIIII")
+SPARSE_CHUNK_HEADER = struct.Struct("<HHII")
+CHUNK_TYPE_RAW = 0xcac1
+CHUNK_TYPE_FILL = 0xcac2
+CHUNK_TYPE_DONT_CARE = 0xcac3
+CHUNK_TYPE_CRC32 = 0xcac4
+
+LP_PARTITION_RESERVED_BYTES = 4096
+LP_METADATA_GEOMETRY_SIZE = 4096
+LP_METADATA_GEOMETRY_MAGIC = 0x616c4467
+LP_METADATA_HEADER_MAGIC = 0x414c5030
+LP_SECTOR_SIZE = 512
+LP_TARGET_TYPE_LINEAR = 0
+LP_TARGET_TYPE_ZERO = 1
+LP_GEOMETRY = struct.Struct("<II32sIII")
+LP_HEADER = struct.Struct("<IHHI32sI32s")
+LP_TABLE_DESCRIPTOR = struct.Struct("<III")
+LP_PARTITION = struct.Struct("<36sIIII")
+LP_EXTENT = struct.Struct("<QIQI")
+
+ZIP_MAGIC = b"PK\x03\x04"
+READ_SIZE = 1024 * 1024
+TAR_MAGIC_OFFSET = 257
+
+EXTENT_DATA = 0
+EXTENT_FILL = 1
+EXTENT_ZERO = 2
+
+
+class Source:
+    # random access to the bytes of one image, wherever they are stored: subclasses set size and read_at
+
+    def close(self):
+        pass
+
+
+class FileSource(Source):
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDONLY)
+        self.size = os.fstat(self.fd).st_size
+
+    def read_at(self, offset, size):
+        parts = []
+        while size > 0:
+            data = os.pread(self.fd, size, offset)
+            if not data:
+                break
+            parts.append(data)
+            offset += len(data)
+            size -= len(data)
+        return b"".join(parts)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FileObjectSource(Source):
+    # archive members; deflated members decompress forward from wherever the last read stopped
+
+    def __init__(self, fileobj, size, archive, parent):
+        self.fileobj = fileobj
+        self.size = size
+        self.archive = archive
+        self.parent = parent
+        self.lock = threading.Lock()
+
+    def read_at(self, offset, size):
+        with self.lock:
+            self.fileobj.seek(offset)
+            return self.fileobj.read(size)
+
+    def close(self):
+        self.fileobj.close()
+        self.archive.close()
+        self.parent.close()
+
+
+class ExtentSource(Source):
+    # sparse images and super partitions are both a map of extents onto a parent source
+
+    def __init__(self, parent, size, extents):
+        self.parent = parent
+        self.size = size
+        self.extents = extents
+        self.starts = [extent[0] for extent in extents]
+
+    def read_at(self, offset, size):
+        size = max(0, min(size, self.size - offset))
+        parts = []
+        index = bisect.bisect_right(self.starts, offset) - 1
+        while size > 0 and 0 <= index < len(self.extents):
+            start, length, kind, value = self.extents[index]
+            skip = offset - start
+            count = min(size, length - skip)
+            if kind == EXTENT_DATA:
+                parts.append(self.parent.read_at(value + skip, count))
+            elif kind == EXTENT_FILL:
+                pattern = value * ((skip % 4 + count) // 4 + 2)
+                parts.append(pattern[skip % 4:skip % 4 + count])
+            else:
+                parts.append(bytes(count))
+            offset += count
+            size -= count
+            index += 1
+        return b"".join(parts)
+
+    def close(self):
+        self.parent.close()
+
+
+class SourceFile(io.RawIOBase):
+    # file object over a source, for code that reads with seek() and read()
+
+    def __init__(self, source):
+        self.source = source
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.source.size
+        self.position = offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, buffer):
+        data = self.source.read_at(self.position, len(buffer))
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+class SourceView:
+    # sliced like the mapped image the unpacker normally works on; only the slices taken are read
+
+    def __init__(self, source):
+        self.source = source
+
+    def __len__(self):
+        return self.source.size
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.source.size)
+            return memoryview(self.source.read_at(start, max(0, stop - start)))
+        if key < 0:
+            key += self.source.size
+        return self.source.read_at(key, 1)[0]
+
+    def release(self):
+        pass
+
+    def close(self):
+        self.source.close()
+
+
+def is_sparse(source):
+    header = source.read_at(0, 4)
+    return len(header) == 4 and struct.unpack("<I", header)[0] == SPARSE_MAGIC
+
+
+def is_super(source):
+    geometry = source.read_at(LP_PARTITION_RESERVED_BYTES, 4)
+    return len(geometry) == 4 and struct.unpack("<I", geometry)[0] == LP_METADATA_GEOMETRY_MAGIC
+
+
+def is_tar(source):
+    return source.read_at(TAR_MAGIC_OFFSET, 5) == b"ustar"
+
+
+def open_sparse(parent):
+    magic, major, minor, file_header_size, chunk_header_size, block_size, total_blocks, total_chunks, checksum = \
+        SPARSE_HEADER.unpack(parent.read_at(0, SPARSE_HEADER.size))
+    if major != 1:
+        raise ValueError("sparse image version %d is not supported" % major)
+    extents = []
+    offset = file_header_size
+    position = 0
+    for index in range(total_chunks):
+        chunk_type, reserved, chunk_blocks, total_size = SPARSE_CHUNK_HEADER.unpack(
+            parent.read_at(offset, SPARSE_CHUNK_HEADER.size))
+        data = offset + chunk_header_size
+        length = chunk_blocks * block_size
+        if chunk_type == CHUNK_TYPE_RAW:
+            extents.append((position, length, EXTENT_DATA, data))
+        elif chunk_type == CHUNK_TYPE_FILL:
+            extents.append((position, length, EXTENT_FILL, parent.read_at(data, 4)))
+        elif chunk_type == CHUNK_TYPE_DONT_CARE:
+            extents.append((position, length, EXTENT_ZERO, None))
+        elif chunk_type == CHUNK_TYPE_CRC32:
+            length = 0
+        else:
+            raise ValueError("sparse chunk %d has unknown type 0x%x" % (index, chunk_type))
+        position += length
+        offset += total_size
+    if position != total_blocks * block_size:
+        raise ValueError("sparse image chunks do not add up to its size")
+    return ExtentSource(parent, position, [extent for extent in extents if extent[1]])
+
+
+def read_super_partitions(source):
+    geometry = LP_GEOMETRY.unpack(source.read_at(LP_PARTITION_RESERVED_BYTES, LP_GEOMETRY.size))
+    metadata_offset = LP_PARTITION_RESERVED_BYTES + 2 * LP_METADATA_GEOMETRY_SIZE
+    header = source.read_at(metadata_offset, LP_HEADER.size + 4 * LP_TABLE_DESCRIPTOR.size)
+    magic, major, minor, header_size, header_checksum, tables_size, tables_checksum = LP_HEADER.unpack_from(header)
+    if geometry[0] != LP_METADATA_GEOMETRY_MAGIC or magic != LP_METADATA_HEADER_MAGIC:
+        raise ValueError("super image metadata is malformed")
+    tables = source.read_at(metadata_offset + header_size, tables_size)
+    partitions, extents = [LP_TABLE_DESCRIPTOR.unpack_from(header, LP_HEADER.size + index * LP_TABLE_DESCRIPTOR.size)
+                           for index in range(2)]
+
+    partition_extents = {}
+    for index in range(partitions[1]):
+        name, attributes, first_extent, extent_count, group = LP_PARTITION.unpack_from(
+            tables, partitions[0] + index * partitions[2])
+        mapped = []
+        position = 0
+        for extent_index in range(first_extent, first_extent + extent_count):
+            sectors, target_type, target_data, target_source = LP_EXTENT.unpack_from(
+                tables, extents[0] + extent_index * extents[2])
+            length = sectors * LP_SECTOR_SIZE
+            if target_type == LP_TARGET_TYPE_LINEAR:
+                if target_source != 0:
+                    raise ValueError("super partitions spanning several block devices are not supported")
+                mapped.append((position, length, EXTENT_DATA, target_data * LP_SECTOR_SIZE))
+            elif target_type == LP_TARGET_TYPE_ZERO:
+                mapped.append((position, length, EXTENT_ZERO, None))
+            position += length
+        partition_extents[name.rstrip(b"\0").decode(errors="replace")] = (position, mapped)
+    return partition_extents
+
+
+def open_super_partition(source, name):
+    partitions = read_super_partitions(source)
+    if name not in partitions:
+        raise ValueError("super image has no partition " + name + " (has " + ", ".join(sorted(partitions)) + ")")
+    size, extents = partitions[name]
+    return ExtentSource(source, size, extents)
+
+
+def open_member(source, name):
+    # the container type comes from its content, not from its name
+    if source.read_at(0, 4) == ZIP_MAGIC:
+        archive = zipfile.ZipFile(io.BufferedReader(SourceFile(source), READ_SIZE))
+        try:
+            info = archive.getinfo(name)
+        except KeyError:
+            archive.close()
+            raise ValueError("zip archive has no member " + name)
+        return FileObjectSource(archive.open(info), info.file_size, archive, source)
+    if is_super(source):
+        return open_super_partition(source, name)
+    if is_tar(source) or tarfile.is_tarfile(SourceFile(source)):
+        archive = tarfile.open(fileobj=io.BufferedReader(SourceFile(source), READ_SIZE), mode="r:*")
+        try:
+            member = archive.getmember(name)
+        except KeyError:
+            archive.close()
+            raise ValueError("tar archive has no member " + name)
+        if not member.isfile():
+            archive.close()
+            raise ValueError(name + " is not a regular file in the tar archive")
+        return FileObjectSource(archive.extractfile(member), member.size, archive, source)
+    raise ValueError("cannot open " + name + ": its container is not a zip, tar or super image")
+
+
+def needs_source(path):
+    # plain images keep the mapped fast path; only containers and sparse images go through sources
+    if os.path.exists(path):
+        if not os.path.isfile(path):
+            return False
+        with open(path, "rb") as file:
+            header = file.read(4)
+        return len(header) == 4 and struct.unpack("<I", header)[0] == SPARSE_MAGIC
+    return MEMBER_SEPARATOR in path
+
+
+def get_image_name(path):
+    return os.path.basename(path.split(MEMBER_SEPARATOR)[-1])
+
+
+def open_source(path):
+    parts = path.split(MEMBER_SEPARATOR)
+    while len(parts) > 1 and not os.path.isfile(parts[0]):
+        # the file name itself may contain the separator
+        parts[:2] = [parts[0] + MEMBER_SEPARATOR + parts[1]]
+    if not os.path.isfile(parts[0]):
+        raise ValueError(parts[0] + " is not a file.")
+    source = FileSource(parts[0])
+    try:
+        for name in [None] + parts[1:]:
+            if name is not None:
+                source = open_member(source, name)
+            if is_sparse(source):
+                source = open_sparse(source)
+    except (zipfile.BadZipFile, tarfile.TarError, struct.error, EOFError) as error:
+        source.close()
+        raise ValueError(path + ": " + str(error))
+    except (OSError, ValueError):
+        source.close()
+        raise
+    return source
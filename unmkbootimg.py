@@ -1,54 +1,376 @@
 #!/usr/bin/env python3
 
+import mmap
 import os
+from contextlib import contextmanager
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
-import ctypes
+
+import bootimg
+import instrument
+import ramdisk
+import sectionstore
+import sources
+
+CHUNK_SIZE = 1024 * 1024
 
 
 def usage():
-    print("""unmkbootimg.py
+    return """unmkbootimg.py
         -i: boot image
-        -o: output directory""")
+        -o: output directory
+        -seeklimit: bytes to search for the ANDROID!/VNDRBOOT magic (default 65536)
+        -offset: unpack the header found at this offset instead of the first one
+        -scan: list every header candidate found and exit
+        -list: list the files in the ramdisk of a boot image or of an unpacked ramdisk
+        -extract: pull one file out of the ramdisk into the output directory
+        -fragment: vendor ramdisk fragment (name, type or index) to list, extract from or unpack on its own
+        -mtk: strip MediaTek headers off the kernel and ramdisk; mkbootimg.py puts them back with --mtk_kernel
+        and --mtk_ramdisk
+        -store: keep sections once per content in this section store and hardlink them into the output directory
+        -i also takes members of zip, tar and super images as <container>!<member>, e.g. ota.zip!boot.img,
+        and reads Android sparse images directly""" + \
+        instrument.usage()
 
 
 def parse_arguments():
     parser = ArgumentParser(formatter_class=RawDescriptionHelpFormatter, epilog=usage())
     parser.add_argument("-i", required=True)
-    parser.add_argument("-o", required=True)
+    parser.add_argument("-o", required=False)
+    parser.add_argument("-seeklimit", required=False, default=bootimg.SEEK_LIMIT, type=lambda value: int(value, 0))
+    parser.add_argument("-offset", required=False, default=None, type=lambda value: int(value, 0))
+    parser.add_argument("-scan", required=False, default=False, action="store_true")
+    parser.add_argument("-list", required=False, default=False, action="store_true")
+    parser.add_argument("-extract", required=False, action="append", default=[])
+    parser.add_argument("-fragment", required=False, default=None)
+    parser.add_argument("-mtk", required=False, default=False, action="store_true")
+    parser.add_argument("-store", required=False, default=None)
+    instrument.add_arguments(parser)
     args = parser.parse_args()
     return args
 
 
+def write_string_to_file(prefix, name, string):
+    with open(prefix + name, "w") as file:
+        file.write(string + "\n")
+
+
+def write_section_to_file(prefix, fd, view, section, store=None):
+    # fd is None for images read through a source, which are copied chunk by chunk
+    if store is not None:
+        with instrument.span("section_io", section=section.name):
+            store.write_section(fd, view, section, prefix + section.name)
+        return
+    end = section.offset + section.size
+    with instrument.span("section_io", section=section.name), open(prefix + section.name, "wb") as file:
+        done = bootimg.copy_range(fd, file.fileno(), section.offset, section.size) if fd is not None else 0
+        for start in range(section.offset + done, end, CHUNK_SIZE):
+            file.write(view[start:min(start + CHUNK_SIZE, end)])
+    instrument.count("bytes_written", section.size)
+
+
+def get_offset(address, base, mask=0xffffffff):
+    return (address - base) & mask
+
+
+def write_settings(image, prefix, out=None):
+    header = image.header
+    cmdline = bootimg.get_cmdline(header)
+    print("%s magic found at: %d" % (image.magic.decode(), image.offset), file=out)
+
+    if image.is_vendor:
+        base = bootimg.get_base(header)
+        print("BOARD_VENDOR_CMDLINE " + cmdline, file=out)
+        print("BOARD_VENDOR_BASE 0x%08x" % base, file=out)
+        print("BOARD_NAME " + header.name.decode(errors="replace"), file=out)
+        print("BOARD_PAGE_SIZE %d" % header.page_size, file=out)
+        print("BOARD_KERNEL_OFFSET 0x%08x" % get_offset(header.kernel_addr, base), file=out)
+        print("BOARD_RAMDISK_OFFSET 0x%08x" % get_offset(header.ramdisk_addr, base), file=out)
+        print("BOARD_TAGS_OFFSET 0x%08x" % get_offset(header.tags_addr, base), file=out)
+        print("BOARD_HEADER_VERSION %d" % header.header_version, file=out)
+        print("BOARD_HEADER_SIZE %d" % header.header_size, file=out)
+        print("BOARD_DTB_SIZE %d" % header.dtb_size, file=out)
+        print("BOARD_DTB_OFFSET 0x%08x" % get_offset(header.dtb_addr, base, 0xffffffffffffffff), file=out)
+        if header.header_version > 3:
+            print("BOARD_BOOTCONFIG_SIZE %d" % header.bootconfig_size, file=out)
+
+        write_string_to_file(prefix, "vendor_cmdline", cmdline)
+        write_string_to_file(prefix, "board", header.name.decode(errors="replace"))
+        write_string_to_file(prefix, "base", "0x%08x" % base)
+        write_string_to_file(prefix, "pagesize", "%d" % header.page_size)
+        write_string_to_file(prefix, "kernel_offset", "0x%08x" % get_offset(header.kernel_addr, base))
+        write_string_to_file(prefix, "ramdisk_offset", "0x%08x" % get_offset(header.ramdisk_addr, base))
+        write_string_to_file(prefix, "tags_offset", "0x%08x" % get_offset(header.tags_addr, base))
+        write_string_to_file(prefix, "header_version", "%d\n" % header.header_version)
+        write_string_to_file(prefix, "dtb_offset", "0x%08x" % get_offset(header.dtb_addr, base, 0xffffffffffffffff))
+        return
+
+    os_version, os_patch_level = bootimg.decode_os_version(header.os_version)
+
+    if isinstance(header, bootimg.BootImgHdrV3):
+        # boot_img_hdr_v3 and above are no longer backwards compatible
+        print("BOARD_KERNEL_CMDLINE " + cmdline, file=out)
+        print("BOARD_PAGE_SIZE %d" % bootimg.BOOT_V3_PAGE_SIZE, file=out)
+        if os_version:
+            print("BOARD_OS_VERSION " + os_version, file=out)
+            print("BOARD_OS_PATCH_LEVEL " + os_patch_level, file=out)
+        print("BOARD_HEADER_VERSION %d" % header.header_version, file=out)
+        print("BOARD_HEADER_SIZE %d" % header.header_size, file=out)
+
+        write_string_to_file(prefix, "cmdline", cmdline)
+        if os_version:
+            write_string_to_file(prefix, "os_version", os_version)
+            write_string_to_file(prefix, "os_patch_level", os_patch_level)
+        write_string_to_file(prefix, "header_version", "%d\n" % header.header_version)
+        return
+
+    base = bootimg.get_base(header)
+    hash_type = bootimg.get_hash_type(header)
+    print("BOARD_KERNEL_CMDLINE " + cmdline, file=out)
+    print("BOARD_KERNEL_BASE 0x%08x" % base, file=out)
+    print("BOARD_NAME " + header.name.decode(errors="replace"), file=out)
+    print("BOARD_PAGE_SIZE %d" % header.page_size, file=out)
+    print("BOARD_HASH_TYPE " + hash_type, file=out)
+    print("BOARD_KERNEL_OFFSET 0x%08x" % get_offset(header.kernel_addr, base), file=out)
+    print("BOARD_RAMDISK_OFFSET 0x%08x" % get_offset(header.ramdisk_addr, base), file=out)
+    print("BOARD_SECOND_OFFSET 0x%08x" % get_offset(header.second_addr, base), file=out)
+    print("BOARD_TAGS_OFFSET 0x%08x" % get_offset(header.tags_addr, base), file=out)
+    if os_version:
+        print("BOARD_OS_VERSION " + os_version, file=out)
+        print("BOARD_OS_PATCH_LEVEL " + os_patch_level, file=out)
+    if image.is_legacy_dt:
+        print("BOARD_DT_SIZE %d" % header.dt_size, file=out)
+    else:
+        print("BOARD_HEADER_VERSION %d" % header.header_version, file=out)
+        if header.header_version > 0:
+            if header.recovery_dtbo_size != 0:
+                print("BOARD_RECOVERY_DTBO_SIZE %d" % header.recovery_dtbo_size, file=out)
+                print("BOARD_RECOVERY_DTBO_OFFSET %d" % header.recovery_dtbo_offset, file=out)
+            print("BOARD_HEADER_SIZE %d" % header.header_size, file=out)
+        if header.header_version > 1 and header.dtb_size != 0:
+            print("BOARD_DTB_SIZE %d" % header.dtb_size, file=out)
+            print("BOARD_DTB_OFFSET 0x%08x" % get_offset(header.dtb_addr, base, 0xffffffffffffffff), file=out)
+
+    write_string_to_file(prefix, "cmdline", cmdline)
+    write_string_to_file(prefix, "board", header.name.decode(errors="replace"))
+    write_string_to_file(prefix, "base", "0x%08x" % base)
+    write_string_to_file(prefix, "pagesize", "%d" % header.page_size)
+    write_string_to_file(prefix, "kernel_offset", "0x%08x" % get_offset(header.kernel_addr, base))
+    write_string_to_file(prefix, "ramdisk_offset", "0x%08x" % get_offset(header.ramdisk_addr, base))
+    write_string_to_file(prefix, "second_offset", "0x%08x" % get_offset(header.second_addr, base))
+    write_string_to_file(prefix, "tags_offset", "0x%08x" % get_offset(header.tags_addr, base))
+    if os_version:
+        write_string_to_file(prefix, "os_version", os_version)
+        write_string_to_file(prefix, "os_patch_level", os_patch_level)
+    if not image.is_legacy_dt:
+        write_string_to_file(prefix, "header_version", "%d\n" % header.header_version)
+        if header.header_version > 1:
+            write_string_to_file(prefix, "dtb_offset",
+                                 "0x%08x" % get_offset(header.dtb_addr, base, 0xffffffffffffffff))
+    write_string_to_file(prefix, "hashtype", hash_type)
+
+
+def get_mtk_sections(buf, image):
+    # returns the sections with stripped payloads swapped in, and the MTK header name of each stripped section
+    sections = []
+    names = {}
+    for section in image.sections:
+        if section.name in bootimg.MTK_SECTIONS and not image.is_vendor:
+            header, payload = bootimg.get_mtk_payload(buf, section)
+            if header is not None and bootimg.is_rebuildable_mtk_header(buf, section.offset, header):
+                names[section.name] = bootimg.get_mtk_name(header)
+                section = payload
+        sections.append(section)
+    return sections, names
+
+
+def write_mtk_settings(names, prefix, out=None):
+    for name, mtk_name in names.items():
+        print("BOARD_%s_MTK_NAME %s" % (name.upper(), mtk_name), file=out)
+        write_string_to_file(prefix, name + "_mtk", mtk_name)
+
+
+def map_image(file):
+    if os.fstat(file.fileno()).st_size == 0:
+        raise ValueError(file.name + " is empty.")
+    return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+@contextmanager
+def open_image(path):
+    # yields (fd, buf, view); containers and sparse images come through a source and have no fd
+    if sources.needs_source(path):
+        view = sources.SourceView(sources.open_source(path))
+        try:
+            yield None, view, view
+        finally:
+            view.close()
+        return
+    with open(path, "rb") as file:
+        with map_image(file) as mapped:
+            view = memoryview(mapped)
+            try:
+                yield file.fileno(), mapped, view
+            finally:
+                view.release()
+
+
+def scan(path, seeklimit=bootimg.SEEK_LIMIT):
+    with open_image(path) as (fd, buf, view):
+        candidates = bootimg.scan_image(buf, seeklimit)
+
+    for offset, magic, image in candidates:
+        if image is None:
+            print("%s magic found at: %d (invalid header)" % (magic.decode(), offset))
+        else:
+            print("%s magic found at: %d (header version %d, page size %d)" % (
+                magic.decode(), offset, image.header_version, image.page_size))
+    return candidates
+
+
+def get_ramdisk_view(mapped, view, seeklimit=bootimg.SEEK_LIMIT, offset=None, fragment=None):
+    # an unpacked ramdisk is used as is, a boot image is reduced to its ramdisk section or one fragment of it;
+    # a MediaTek header in front of either is skipped
+    header, payload = bootimg.get_mtk_payload(view, bootimg.Section("ramdisk", 0, len(view)))
+    if ramdisk.get_compression(view[payload.offset:payload.offset + 6]) is not None:
+        return view[payload.offset:payload.offset + payload.size]
+    image = bootimg.parse_image(mapped, seeklimit=seeklimit, offset=offset)
+    section = image.section("vendor_ramdisk" if image.is_vendor else "ramdisk")
+    if section.offset + section.size > len(view):
+        raise ValueError(section.name + " extends past the end of the image.")
+    if fragment is not None:
+        if not image.is_vendor:
+            raise ValueError("only vendor boot images have ramdisk fragments.")
+        return bootimg.find_fragment(bootimg.get_ramdisk_fragments(view, image), fragment).view(view)
+    header, payload = bootimg.get_mtk_payload(view, section)
+    return view[payload.offset:payload.offset + payload.size]
+
+
+def write_fragments(fragments, out=None):
+    print("BOARD_VENDOR_RAMDISK_TABLE_ENTRY_NUM %d" % len(fragments), file=out)
+    for fragment in fragments:
+        print("BOARD_VENDOR_RAMDISK_FRAGMENT %d %s %s %d %s" % (
+            fragment.index, fragment.type_name, fragment.name or "-", fragment.size,
+            ",".join("0x%08x" % value for value in fragment.board_id)), file=out)
+
+
+def write_bootconfig(params, out=None):
+    for key, value in params:
+        print("BOARD_BOOTCONFIG %s=%s" % (key, value), file=out)
+
+
+def get_fragment_section(fragment):
+    return bootimg.Section("vendor_ramdisk." + (fragment.name or "%02d" % fragment.index), fragment.offset,
+                           fragment.size)
+
+
+def get_fragment_sections(image, fragments):
+    # every fragment of a ramdisk table is unpacked on its own, with the table described in vendor_ramdisk_fragments
+    if fragments is None or image.section("vendor_ramdisk_table") is None:
+        return []
+    return [get_fragment_section(fragment) for fragment in fragments]
+
+
+def write_fragment_table(fragments, prefix):
+    with open(prefix + "vendor_ramdisk_fragments", "w") as file:
+        write_fragments(fragments, file)
+
+
+def write_fragment_to_file(prefix, fd, view, fragment, store=None):
+    write_section_to_file(prefix, fd, view, get_fragment_section(fragment), store)
+
+
+def list_ramdisk(path, seeklimit=bootimg.SEEK_LIMIT, offset=None, fragment=None):
+    with open_image(path) as (fd, buf, view):
+        entries = ramdisk.index_ramdisk(get_ramdisk_view(buf, view, seeklimit, offset, fragment))
+
+    for entry in entries:
+        print("%06o %10d %s" % (entry.mode, entry.size, entry.name))
+    return entries
+
+
+def extract_ramdisk_files(path, directory, names, seeklimit=bootimg.SEEK_LIMIT, offset=None, fragment=None):
+    with open_image(path) as (fd, buf, view):
+        ramdisk_view = get_ramdisk_view(buf, view, seeklimit, offset, fragment)
+        try:
+            for name in names:
+                entry, data = ramdisk.extract_file(ramdisk_view, name)
+                target = os.path.normpath(os.path.join(directory, entry.name))
+                root = os.path.abspath(directory)
+                if os.path.commonpath([root, os.path.abspath(target)]) != root:
+                    raise ValueError(entry.name + " points outside of the output directory.")
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with open(target, "wb") as output:
+                    output.write(data)
+                print(target)
+        finally:
+            ramdisk_view.release()
+
+
+def unpack(path, directory, seeklimit=bootimg.SEEK_LIMIT, offset=None, fragment=None, mtk=False, store=None):
+    prefix = os.path.join(directory, sources.get_image_name(path) + "-")
+    with open_image(path) as (fd, buf, view):
+        image = bootimg.parse_image(buf, seeklimit=seeklimit, offset=offset)
+        end = len(view)
+        for section in image.sections:
+            if section.offset + section.size > end:
+                raise ValueError(section.name + " extends past the end of " + path + ".")
+        fragments = None
+        if image.is_vendor and image.header_version > 3:
+            fragments = bootimg.get_ramdisk_fragments(view, image)
+        if fragment is not None:
+            if fragments is None:
+                raise ValueError(path + " has no vendor ramdisk table.")
+            write_fragment_to_file(prefix, fd, view, bootimg.find_fragment(fragments, fragment), store)
+            return image
+        write_settings(image, prefix)
+        if fragments is not None:
+            write_fragments(fragments)
+        bootconfig = image.section("bootconfig")
+        if bootconfig is not None:
+            write_bootconfig(bootimg.parse_bootconfig(view[bootconfig.offset:bootconfig.offset + bootconfig.size]))
+        sections = image.sections
+        if mtk:
+            sections, names = get_mtk_sections(view, image)
+            write_mtk_settings(names, prefix)
+        fragment_sections = get_fragment_sections(image, fragments)
+        if fragment_sections:
+            write_fragment_table(fragments, prefix)
+        for section in sections + fragment_sections:
+            write_section_to_file(prefix, fd, view, section, store)
+    return image
+
+
 def main():
     args = parse_arguments();
-    print("unmkbootimg")
+    instrument.start_from_arguments(args)
 
-    if not os.path.isfile(args.i):
+    if not os.path.isfile(args.i) and not sources.needs_source(args.i):
         print(args.i + " is not a file.")
+        quit()
+
+    try:
+        if args.scan:
+            if not scan(args.i, args.seeklimit):
+                print("Boot image magic not found.")
+            quit()
+
+        if args.list:
+            list_ramdisk(args.i, args.seeklimit, args.offset, args.fragment)
+            quit()
+
+        if args.o is None or not os.path.isdir(args.o):
+            print(str(args.o) + " is not a directory.")
+            quit()
+
+        if args.extract:
+            extract_ramdisk_files(args.i, args.o, args.extract, args.seeklimit, args.offset, args.fragment)
+            quit()
 
-    header = "ANDROID!"
-    with open(args.i, 'rb') as file:
-        header = file.read(0x260)
-
-    # base = ctypes.c_byte(0)
-    # run = True
-    # countdown = 8
-    #
-    android_header = b"ANDROID!"
-    # header2 = (ctypes.c_char_p * len(android_header))()
-    # header2[:] = android_header
-    # tmp_header = header.encode('utf-8', 'strict')
-    # while run:
-    #     if countdown == 0:
-    #         break
-    #     countdown = countdown - 1
-    #     run = header == tmp_header
-    #     neg_two = ctypes.c_uint(-2)
-    #     one = ctypes.c_uint(1)
-    #     header = header + ctypes.cast(base,ctypes.c_uint) * neg_two + one
-    #     tmp_header = int(tmp_header) + base * -2 + 1
-
-    print(android_header + 8)
+        store = sectionstore.SectionStore(args.store) if args.store else None
+        unpack(args.i, args.o, args.seeklimit, args.offset, args.fragment, args.mtk, store)
+    except (ValueError, OSError) as error:
+        print(error)
+        quit()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+from collections import deque
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from concurrent.futures import ThreadPoolExecutor
+
+import bootimg
+import instrument
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def usage():
+    return """verifybootimg.py
+        -i: one or more boot images
+        -hashtype: digest used for per-section reports (default sha256)
+        -seeklimit: bytes to search for the ANDROID!/VNDRBOOT magic (default 65536)
+        -jobs: hashing threads (default: all cores)
+        -json: print one JSON line per image""" + instrument.usage()
+
+
+def parse_arguments():
+    parser = ArgumentParser(formatter_class=RawDescriptionHelpFormatter, epilog=usage())
+    parser.add_argument("-i", required=True, nargs="+")
+    parser.add_argument("-hashtype", required=False, default="sha256")
+    parser.add_argument("-seeklimit", required=False, default=bootimg.SEEK_LIMIT, type=lambda value: int(value, 0))
+    parser.add_argument("-jobs", required=False, default=None, type=int)
+    parser.add_argument("-json", required=False, default=False, action="store_true")
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    return args
+
+
+def hash_view(hasher, view):
+    # hashlib drops the GIL for large updates, so chunks keep other threads moving
+    for start in range(0, len(view), CHUNK_SIZE):
+        hasher.update(view[start:start + CHUNK_SIZE])
+    return hasher
+
+
+def get_section_digest(view, section, hashtype):
+    with instrument.span("hashing", section=section.name):
+        digest = hash_view(hashlib.new(hashtype), view[section.offset:section.offset + section.size]).hexdigest()
+    instrument.count("bytes_hashed", section.size)
+    return digest
+
+
+def get_image_id(view, image, hashtype):
+    # each id section is read once; every chunk feeds both the boot id hash and that section's own digest
+    hasher = hashlib.new(bootimg.get_hash_type(image.header))
+    digests = {}
+    with instrument.span("hashing", section="id"):
+        for name, section in bootimg.get_id_sections(image):
+            size = 0
+            if section is not None:
+                section_hasher = hashlib.new(hashtype)
+                data = view[section.offset:section.offset + section.size]
+                for start in range(0, len(data), CHUNK_SIZE):
+                    chunk = data[start:start + CHUNK_SIZE]
+                    hasher.update(chunk)
+                    section_hasher.update(chunk)
+                digests[name] = section_hasher.hexdigest()
+                size = section.size
+            hasher.update(struct.pack("<I", size))
+            instrument.count("bytes_hashed", size)
+    digest = hasher.digest()[:32]
+    return digest + bytes(32 - len(digest)), digests
+
+
+class Verification:
+    def __init__(self, path, image, stored_id, id_future, section_futures):
+        self.path = path
+        self.image = image
+        self.stored_id = stored_id
+        self.id_future = id_future
+        self.section_futures = section_futures
+
+    def result(self):
+        record = {"path": self.path, "hash_type": None, "id": None, "computed_id": None, "status": "no id",
+                  "sections": {}}
+        computed_id, id_digests = self.id_future.result() if self.id_future is not None else (None, {})
+        for section in self.image.sections:
+            future = self.section_futures.get(section.name)
+            record["sections"][section.name] = {"offset": section.offset, "size": section.size,
+                                                "digest": future.result() if future else id_digests[section.name]}
+        if self.id_future is not None:
+            record["hash_type"] = bootimg.get_hash_type(self.image.header)
+            record["id"] = self.stored_id.hex()
+            record["computed_id"] = computed_id.hex()
+            record["status"] = "ok" if computed_id == self.stored_id else "mismatch"
+        return record
+
+
+def submit_verification(executor, path, view, hashtype, seeklimit=bootimg.SEEK_LIMIT):
+    image = bootimg.parse_image(view.obj, seeklimit=seeklimit)
+    for section in image.sections:
+        if section.offset + section.size > len(view):
+            raise ValueError(section.name + " extends past the end of " + path + ".")
+    stored_id = bootimg.get_stored_id(image)
+    id_future = executor.submit(get_image_id, view, image, hashtype) if stored_id is not None else None
+    # sections outside the boot id are hashed on their own, in parallel with the id pass
+    id_names = {name for name, section in bootimg.get_id_sections(image)} if id_future is not None else set()
+    section_futures = {section.name: executor.submit(get_section_digest, view, section, hashtype)
+                       for section in image.sections if section.name not in id_names}
+    return Verification(path, image, stored_id, id_future, section_futures)
+
+
+class MappedImage:
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        try:
+            if os.fstat(self.file.fileno()).st_size == 0:
+                raise ValueError(path + " is empty.")
+            self.mapped = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            self.file.close()
+            raise
+        self.view = memoryview(self.mapped)
+
+    def close(self):
+        self.view.release()
+        self.mapped.close()
+        self.file.close()
+
+
+def verify(paths, hashtype="sha256", jobs=None, seeklimit=bootimg.SEEK_LIMIT):
+    # every image is mapped once; the id hash and the per-section digests all read from that mapping.
+    # a few images stay in flight so small images do not leave the pool idle
+    jobs = jobs or os.cpu_count()
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for path in paths:
+            try:
+                mapped = MappedImage(path)
+            except (OSError, ValueError) as error:
+                pending.append((None, {"path": path, "status": "error", "error": str(error)}))
+            else:
+                try:
+                    pending.append((mapped, submit_verification(executor, path, mapped.view, hashtype, seeklimit)))
+                except ValueError as error:
+                    mapped.close()
+                    pending.append((None, {"path": path, "status": "error", "error": str(error)}))
+            while len(pending) > jobs:
+                yield collect(*pending.popleft())
+        while pending:
+            yield collect(*pending.popleft())
+
+
+def collect(mapped, verification):
+    if mapped is None:
+        return verification
+    try:
+        return verification.result()
+    finally:
+        mapped.close()
+
+
+def print_result(record):
+    if record["status"] == "error":
+        print("ERROR " + record["path"] + ": " + record["error"])
+        return
+    if record["status"] == "no id":
+        print("NOID " + record["path"])
+    elif record["status"] == "ok":
+        print("OK " + record["path"] + " " + record["hash_type"] + " 0x" + record["id"])
+    else:
+        print("MISMATCH " + record["path"] + " " + record["hash_type"] + " stored 0x" + record["id"] +
+              " computed 0x" + record["computed_id"])
+    for name, section in record["sections"].items():
+        print("    %s %d %s" % (name, section["size"], section["digest"]))
+
+
+def main():
+    args = parse_arguments()
+    instrument.start_from_arguments(args)
+    if args.hashtype not in hashlib.algorithms_available:
+        print("unknown hash algorithm '" + args.hashtype + "'")
+        quit()
+
+    failed = False
+    for record in verify(args.i, args.hashtype, args.jobs, args.seeklimit):
+        if args.json:
+            print(json.dumps(record))
+        else:
+            print_result(record)
+        failed = failed or record["status"] in ("error", "mismatch")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()